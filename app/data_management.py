@@ -9,6 +9,7 @@ import os
 import io
 import zipfile
 import tempfile
+import getpass
 import shutil
 import streamlit as st
 from pathlib import Path
@@ -33,6 +34,10 @@ class TempDirManager:
             self._results_dir = Path(raw_path).resolve()
         return self._results_dir
 
+    def get_cache_dir(self):
+        """Get the per-user fit cache dir. It sits beside the temp dirs, is kept on cleanup and is created by FitCache (mode 0o700)."""
+        return Path(tempfile.gettempdir()).resolve() / f"precat_fit_cache_{getpass.getuser()}"
+
     def _cleanup(self):
         """Safely removes the directories."""
         for d in [self._upload_dir, self._results_dir]:
@@ -68,7 +73,7 @@ def create_zip_in_memory(directory_path):
     zip_buffer.seek(0)
     return zip_buffer
 
-def prepare_data_for_saving(pixel_maps, b1_map, wassr_map, t1_map, quesp_maps):
+def prepare_data_for_saving(pixel_maps, b1_map, wassr_map, t1_map, quesp_maps, volume_maps=None, b1_corrected_maps=None):
     """
     Selects only the necessary, final data from session_state for saving.
     It dynamically builds the 'fits' dictionary to only include
@@ -83,8 +88,8 @@ def prepare_data_for_saving(pixel_maps, b1_map, wassr_map, t1_map, quesp_maps):
     }
     # 2. Define all *possible* non-map fit keys
     possible_fit_keys = [
-        'cest', 'wassr', 'damb1', 
-        'quesp', 't1', 'cest-mrf'
+        'cest', 'cest_powers', 'wassr', 'wassr_residual_map', 'damb1', 
+        'quesp', 't1', 't1_full_map', 'cest-mrf'
     ]
     # 3. Dynamically add *only* the data that actually exists
     for key in possible_fit_keys:
@@ -102,4 +107,8 @@ def prepare_data_for_saving(pixel_maps, b1_map, wassr_map, t1_map, quesp_maps):
         data_to_save['fits']['t1_map'] = t1_map
     if quesp_maps is not None:
         data_to_save['fits']['quesp_maps'] = quesp_maps
+    if volume_maps is not None:
+        data_to_save['fits']['cest_volume_maps'] = volume_maps
+    if b1_corrected_maps is not None:
+        data_to_save['fits']['cest_b1_corrected_maps'] = b1_corrected_maps
     return data_to_save    
\ No newline at end of file
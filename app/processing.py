@@ -6,11 +6,62 @@ Created on Mon Feb 23 15:56:30 2026
 @author: jonah
 """
 import os
+import numpy as np
 import streamlit as st
-from scripts import pre_processing, load_study, draw_rois, cest_fitting, quesp_fitting
+from scripts import pre_processing, load_study, draw_rois, cest_fitting, quesp_fitting, fit_cache, plotting
 from scripts.mrf_scripts import load_mrf, mrf_fitting
 from custom import st_functions
 
+def recon_cest(submitted, cest_path, dtype):
+    """
+    Reconstructs one CEST scan with the submitted acquisition type, motion correction and denoising settings.
+    """
+    cest_type = submitted.get('cest_type')
+    use_pca = submitted.get('pca', False)
+    use_moco = submitted.get('moco_cest', False)
+
+    if cest_type == 'Radial':
+        if use_moco:
+            recon_results = pre_processing.run_radial_preprocessing(
+                submitted['folder_path'],
+                cest_path,
+                use_pca, 
+                'cest',
+                dtype
+            )
+        else:
+            recon_results = load_study.recon_bart(
+                cest_path, submitted['folder_path'], dtype
+            )
+    else: # Rectilinear
+        recon_results = load_study.recon_bruker(
+            cest_path, submitted['folder_path'], dtype, split_slices=True
+        )
+
+    if use_pca and not use_moco: 
+        recon_results['imgs'] = pre_processing.denoise_data(recon_results['imgs'])
+    return recon_results
+
+def align_cest_powers(submitted, reference, k, flip):
+    """
+    Orients and drift-corrects the additional saturation power scans like the main CEST scan.
+    Scans whose offsets or image size differ from the reference are skipped with a warning.
+    Returns {label: thermal_drift output} in submission order.
+    """
+    powers = {}
+    for path, recon in zip(submitted['cest_power_paths'], st.session_state.recon_data['cest_powers']):
+        oriented = load_study.rotate_image_stack(recon['imgs'], k)
+        if flip:
+            oriented = load_study.flip_image_stack_vertically(oriented)
+        corrected = load_study.thermal_drift({"imgs": oriented, "offsets": recon['offsets']})
+        label = load_study.power_label(recon.get('sat_power'), path)
+        if corrected['imgs'].shape != reference['imgs'].shape or not np.array_equal(corrected['offsets'], reference['offsets']):
+            st_functions.message_logging(f"CEST {label} does not match the offsets or matrix size of the main CEST scan and is not fit.", msg_type='warning')
+            continue
+        corrected['sat_power'] = recon.get('sat_power')
+        powers[label] = corrected
+    return powers
+
 def do_processing_pipeline():
     """
     Manages the sequential processing pipeline for all experiment types.
@@ -39,33 +90,14 @@ def do_processing_pipeline():
             # Sort tasks
             task_order = ['cest', 'quesp', 'cest-mrf', 'wassr', 'damb1']
             tasks_to_run.sort(key=task_order.index)
+            dtype = np.float32 if submitted.get('single_precision') else np.float64
             for exp_type in tasks_to_run:
                 if exp_type == 'cest':
-                    cest_type = submitted.get('cest_type')
-                    use_pca = submitted.get('pca', False)
-                    use_moco = submitted.get('moco_cest', False)
-
-                    if cest_type == 'Radial':
-                        if use_moco:
-                            recon_results = pre_processing.run_radial_preprocessing(
-                                submitted['folder_path'],
-                                submitted['cest_path'],
-                                use_pca, 
-                                exp_type
-                            )
-                        else:
-                            recon_results = load_study.recon_bart(
-                                submitted['cest_path'], submitted['folder_path']
-                            )
-                    else: # Rectilinear
-                        recon_results = load_study.recon_bruker(
-                            submitted['cest_path'], submitted['folder_path']
-                        )
-
-                    if use_pca and not use_moco: 
-                        recon_results['imgs'] = pre_processing.denoise_data(recon_results['imgs'])
-                    
-                    st.session_state.recon_data['cest'] = recon_results
+                    st.session_state.recon_data['cest'] = recon_cest(submitted, submitted['cest_path'], dtype)
+                    # Additional saturation powers are reconstructed the same way as the main scan
+                    power_paths = submitted.get('cest_power_paths') or []
+                    if power_paths:
+                        st.session_state.recon_data['cest_powers'] = [recon_cest(submitted, path, dtype) for path in power_paths]
 
                 if exp_type == 'wassr':
                     wassr_type = submitted.get('wassr_type')
@@ -74,15 +106,16 @@ def do_processing_pipeline():
                             submitted['folder_path'],
                             submitted['wassr_path'],
                             False,
-                            exp_type 
+                            exp_type,
+                            dtype
                         )
                     elif wassr_type == 'Radial':
                         st.session_state.recon_data['wassr'] = load_study.recon_bart(
-                            submitted['wassr_path'], submitted['folder_path']
+                            submitted['wassr_path'], submitted['folder_path'], dtype
                         )
                     else: # Rectilinear
                         st.session_state.recon_data['wassr'] = load_study.recon_bruker(
-                            submitted['wassr_path'], submitted['folder_path']
+                            submitted['wassr_path'], submitted['folder_path'], dtype, split_slices=True
                         )
                 if exp_type == "damb1":
                     st.session_state.recon_data['damb1'] = load_study.recon_damb1(submitted['folder_path'], submitted['theta_path'], submitted['two_theta_path'])
@@ -152,7 +185,21 @@ def do_processing_pipeline():
                         st.session_state.processed_data[exp_type] = processed_mrf
                     elif 'offsets' in recon and 'powers' not in recon: # CEST/WASSR
                         corrected = load_study.thermal_drift({"imgs": oriented, "offsets": recon['offsets']})
-                        st.session_state.processed_data[exp_type] = corrected
+                        n_slices = load_study.slice_count(corrected['imgs'])
+                        if exp_type == 'cest':
+                            corrected['sat_power'] = recon.get('sat_power')
+                            if 'cest_powers' in st.session_state.recon_data:
+                                st.session_state.processed_data['cest_powers'] = align_cest_powers(submitted, corrected, k, flip)
+                        if exp_type == 'cest' and n_slices > 1:
+                            # Volumes are kept whole for volume mapping; ROI analysis uses one slice (chosen in Stage 4)
+                            st.session_state.processed_data['cest_volume'] = corrected
+                            st_functions.message_logging(f"Multi-slice CEST data: {n_slices} slices.", msg_type='info')
+                        elif n_slices > 1:
+                            st_functions.message_logging(f"Multi-slice {exp_type.upper()} data: only the center slice is used.", msg_type='warning')
+                        st.session_state.processed_data[exp_type] = load_study.select_slice(corrected, n_slices // 2)
+                        if exp_type == 'cest' and submitted.get('quick_look'):
+                            st.session_state.fits['cest_quick_look'] = cest_fitting.quick_look_maps(
+                                corrected['imgs'], corrected['m0'], corrected['offsets'], submitted.get('custom_contrasts'))
                     elif 'powers' in recon: # QUESP
                         corrected = load_study.process_quesp({"imgs": oriented, "powers": recon['powers'], "tsats": recon['tsats'], "trecs": recon['trecs'], "offsets": recon['offsets']}, denoise = submitted.get('quesp_denoise'))
                         st.session_state.processed_data[exp_type] = corrected
@@ -166,6 +213,18 @@ def do_processing_pipeline():
     if st.session_state.pipeline_status.get('processing_done') and not st.session_state.pipeline_status.get('rois_done', False):
         roi_canvas_placeholder = st.empty()
         with roi_canvas_placeholder.container():
+            volume = st.session_state.processed_data.get('cest_volume')
+            quick_look_maps = st.session_state.fits.get('cest_quick_look')
+            roi_slice = None
+            if volume is not None:
+                n_slices = load_study.slice_count(volume['imgs'])
+                roi_slice = st.slider("CEST slice for ROI analysis", 1, n_slices, n_slices // 2 + 1, key="roi_slice") - 1
+                st.session_state.processed_data['cest'] = load_study.select_slice(volume, roi_slice)
+                if quick_look_maps is not None:
+                    quick_look_maps = load_study.select_slice(quick_look_maps, roi_slice, n_slices)
+            if quick_look_maps is not None:
+                with st.expander("Quick-look CEST maps (MTRasym / Lorentzian difference, no fitting)"):
+                    plotting.plot_quick_look(st.session_state.processed_data['cest']['m0'], quick_look_maps, submitted['save_path'])
             # Determine the best reference image for drawing ROIs
             primary_exp = selection[0]
             processed_exp_data = st.session_state.processed_data[primary_exp]
@@ -181,6 +240,9 @@ def do_processing_pipeline():
             rois = draw_rois.cardiac_roi(canvas_bg_image, canvas_shape_ref) if submitted['organ'] == 'Cardiac' else draw_rois.draw_rois(canvas_bg_image, canvas_shape_ref)
         if rois:
             st.session_state.user_geometry['rois'] = rois
+            st.session_state.user_geometry['slice'] = roi_slice
+            if quick_look_maps is not None:
+                st.session_state.fits['cest_quick_look'] = quick_look_maps
             st.session_state.pipeline_status['rois_done'] = True
             st_functions.message_logging("ROI definition complete!")
             roi_canvas_placeholder.empty()
@@ -190,7 +252,7 @@ def do_processing_pipeline():
 
     # --- Stage 5: Fitting --- #
     if st.session_state.pipeline_status.get('rois_done') and not st.session_state.pipeline_status.get('fitting_done', False):
-        with st.spinner("Performing final analysis..."):
+        with st.spinner("Performing final analysis..."), cest_fitting.WorkerPool() as pool:
             # --- Generate masks and AHA segments ---
             # Determine reference image
             primary_exp = selection[0]
@@ -209,13 +271,79 @@ def do_processing_pipeline():
                 st.session_state.user_geometry['aha'] = draw_rois.aha_segmentation(lv_mask, masks['insertion_points'])
 
             # --- Run fitting for all selected types --- #
+            cache = None
+            if submitted.get('cache_dir'):
+                try:
+                    cache = fit_cache.FitCache(submitted['cache_dir'])
+                except PermissionError as e:
+                    st_functions.message_logging(f"Fit cache disabled: {e}", msg_type='warning')
+            # WASSR runs first so its B0 map can replace the CEST B0 pre-fit
+            if "wassr" in selection:
+                proc_data = st.session_state.processed_data['wassr']
+                if submitted.get('full_b0_mapping'):
+                    st.session_state.fits['wassr'], st.session_state.fits['wassr_full_map'], residual_map = cest_fitting.fit_wassr_full(
+                        proc_data['imgs'], proc_data['offsets'], st.session_state.user_geometry, submitted.get('wassr_algorithm', 'lorentzian'), submitted.get('sparse_b0', False))
+                    if residual_map is not None:
+                        st.session_state.fits['wassr_residual_map'] = residual_map
+                else:
+                    st.session_state.fits['wassr'] = cest_fitting.fit_wassr_masked(proc_data['imgs'], proc_data['offsets'], st.session_state.user_geometry, submitted.get('wassr_algorithm', 'lorentzian'))
+
             if "cest" in selection:
                 proc_data = st.session_state.processed_data['cest']
+                volume = st.session_state.processed_data.get('cest_volume')
+                b0_map = None
+                if submitted.get('wassr_b0') and 'wassr' in st.session_state.fits and volume is not None:
+                    st_functions.message_logging("WASSR B₀ maps are single-slice, so B₀ will be fit from the multi-slice CEST data.", msg_type='warning')
+                elif submitted.get('wassr_b0') and 'wassr' in st.session_state.fits:
+                    b0_map = cest_fitting.wassr_b0_map(st.session_state.fits['wassr'], st.session_state.user_geometry, proc_data['imgs'].shape[:2], st.session_state.fits.get('wassr_full_map'))
+                    if b0_map.shape != proc_data['imgs'].shape[:2]:
+                        st_functions.message_logging("WASSR and CEST matrix sizes differ, B₀ will be fit from the CEST data.", msg_type='warning')
+                        b0_map = None
+                    else:
+                        st_functions.message_logging("Using the WASSR B₀ map for CEST B₀ correction.", msg_type='info')
                 spectra = cest_fitting.calc_spectra(proc_data['imgs'], st.session_state.user_geometry)
-                st.session_state.fits['cest'] = cest_fitting.fit_all_rois(spectra, proc_data['offsets'], submitted.get('custom_contrasts'))
-                if submitted.get('pixelwise'):
+                roi_shifts = cest_fitting.roi_b0_shifts(b0_map, st.session_state.user_geometry) if b0_map is not None else None
+                st.session_state.fits['cest'] = cest_fitting.fit_all_rois(spectra, proc_data['offsets'], submitted.get('custom_contrasts'), roi_shifts, cache=cache)
+                power_studies = st.session_state.processed_data.get('cest_powers')
+                if power_studies:
+                    # Other saturation powers share the ROIs and the B0 correction of the main scan
+                    roi_slice = st.session_state.user_geometry['slice']
+                    power_spectra = [cest_fitting.calc_spectra(load_study.select_slice(study, roi_slice)['imgs'], st.session_state.user_geometry)
+                                     for study in power_studies.values()]
+                    power_fits = cest_fitting.fit_all_powers(power_spectra, proc_data['offsets'], st.session_state.fits['cest'], submitted.get('custom_contrasts'), cache=cache)
+                    st.session_state.fits['cest_powers'] = dict(zip(power_studies, power_fits))
+                if submitted.get('pixelwise') and submitted.get('full_fov') and volume is not None:
+                    if submitted.get('snr_triage'):
+                        st_functions.message_logging("SNR triage is not applied to multi-slice volume mapping.", msg_type='info')
+                    volume_fits = cest_fitting.fit_volume(volume['imgs'], volume['m0'], volume['offsets'], submitted.get('custom_contrasts'), submitted.get('pixel_engine', 'serial'), submitted.get('warm_start'), cache=cache, pool=pool)
+                    if volume_fits is not None:
+                        st.session_state.fits['cest_volume'] = volume_fits
+                        roi_slice_fits = volume_fits[st.session_state.user_geometry['slice']]
+                        if roi_slice_fits is not None:
+                            st.session_state.fits['cest_pixelwise'] = roi_slice_fits
+                elif submitted.get('pixelwise') and submitted.get('full_fov'):
+                    fov_fits = cest_fitting.fit_full_fov(proc_data['imgs'], proc_data['m0'], proc_data['offsets'], submitted.get('custom_contrasts'), submitted.get('pixel_engine', 'serial'), submitted.get('warm_start'), b0_map, cache=cache, triage=submitted.get('snr_triage'), coarse=submitted.get('coarse_triage'), pool=pool)
+                    if fov_fits is not None:
+                        st.session_state.fits['cest_pixelwise'] = fov_fits
+                elif submitted.get('pixelwise'):
                     pixel_spectra = cest_fitting.calc_spectra_pixelwise(proc_data['imgs'], st.session_state.user_geometry)
-                    st.session_state.fits['cest_pixelwise'] = cest_fitting.fit_all_pixels(pixel_spectra, proc_data['offsets'], submitted.get('custom_contrasts'))
+                    warm_starts = None
+                    if submitted.get('warm_start'):
+                        warm_starts = cest_fitting.pixel_warm_starts(st.session_state.user_geometry, st.session_state.fits['cest'])
+                    pixel_shifts = cest_fitting.pixel_b0_shifts(b0_map, st.session_state.user_geometry) if b0_map is not None else None
+                    pixel_snr = None
+                    if submitted.get('snr_triage'):
+                        snr_map = cest_fitting.pixel_snr(proc_data['imgs'], proc_data['m0'], proc_data['offsets'])
+                        pixel_snr = cest_fitting.pixel_values(snr_map, st.session_state.user_geometry)
+                    pixel_fits = cest_fitting.fit_all_pixels(pixel_spectra, proc_data['offsets'], submitted.get('custom_contrasts'), submitted.get('pixel_engine', 'serial'), warm_starts, compact=True, b0_shifts=pixel_shifts, cache=cache, snr=pixel_snr, coarse=submitted.get('coarse_triage'), pool=pool)
+                    st.session_state.fits['cest_pixelwise'] = cest_fitting.collect_pixel_fits(pixel_fits, st.session_state.user_geometry)
+                if power_studies and 'damb1' in selection and 'cest_pixelwise' in st.session_state.fits:
+                    # Pixelwise maps at every power are the lookup table for the DAMB1 B1 correction
+                    power_imgs = [load_study.select_slice(study, st.session_state.user_geometry['slice'])['imgs'] for study in power_studies.values()]
+                    power_pixel_fits = cest_fitting.fit_power_pixels(st.session_state.fits['cest_pixelwise'], power_imgs, proc_data['offsets'], submitted.get('custom_contrasts'), cache=cache)
+                    st.session_state.fits['cest_powers_pixelwise'] = dict(zip(power_studies, power_pixel_fits))
+                if cache is not None and cache.hits:
+                    st_functions.message_logging(f"Reused {cache.hits} cached CEST fit result(s) from a previous analysis.", msg_type='info')
                 if submitted['organ'] == 'Cardiac':
                     cest_fits = st.session_state.fits.get('cest', {})
                     segments_to_check = ["Anterior", "Anteroseptal"] # Can be changed if needed
@@ -227,20 +355,15 @@ def do_processing_pipeline():
                                 st_functions.message_logging(f"Fit RMSE in {segment.lower()} segment > 2% (RMSE = {rmse*100:.3f}%)!", msg_type='warning')
 
             if "quesp" in selection:
-                if submitted['t1_path']:
+                if submitted['t1_path'] and submitted.get('full_t1_map'):
+                    t1_fits, st.session_state.fits['t1_full_map'] = quesp_fitting.fit_t1_full(st.session_state.recon_data['t1'], masks)
+                elif submitted['t1_path']:
                     t1_fits = quesp_fitting.fit_t1_map(st.session_state.recon_data['t1'], masks)
                 else:
                     t1_fits = quesp_fitting.fixed_t1_map(submitted['fixed_t1'], masks)
                 st.session_state.fits['t1'] = t1_fits
                 st.session_state.fits['quesp'] = quesp_fitting.fit_quesp_map(st.session_state.processed_data['quesp'], t1_fits, masks, submitted.get('quesp_type'), submitted.get('fixed_fb'))
             
-            if "wassr" in selection:
-                proc_data = st.session_state.processed_data['wassr']
-                if submitted.get('full_b0_mapping'):
-                    st.session_state.fits['wassr'], st.session_state.fits['wassr_full_map'] = cest_fitting.fit_wassr_full(proc_data['imgs'], proc_data['offsets'], st.session_state.user_geometry)
-                else:
-                    st.session_state.fits['wassr'] = cest_fitting.fit_wassr_masked(proc_data['imgs'], proc_data['offsets'], st.session_state.user_geometry)
-
             if "damb1" in selection:
                 proc_data = st.session_state.processed_data['damb1']
                 st.session_state.fits['damb1'] = cest_fitting.fit_b1(proc_data['imgs'], proc_data['nominal_flip'])
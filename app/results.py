@@ -8,7 +8,7 @@ Created on Mon Feb 23 16:30:36 2026
 import os
 import pickle
 from app import data_management
-from scripts import plotting, plotting_wassr, plotting_damb1, plotting_quesp
+from scripts import plotting, plotting_wassr, plotting_damb1, plotting_quesp, cest_fitting, lorentzian_fitting, load_study
 from scripts.mrf_scripts import plotting_mrf
 from custom import st_functions
 import streamlit as st
@@ -27,23 +27,77 @@ def display_results():
     wassr_map_for_saving = None
     t1_map_for_saving = None
     quesp_maps_for_saving = None
+    volume_maps_for_saving = None
+    b1_corrected_maps_for_saving = None
     
     if "CEST" in submitted['selection']:
         st.header('CEST Results')
+        if submitted['organ'] != 'Cardiac':
+            with st.expander("Refit with different contrasts"):
+                current_contrasts = submitted.get('custom_contrasts') or lorentzian_fitting.default_contrasts
+                contrast_selection = st.pills("Contrasts", list(lorentzian_fitting.contrast_params), default=current_contrasts,
+                                              selection_mode="multi", key="refit_contrasts")
+                if st.button("Refit contrasts", help="Reuses the B₀ correction and water/MT fits, so only the contrast pools are refit.") and contrast_selection:
+                    volume_fits = st.session_state.fits.get('cest_volume')
+                    with st.spinner("Refitting contrasts..."):
+                        # With volume maps the ROI slice pixels are part of the volume and refit with it
+                        st.session_state.fits['cest'], pixel_fits = cest_fitting.refit_all_contrasts(
+                            st.session_state.fits['cest'], st.session_state.fits.get('cest_pixelwise') if volume_fits is None else None, contrast_selection)
+                        if volume_fits is not None:
+                            volume_fits = [fits.refit_contrasts(contrast_selection) if fits is not None else None for fits in volume_fits]
+                            st.session_state.fits['cest_volume'] = volume_fits
+                            pixel_fits = volume_fits[st.session_state.user_geometry['slice']]
+                        if 'cest_powers' in st.session_state.fits:
+                            st.session_state.fits['cest_powers'] = cest_fitting.refit_all_powers(st.session_state.fits['cest_powers'], contrast_selection)
+                        if 'cest_powers_pixelwise' in st.session_state.fits:
+                            st.session_state.fits['cest_powers_pixelwise'] = {label: fits.refit_contrasts(contrast_selection)
+                                                                              for label, fits in st.session_state.fits['cest_powers_pixelwise'].items()}
+                    if pixel_fits is not None:
+                        st.session_state.fits['cest_pixelwise'] = pixel_fits
+                    submitted['custom_contrasts'] = contrast_selection
+                    st.rerun()
         ref_image = st.session_state.processed_data['cest']['m0']
         if submitted['organ'] == 'Cardiac':
             mask = st.session_state.user_geometry['masks']['lv']
             plotting.show_segmentation(ref_image, mask, st.session_state.user_geometry['aha'], save_path)
         else:
             plotting.show_rois(ref_image, st.session_state.user_geometry['masks'], save_path)
+        if 'cest_quick_look' in st.session_state.fits:
+            with st.expander("Quick-look maps (MTRasym / Lorentzian difference)"):
+                plotting.plot_quick_look(ref_image, st.session_state.fits['cest_quick_look'], save_path)
         if submitted.get('pixelwise') and 'cest_pixelwise' in st.session_state.fits:
             pixel_maps_for_saving = plotting.pixelwise_mapping(
                 ref_image, st.session_state.fits['cest_pixelwise'], 
                 st.session_state.user_geometry,
                 submitted.get('custom_contrasts'), submitted.get('smoothing_filter'), save_path
             )
+            with st.expander("Inspect single pixel fit"):
+                plotting.plot_pixel_zspec(st.session_state.fits['cest_pixelwise'], save_path)
+        if 'cest_powers_pixelwise' in st.session_state.fits and 'damb1' in st.session_state.fits:
+            power_studies = st.session_state.processed_data['cest_powers']
+            nominal_b1 = [st.session_state.processed_data['cest'].get('sat_power')] + \
+                         [power_studies[label].get('sat_power') for label in st.session_state.fits['cest_powers_pixelwise']]
+            if None in nominal_b1:
+                st.warning("B₁ correction needs the saturation power of every CEST scan, but it was not found in all method files.")
+            else:
+                with st.expander("B₁-corrected contrast maps"):
+                    st.caption(f"Contrast at {nominal_b1[0]:g} µT after correcting each pixel for its DAMB1 relative B₁.")
+                    corrected_maps = cest_fitting.correct_b1([st.session_state.fits['cest_pixelwise'], *st.session_state.fits['cest_powers_pixelwise'].values()],
+                                                             nominal_b1, st.session_state.fits['damb1'], nominal_b1[0])
+                    b1_corrected_maps_for_saving = plotting.plot_b1_corrected(ref_image, corrected_maps, save_path)
+        if 'cest_volume' in st.session_state.fits:
+            with st.expander("Volume maps (all slices)"):
+                volume_maps_for_saving = plotting.plot_volume_maps(
+                    st.session_state.processed_data['cest_volume']['m0'], st.session_state.fits['cest_volume'],
+                    submitted.get('custom_contrasts'), save_path)
 
         plotting.plot_zspec(st.session_state.fits['cest'], save_path)
+        if st.session_state.fits.get('cest_powers'):
+            st.subheader("Saturation power series")
+            reference_label = load_study.power_label(st.session_state.processed_data['cest'].get('sat_power'), submitted['cest_path'])
+            power_df = plotting.plot_power_series({reference_label: st.session_state.fits['cest'], **st.session_state.fits['cest_powers']}, save_path)
+            st.dataframe(power_df.style.format("{:.3f}", subset=power_df.columns[2:]))
+            st_functions.save_df_to_csv(power_df, save_path, type='CEST_Power_Series')
         
     if "QUESP" in submitted['selection']:
         st.header('QUESP Results')
@@ -52,6 +106,9 @@ def display_results():
             t1_map_for_saving = plotting_quesp.plot_t1_map(st.session_state.fits['t1'], st.session_state.processed_data['quesp']['m0'], st.session_state.user_geometry['masks'], save_path)
         with col2:
             plotting.show_rois(st.session_state.processed_data['quesp']['m0'], st.session_state.user_geometry['masks'], save_path)
+        if 't1_full_map' in st.session_state.fits:
+            with st.expander("Full-FOV T₁ map"):
+                plotting_quesp.plot_t1_full_map(st.session_state.fits['t1_full_map'], save_path)
         quespmin, quespmax = st.slider("Percentile range for plots and statistics display:", 0, 100, value=(5, 95))
         st.warning(f'Plot colorbars and statistics are displayed within the {quespmin}-{quespmax}th percentile range per ROI.')
         quesp_maps_for_saving = plotting_quesp.plot_quesp_maps(st.session_state.fits['quesp'], st.session_state.user_geometry['masks'], st.session_state.processed_data['quesp']['m0'], save_path, quespmin, quespmax)
@@ -79,6 +136,9 @@ def display_results():
         st.header('WASSR Results')
         ref_image = st.session_state.processed_data['cest']['m0'] if 'cest' in st.session_state.processed_data else st.session_state.processed_data['wassr']['m0']
         wassr_map_for_saving = plotting_wassr.plot_wassr(ref_image, st.session_state.user_geometry, st.session_state.fits.get('wassr'), save_path,st.session_state.fits.get('wassr_full_map'))
+        if 'wassr_residual_map' in st.session_state.fits:
+            with st.expander("Sparse B₀ field residuals"):
+                plotting_wassr.plot_wassr_residuals(st.session_state.fits['wassr_residual_map'], save_path)
         if submitted['organ'] == 'Cardiac':
             plotting_wassr.plot_wassr_aha(st.session_state.fits['wassr'], save_path)
 
@@ -112,7 +172,9 @@ def display_results():
         b1_map_for_saving,
         wassr_map_for_saving,
         t1_map_for_saving,
-        quesp_maps_for_saving
+        quesp_maps_for_saving,
+        volume_maps_for_saving,
+        b1_corrected_maps_for_saving
         )
 
     raw_data_dir = os.path.join(save_path, "Raw")
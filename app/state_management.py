@@ -38,7 +38,7 @@ def initialize_session_state():
         "recon_data": {},
         "orientation_params": {"radial": None, "rectilinear": None},
         "processed_data": {},
-        "user_geometry": {"rois": None, "masks": None, "aha": None},
+        "user_geometry": {"rois": None, "masks": None, "aha": None, "slice": None}, # slice: CEST volume slice the ROIs belong to
         "fits": {},
         # Log messages
         "timing_log": [],
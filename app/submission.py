@@ -101,6 +101,16 @@ def do_data_submission():
                     moco_cest = False
                     pca = False
                     pixelwise = False
+                    pixel_engine = 'serial'
+                    warm_start = False
+                    full_fov = False
+                    wassr_b0 = False
+                    quick_look = True
+                    snr_triage = False
+                    single_precision = False
+                    coarse_triage = False
+                    use_fit_cache = True
+                    cest_power_paths = []
                     cest_type = st.radio('CEST acquisition type', ["Radial", "Rectilinear"], horizontal=True)
                     st.markdown(
                     """
@@ -126,10 +136,28 @@ def do_data_submission():
                     if "CEST" in selection and cest_type == "Radial":
                         moco_cest = st.toggle('Motion correction (CEST)', help="Correct bulk motion by discarding spokes based on projection images.")
                     pca = st.toggle('Z-spectral denoising', help="Z-spectral denoising with principal component analysis. This is a *global* method using Malinowskis empirical indicator function.")
+                    single_precision = st.toggle('Single precision (float32)', help="Load, reconstruct and pre-process CEST/WASSR images in single precision. Halves image memory and speeds up denoising; fits still run in double precision.")
+                    use_fit_cache = st.toggle('Cache fit results', value=True, help="Store CEST fit results in a private per-user cache and reuse them when the same data are fit again with the same settings.")
+                    if "WASSR" in selection:
+                        wassr_b0 = st.toggle('WASSR B₀ correction', value=True, help="Use the WASSR B₀ map to shift CEST offsets instead of estimating B₀ from each Z-spectrum.")
+                    multi_power = st.toggle('Additional saturation powers', help="Fit CEST scans acquired at other saturation powers together with this scan. They must use the same offsets and matrix size, and share its ROIs and B₀ correction.")
+                    if multi_power:
+                        power_paths_input = st.text_input('Input additional CEST experiment numbers', placeholder='6, 7, 8', help='Comma-separated experiment numbers with the same CEST acquisition type.')
+                        cest_power_paths = [path.strip() for path in power_paths_input.split(',') if path.strip()]
+                        if not cest_power_paths:
+                            all_fields_filled = False
+                    quick_look = st.toggle('Quick-look maps', value=True, help="Show MTRasym and Lorentzian difference maps for the whole image, computed without fitting, before the Lorentzian fits run.")
                     pixelwise = st.toggle(
                         'Pixelwise mapping', help="Accuracy is highly dependent on field homogeneity.")
                     if pixelwise:
                         smoothing_filter = st.toggle('Median smoothing filter', help="Apply a median filter to smooth contrast maps.")
+                        pixel_engine = st.radio('Pixelwise fitting engine', ["Batched", "Parallel", "Serial"], horizontal=True,
+                            help="Batched fits blocks of pixels at once with a vectorized Levenberg-Marquardt solver. Parallel runs the SciPy fit on all CPU cores. Serial fits one pixel at a time with SciPy.").lower()
+                        warm_start = st.toggle('Warm-start pixel fits', value=True, help="Start each pixel fit from its ROI/segment fit or an already converged neighbouring pixel.")
+                        full_fov = st.toggle('Full field-of-view', help="Fit every pixel of the image instead of only the ROI(s). Background pixels are excluded using the M0 image intensity and SNR.")
+                        snr_triage = st.toggle('SNR triage', help="Estimate each pixel's SNR from the M0 image and the reference offsets and skip fitting pixels that are dominated by noise. Skipped pixels are reported in the log.")
+                        if snr_triage:
+                            coarse_triage = st.toggle('Coarse fits for borderline pixels', value=True, help="Fit pixels just above the SNR threshold with a reduced evaluation budget.")
                     if anatomy == "Other":
                         reference = st.toggle(
                             'Additional reference image', help="Use this option to load an additional reference image for ROI(s)/masking. By default, the unsaturated (S0/M0) image is used.")
@@ -184,6 +212,19 @@ def do_data_submission():
                     else:
                         st.error(f"CEST folder does not exist: {cest_full_path}")
                         cest_validation = False
+                    for power_path in cest_power_paths:
+                        power_full_path = os.path.join(folder_path, power_path)
+                        if power_path == cest_path or cest_power_paths.count(power_path) > 1:
+                            st.error(f"CEST experiment {power_path} is listed more than once.")
+                            cest_validation = False
+                        elif not os.path.isdir(power_full_path):
+                            st.error(f"CEST folder does not exist: {power_full_path}")
+                            cest_validation = False
+                        else:
+                            missing_items = validation.validate_radial(power_full_path) if cest_type == "Radial" else validation.validate_rectilinear(power_full_path)
+                            if missing_items:
+                                st.error(f"CEST folder {power_path} is missing the following required items: {', '.join(missing_items)}")
+                                cest_validation = False
 
             # QUESP validation
             if "QUESP" in selection:
@@ -194,12 +235,14 @@ def do_data_submission():
                     t1_input_method = None
                     fixed_t1_s = None
                     t1_path = None
+                    full_t1_map = False
                     quesp_path = st.text_input('Input QUESP experiment number', placeholder='4', help="Currently, only QUESP data acquired using the 'fp_EPI' sequence are supported.")
                     
                     t1_input_method = st.radio("T1 Input Method", ["Use T1 Map", "Use Fixed T1 Value"], horizontal=True, key="quesp_t1_method")
                     
                     if t1_input_method == "Use T1 Map":
                         t1_path = st.text_input('Input T1 mapping experiment number', placeholder='5', help="Currently, only VTR RARE T1 mapping is supported.")
+                        full_t1_map = st.toggle('Full-FOV T₁ map', help="Fit T₁ for every pixel above the background threshold, not only the ROIs. The full map is shown with the results.")
                     elif t1_input_method == "Use Fixed T1 Value":
                         fixed_t1_s = st.number_input("Input Fixed T1 Value (ms)", min_value=1, value=2000, step=1, format="%i", help="Enter the global T1 relaxation time in milliseconds.")
                     quesp_inputs_provided = quesp_path and \
@@ -350,6 +393,11 @@ def do_data_submission():
                     moco_wassr = False
                     wassr_type = st.radio('WASSR acquisition type', ["Radial", "Rectilinear"], horizontal=True)
                     full_b0_mapping = st.toggle('Full B0 mapping', value=False, help="Fit B0 map for the entire image. Slower, but allows for full map visualization.") 
+                    sparse_b0 = False
+                    if full_b0_mapping:
+                        sparse_b0 = st.toggle('Sparse B₀ sampling', help="Fit only every 4th pixel along each image axis and model the map as a smooth polynomial field. About 6% of the fits; the field residuals at the fitted pixels are shown with the results.")
+                    wassr_algorithm = st.radio('WASSR B₀ algorithm', ["Lorentzian", "MSCF"], horizontal=True,
+                        help="Lorentzian fits water + MT to each spline-interpolated spectrum. MSCF (maximum-symmetry centre frequency) finds the centre of symmetry of each spectrum without fitting, which is faster and less sensitive to asymmetric lineshapes.").lower()
                     if "WASSR" in selection and wassr_type == "Radial":
                         moco_wassr = st.toggle('Motion correction (WASSR)', help="Correct bulk motion by discarding spokes based on projection images.")
                     if not wassr_type:
@@ -426,11 +474,22 @@ def do_data_submission():
                             "selection": selection,
                             "organ": anatomy,
                             "reference": st.session_state.get("reference"),
-                            "custom_contrasts": st.session_state.get("custom_contrasts"),}
+                            "custom_contrasts": st.session_state.get("custom_contrasts"),
+                            "cache_dir": None,}
                         if "CEST" in selection:
                             st.session_state.submitted_data['cest_path'] = cest_path
                             st.session_state.submitted_data['cest_type'] = cest_type
+                            st.session_state.submitted_data['cest_power_paths'] = cest_power_paths
                             st.session_state.submitted_data['pixelwise'] = pixelwise
+                            st.session_state.submitted_data['pixel_engine'] = pixel_engine
+                            st.session_state.submitted_data['warm_start'] = warm_start
+                            st.session_state.submitted_data['full_fov'] = full_fov
+                            st.session_state.submitted_data['wassr_b0'] = wassr_b0
+                            st.session_state.submitted_data['quick_look'] = quick_look
+                            st.session_state.submitted_data['snr_triage'] = snr_triage
+                            st.session_state.submitted_data['single_precision'] = single_precision
+                            st.session_state.submitted_data['cache_dir'] = manager.get_cache_dir() if use_fit_cache else None
+                            st.session_state.submitted_data['coarse_triage'] = coarse_triage
                             st.session_state.submitted_data['smoothing_filter'] = smoothing_filter
                             st.session_state.submitted_data['moco_cest'] = moco_cest
                             st.session_state.submitted_data['pca'] = pca
@@ -438,6 +497,8 @@ def do_data_submission():
                             st.session_state.submitted_data['wassr_path'] = wassr_path
                             st.session_state.submitted_data['wassr_type'] = wassr_type
                             st.session_state.submitted_data['full_b0_mapping'] = full_b0_mapping
+                            st.session_state.submitted_data['wassr_algorithm'] = wassr_algorithm
+                            st.session_state.submitted_data['sparse_b0'] = sparse_b0
                             st.session_state.submitted_data['moco_wassr'] = moco_wassr
                         if "DAMB1" in selection:
                             st.session_state.submitted_data['theta_path'] = theta_path
@@ -446,6 +507,7 @@ def do_data_submission():
                             st.session_state.submitted_data['quesp_path'] = quesp_path
                             st.session_state.submitted_data['t1_path'] = t1_path
                             st.session_state.submitted_data['fixed_t1'] = fixed_t1_s
+                            st.session_state.submitted_data['full_t1_map'] = full_t1_map
                             st.session_state.submitted_data['quesp_denoise'] = quesp_denoise
                             st.session_state.submitted_data['quesp_type'] = quesp_type
                             st.session_state.submitted_data['fixed_fb'] = fixed_fb
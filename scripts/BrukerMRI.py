@@ -16,7 +16,7 @@ import numpy as np
 # ***********************************************************
 class BrukerData:
     """Class to store and process data of a Bruker MRI Experiment"""
-    def __init__(self, path="", ExpNum=0, B0=9.4):
+    def __init__(self, path="", ExpNum=0, B0=9.4, dtype=np.float64):
         self.method = {}
         self.acqp = {}
         self.reco = {}
@@ -34,7 +34,11 @@ class BrukerData:
         self.ConvFreqsFactor = 0 # reference to convert Hz <--> ppm
         self.path = path
         self.ExpNum = ExpNum
+        self.dtype = np.dtype(dtype) # real dtype for images, k-space uses the matching complex type
 
+    @property
+    def complex_dtype(self):
+        return np.result_type(self.dtype, np.complex64)
 
     def GenerateKspace(self):
         """Reorder the data in raw_fid to a valid k-space."""
@@ -211,7 +215,7 @@ class BrukerData:
         ToDelete = NTotalPoints - NPoints
         
         # Dynamically split data per receiver
-        KSpoke = np.empty((NPoints, NProj, NRec, NFrames), dtype='complex128')
+        KSpoke = np.empty((NPoints, NProj, NRec, NFrames), dtype=self.complex_dtype)
         
         for ch in range(NRec):
             Data_Ch = Data[NTotalPoints * ch:NTotalPoints * (ch + 1), :, :]
@@ -223,15 +227,18 @@ class BrukerData:
 # ***********************************************************
 #  Functions
 # ***********************************************************
-def ReadExperiment(path, ExpNum):
+def ReadExperiment(path, ExpNum, dtype=np.float64, split_slices=False):
     """Read in a Bruker MRI Experiment. Returns raw data, processed 
     data, and method and acqp parameters in a dictionary.
+    dtype (np.float64 or np.float32) sets the precision of images and k-space.
+    split_slices gives multi-slice processed data its own slice axis (see
+    ReadProcessedData).
 
     """
     path = str(path) # Change from Posix path, JWW
     if not path.endswith("/"):
         path = path + "/"
-    data = BrukerData(path, ExpNum)
+    data = BrukerData(path, ExpNum, dtype=dtype)
 
     exp_folder = os.path.join(path, str(ExpNum)) 
 
@@ -246,7 +253,7 @@ def ReadExperiment(path, ExpNum):
     # processed data
     d2seq_path = os.path.join(exp_folder, "pdata", "1", "2dseq")
     if os.path.exists(d2seq_path):
-        data.proc_data = ReadProcessedData(d2seq_path, data.reco, data.acqp)
+        data.proc_data = ReadProcessedData(d2seq_path, data.reco, data.acqp, data.dtype, split_slices)
     
     # raw trajectory
     traj_path = os.path.join(exp_folder, "trajDC")
@@ -256,7 +263,9 @@ def ReadExperiment(path, ExpNum):
     # generate complex FID if software version is <PV360
     if 'PV-360' not in data.acqp['ACQ_sw_version']:   
         raw_data = ReadRawData(path + str(ExpNum) + "/fid")
-        data.raw_fid = raw_data[0::2] + 1j * raw_data[1::2] 
+        data.raw_fid = np.empty(len(raw_data) // 2, dtype=data.complex_dtype)
+        data.raw_fid.real = raw_data[0::2]
+        data.raw_fid.imag = raw_data[1::2]
         
         # calculate GyroRatio and ConvFreqsFactor
         data.GyroRatio = data.acqp["SFO1"]*2*np.pi/data.B0*10**6 # in rad/Ts
@@ -346,20 +355,30 @@ def ReadRawData(filepath):
         return np.fromfile(f, dtype=np.int32)
 
 
-def ReadProcessedData(filepath, reco, acqp):
+def SliceCount(reco, acqp):
+    """Number of slices in the processed data: the third RECO_size entry
+    for 3D reconstructions, otherwise NSLICES for multi-slice 2D scans.
+    """
+    if len(reco["RECO_size"]) > 2:
+        return int(reco["RECO_size"][2])
+    return int(acqp.get("NSLICES", 1))
+
+
+def ReadProcessedData(filepath, reco, acqp, dtype=np.float64, split_slices=False):
+    """Read the 2dseq image file as (rows, cols, frames). With
+    split_slices, multi-slice and 3D data are returned as (rows, cols,
+    slices, frames) instead; slices are assumed to be the innermost frame
+    loop. Only the CEST/WASSR readers handle the slice axis.
+    """
     with open(filepath, "r") as f:
         data = np.fromfile(f, dtype=np.int16)
-        
-        data = data.reshape(reco["RECO_size"][0],
-                             reco["RECO_size"][1], -1, order="F")
-        if data.ndim == 3:
-            data_length = data.shape[2]
-        else:
-            data_length = 1
 
-        data_reshaped = np.zeros([data.shape[1], data.shape[0], data_length])
-        for i in range(0, data_length):
-            data_reshaped[:, :, i] = np.rot90(data[:, :, i])
+        n_slices = SliceCount(reco, acqp) if split_slices else 1
+        data = data.reshape(reco["RECO_size"][0],
+                            reco["RECO_size"][1], n_slices, -1, order="F")
+        data_reshaped = np.ascontiguousarray(np.rot90(data, axes=(0, 1)), dtype=dtype)
+        if n_slices == 1:
+            data_reshaped = data_reshaped[:, :, 0]
 
         return data_reshaped
 
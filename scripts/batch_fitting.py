@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 16 09:12:41 2026
+
+@author: jonah
+
+Batched Levenberg-Marquardt solver for fitting many spectra at once.
+"""
+import numpy as np
+from scripts import lorentzian_kernels
+
+# --- Solver constants (tunable) --- #
+LAMBDA_INIT = 1e-3
+LAMBDA_UP = 10.0
+LAMBDA_DOWN = 0.1
+LAMBDA_MAX = 1e10
+DIAG_FLOOR = 1e-12
+
+# --- Model definitions --- #
+def split_pools(params):
+    """
+    Splits a (n_spectra, 3 * n_pools) parameter array into amplitude, FWHM and center arrays.
+    Each output has shape (n_spectra, n_pools, 1) so it broadcasts against (n_spectra, 1, n_offsets).
+    """
+    pools = params.reshape(params.shape[0], -1, 3)
+    return pools[:, :, 0:1], pools[:, :, 1:2], pools[:, :, 2:3]
+
+def multi_lorentzian(x, params):
+    """
+    Evaluates a sum of Lorentzians for a batch of spectra.
+    x is (n_spectra, n_offsets) and params is (n_spectra, 3 * n_pools).
+    """
+    if lorentzian_kernels.enabled():
+        return lorentzian_kernels.lorentzian_sum(x, params)
+    amp, fwhm, center = split_pools(params)
+    q = 0.25 * fwhm ** 2
+    d = x[:, np.newaxis, :] - center
+    return np.sum(amp * q / (q + d ** 2), axis=1)
+
+def multi_lorentzian_jac(x, params):
+    """
+    Analytic Jacobian of multi_lorentzian with respect to its parameters.
+    Returns an array of shape (n_spectra, n_offsets, 3 * n_pools).
+    """
+    if lorentzian_kernels.enabled():
+        return lorentzian_kernels.lorentzian_jac(x, params)
+    amp, fwhm, center = split_pools(params)
+    q = 0.25 * fwhm ** 2
+    d = x[:, np.newaxis, :] - center
+    den = q + d ** 2
+    d_amp = q / den
+    d_fwhm = amp * 0.5 * fwhm * d ** 2 / den ** 2
+    d_center = amp * 2 * q * d / den ** 2
+    jac = np.stack([d_amp, d_fwhm, d_center], axis=2)
+    return jac.reshape(x.shape[0], -1, x.shape[1]).transpose(0, 2, 1)
+
+# --- Solver --- #
+def levenberg_marquardt(model, jacobian, x, y, p0, lb, ub, weights=None, max_iter=50, ftol=1e-4, xtol=1e-10):
+    """
+    Fits model(x, params) to y for every row at once with a projected Levenberg-Marquardt scheme.
+    Each spectrum carries its own damping factor and drops out of the active set once converged.
+    Returns the fitted parameters, final cost, convergence flags and iterations used per spectrum.
+    """
+    n_spectra = y.shape[0]
+    params = np.array(np.broadcast_to(p0, (n_spectra, len(lb))), dtype=float)
+    lb = np.asarray(lb, dtype=float)
+    ub = np.asarray(ub, dtype=float)
+    params = np.clip(params, lb, ub)
+    if weights is None:
+        weights = np.ones_like(y, dtype=float)
+    lam = np.full(n_spectra, LAMBDA_INIT)
+    converged = np.zeros(n_spectra, dtype=bool)
+    n_iter = np.zeros(n_spectra, dtype=int)
+    residuals = weights * (model(x, params) - y)
+    cost = np.sum(residuals ** 2, axis=1)
+    active = np.flatnonzero(np.isfinite(cost))
+    for _ in range(max_iter):
+        if active.size == 0:
+            break
+        x_a, y_a, w_a, p_a = x[active], y[active], weights[active], params[active]
+        jac = w_a[:, :, np.newaxis] * jacobian(x_a, p_a)
+        res = w_a * (model(x_a, p_a) - y_a)
+        jtj = np.einsum('nmk,nml->nkl', jac, jac)
+        grad = np.einsum('nmk,nm->nk', jac, res)
+        # Freeze parameters sitting on a bound when the descent direction points outside it
+        blocked = ((p_a <= lb) & (grad > 0)) | ((p_a >= ub) & (grad < 0))
+        free = (~blocked).astype(float)
+        jtj = jtj * free[:, :, np.newaxis] * free[:, np.newaxis, :]
+        grad = grad * free
+        diag = np.maximum(np.diagonal(jtj, axis1=1, axis2=2), DIAG_FLOOR)
+        damped = jtj + lam[active, np.newaxis, np.newaxis] * (diag[:, :, np.newaxis] * np.eye(p_a.shape[1]))
+        step = np.linalg.solve(damped, -grad[:, :, np.newaxis])[:, :, 0]
+        candidate = np.clip(p_a + step, lb, ub)
+        new_cost = np.sum((w_a * (model(x_a, candidate) - y_a)) ** 2, axis=1)
+        n_iter[active] += 1
+        improved = np.isfinite(new_cost) & (new_cost < cost[active])
+        accepted = active[improved]
+        old_cost = cost[accepted]
+        actual_step = candidate[improved] - p_a[improved]
+        params[accepted] = candidate[improved]
+        cost[accepted] = new_cost[improved]
+        lam[accepted] = np.maximum(lam[accepted] * LAMBDA_DOWN, 1e-12)
+        lam[active[~improved]] *= LAMBDA_UP
+        # Same stopping rules as curve_fit: small relative cost reduction or small step
+        small_cost = (old_cost - new_cost[improved]) <= ftol * old_cost
+        small_step = np.linalg.norm(actual_step, axis=1) <= xtol * (xtol + np.linalg.norm(params[accepted], axis=1))
+        converged[accepted[small_cost | small_step]] = True
+        # A spectrum that cannot improve at any damping is already at its minimum
+        stalled = active[~improved][lam[active[~improved]] > LAMBDA_MAX]
+        converged[stalled] = True
+        active = active[~converged[active]]
+    return params, cost, converged, n_iter
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 16 14:37:52 2026
+
+@author: jonah
+
+Benchmarks for the two-step Lorentzian fit on synthetic Z-spectra.
+Run from the Pre-CAT directory with: python -m scripts.benchmark_fitting
+"""
+import time
+from dataclasses import replace
+import numpy as np
+from sklearn.decomposition import PCA
+from scripts import lorentzian_fitting, lorentzian_kernels
+
+# --- Synthetic data --- #
+def synthetic_spectra(n_spectra=100, noise=0.005, seed=0):
+    """
+    Generates cardiac-like Z-spectra with random B0 shifts on a typical offset list.
+    """
+    rng = np.random.default_rng(seed)
+    offsets = np.unique(np.concatenate([np.linspace(-10, 10, 41), np.linspace(-5, 5, 41)]))[::-1]
+    pools = [(0.85, 1.5, 0), (0.12, 45, -1), (0.04, 1.2, -3.5), (0.03, 0.8, 2.0), (0.03, 2.0, 3.5), (0.02, 1.0, -1.6)]
+    spectra = np.ones((n_spectra, len(offsets)))
+    b0_shifts = rng.normal(0, 0.2, n_spectra)
+    for i in range(n_spectra):
+        for amp, fwhm, center in pools:
+            spectra[i] -= lorentzian_fitting.lorentzian(offsets - b0_shifts[i], amp, fwhm, center)
+    spectra += rng.normal(0, noise, spectra.shape)
+    return offsets, spectra
+
+# --- Benchmarks --- #
+def count_model_evaluations(func, *args):
+    """
+    Runs func while counting Lorentzian evaluations and returns (result, count, seconds).
+    The compiled kernels bypass lorentzian, so they are switched off while counting.
+    """
+    original, use_numba = lorentzian_fitting.lorentzian, lorentzian_kernels.use_numba
+    counter = [0]
+    def counted(*lorentzian_args):
+        counter[0] += 1
+        return original(*lorentzian_args)
+    lorentzian_fitting.lorentzian = counted
+    lorentzian_kernels.use_numba = False
+    try:
+        start = time.perf_counter()
+        result = func(*args)
+        duration = time.perf_counter() - start
+    finally:
+        lorentzian_fitting.lorentzian = original
+        lorentzian_kernels.use_numba = use_numba
+    return result, counter[0], duration
+
+def benchmark_jacobians(offsets, spectra, custom_contrasts=None):
+    """
+    Compares finite-difference and analytic Jacobians in two_step.
+    """
+    results = {}
+    for label, analytic in [('Finite differences', False), ('Analytic', True)]:
+        config = replace(lorentzian_fitting.default_config, use_analytic_jac=analytic)
+        fits, n_evals, duration = count_model_evaluations(
+            lambda: [lorentzian_fitting.two_step(spectrum, offsets, custom_contrasts, config=config) for spectrum in spectra])
+        results[label] = {
+            'Lorentzian evaluations / spectrum': n_evals / len(spectra),
+            'ms / spectrum': 1e3 * duration / len(spectra),
+            'Failed fits': sum(np.isinf(fit['RMSE']) for fit in fits),
+        }
+    return results
+
+def benchmark_warm_start(offsets, spectra, custom_contrasts=None):
+    """
+    Compares cold starts with ROI + neighbour warm starts on spectra laid out as a square image.
+    'Iterations' counts curve_fit function evaluations for the serial runs and LM iterations for the batched runs.
+    """
+    side = int(np.sqrt(len(spectra)))
+    spectra = spectra[:side * side]
+    coords = np.argwhere(np.ones((side, side), dtype=bool))
+    roi_seed = lorentzian_fitting.seed_from_fit(lorentzian_fitting.two_step(np.mean(spectra, axis=0), offsets, custom_contrasts))
+    runs = {
+        'Cold start': lambda: lorentzian_fitting.fit_pixel_sequence(spectra, offsets, custom_contrasts),
+        'Warm start': lambda: lorentzian_fitting.fit_pixel_sequence(spectra, offsets, custom_contrasts, coords, [roi_seed] * len(spectra)),
+        'Batched cold': lambda: lorentzian_fitting.two_step_batch(spectra, offsets, custom_contrasts),
+        'Batched warm': lambda: lorentzian_fitting.two_step_batch(
+            spectra, offsets, custom_contrasts, lorentzian_fitting.stack_seeds([roi_seed] * len(spectra), custom_contrasts)),
+    }
+    results = {}
+    for label, run in runs.items():
+        start = time.perf_counter()
+        fits = run()
+        duration = time.perf_counter() - start
+        unit = 'LM iterations' if label.startswith('Batched') else 'curve_fit evaluations'
+        results[label] = {
+            f'{unit} / spectrum': np.nanmean([fit['Iterations'] for fit in fits]),
+            'ms / spectrum': 1e3 * duration / len(spectra),
+            'Failed fits': sum(np.isinf(fit['RMSE']) for fit in fits),
+        }
+    return results
+
+def benchmark_nnls_init(offsets, spectra, custom_contrasts=None):
+    """
+    Compares fixed step 2 starting points with the NNLS initializer for cold-started serial fits
+    (the batched engine always starts from the fixed p0).
+    """
+    results = {}
+    for label, use_nnls in [('Fixed p0', False), ('NNLS', True)]:
+        config = replace(lorentzian_fitting.default_config, use_nnls_init=use_nnls)
+        start = time.perf_counter()
+        fits = [lorentzian_fitting.two_step(spectrum, offsets, custom_contrasts, config=config) for spectrum in spectra]
+        duration = time.perf_counter() - start
+        results[label] = {
+            'Evaluations / spectrum': np.nanmean([fit['Iterations'] for fit in fits]),
+            'ms / spectrum': 1e3 * duration / len(spectra),
+            'Failed fits': sum(np.isinf(fit['RMSE']) for fit in fits),
+            'Mean RMSE': np.mean([fit['RMSE'] for fit in fits if np.isfinite(fit['RMSE'])]),
+        }
+    return results
+
+def benchmark_precision(offsets, spectra, custom_contrasts=None, n_components=6):
+    """
+    Validation report for the float32 data path. The same spectra are PCA denoised and fit after
+    storing them in double and in single precision, and the final contrasts are compared.
+    """
+    results = {}
+    denoised = {}
+    for label, dtype in [('float64', np.float64), ('float32', np.float32)]:
+        data = spectra.astype(dtype)
+        start = time.perf_counter()
+        # Same centering as pre_processing.denoise_data
+        mean_spectrum = np.mean(data, axis=0, dtype=np.float64).astype(dtype)
+        pca = PCA(n_components=n_components)
+        denoised[label] = pca.inverse_transform(pca.fit_transform(data - mean_spectrum)) + mean_spectrum
+        duration = time.perf_counter() - start
+        results[f"PCA {label}"] = {'ms': 1e3 * duration, 'MB': data.nbytes / 1024 ** 2}
+    fits = {label: lorentzian_fitting.two_step_batch(values, offsets, custom_contrasts, compact=True)
+            for label, values in denoised.items()}
+    contrasts = {label: lorentzian_fitting.compact_contrasts(fit) for label, fit in fits.items()}
+    ok = np.isfinite(fits['float64']['RMSE']) & np.isfinite(fits['float32']['RMSE'])
+    for name in contrasts['float64']:
+        difference = np.abs(contrasts['float64'][name] - contrasts['float32'][name])[ok]
+        results[name] = {'Median |diff| (%)': np.median(difference), '99th pct |diff| (%)': np.percentile(difference, 99),
+                         'Spectra > 0.1%': np.sum(difference > 0.1), 'Mean contrast (%)': np.mean(contrasts['float64'][name][ok])}
+    results['Fits'] = {'Failed float64': np.sum(~np.isfinite(fits['float64']['RMSE'])),
+                       'Failed float32': np.sum(~np.isfinite(fits['float32']['RMSE']))}
+    return results
+
+def benchmark_kernels(offsets, spectra, custom_contrasts=None, n_serial=100):
+    """
+    Compares the NumPy model code with the Numba kernels for serial and batched fits.
+    Differences are reported against the NumPy fits; the kernels should reproduce them exactly.
+    """
+    if lorentzian_kernels.numba is None:
+        return {'Numba': {'Installed': 0}}
+    use_numba = lorentzian_kernels.use_numba
+    timings, fits = {}, {}
+    try:
+        for label, flag in [('NumPy', False), ('Numba', True)]:
+            lorentzian_kernels.use_numba = flag
+            # Warm-up call so compilation is not timed
+            lorentzian_fitting.two_step_batch(spectra[:2], offsets, custom_contrasts, compact=True)
+            start = time.perf_counter()
+            serial = [lorentzian_fitting.two_step(spectrum, offsets, custom_contrasts) for spectrum in spectra[:n_serial]]
+            serial_time = time.perf_counter() - start
+            start = time.perf_counter()
+            batch = lorentzian_fitting.two_step_batch(spectra, offsets, custom_contrasts, compact=True)
+            batch_time = time.perf_counter() - start
+            timings[label] = (serial_time, batch_time)
+            fits[label] = (np.array([np.concatenate(fit['Fit_Params']) for fit in serial]),
+                           np.hstack([batch['Fit_Params_1'], batch['Fit_Params_2']]), batch['RMSE'])
+    finally:
+        lorentzian_kernels.use_numba = use_numba
+    results = {}
+    for label, (serial_time, batch_time) in timings.items():
+        results[label] = {'Serial ms / spectrum': 1e3 * serial_time / n_serial,
+                          'Batched ms / spectrum': 1e3 * batch_time / len(spectra)}
+    finite = np.isfinite(fits['NumPy'][2])
+    results['Max |diff|'] = {'Serial params': np.max(np.abs(fits['Numba'][0] - fits['NumPy'][0])),
+                             'Batched params': np.max(np.abs(fits['Numba'][1] - fits['NumPy'][1])),
+                             'Batched RMSE': np.max(np.abs(fits['Numba'][2][finite] - fits['NumPy'][2][finite]))}
+    return results
+
+def print_results(title, results):
+    print(f"\n{title}")
+    for label, stats in results.items():
+        print(f"  {label:<20}" + "  ".join(f"{key}: {value:.4g}" for key, value in stats.items()))
+
+if __name__ == '__main__':
+    offsets, spectra = synthetic_spectra()
+    print_results("Jacobians (two_step)", benchmark_jacobians(offsets, spectra))
+    print_results("Warm starts", benchmark_warm_start(offsets, spectra))
+    print_results("Step 2 initializer", benchmark_nnls_init(offsets, spectra))
+    print_results("Numba kernels", benchmark_kernels(*synthetic_spectra(n_spectra=2000)))
+    print_results("Single precision", benchmark_precision(*synthetic_spectra(n_spectra=16384)))
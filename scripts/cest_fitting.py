@@ -5,107 +5,63 @@ Created on Tue Feb  6 11:08:05 2024
 
 @author: jonah
 """
+import os
+import queue
+import itertools
+import multiprocessing
+from contextlib import nullcontext
+from dataclasses import replace
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import streamlit as st
 import numpy as np
-from sklearn.metrics import mean_squared_error
-from scipy.optimize import curve_fit
+from scipy import ndimage
 from scipy.interpolate import CubicSpline
+from custom import st_functions
 from custom.st_functions import time_it
+from scripts import lorentzian_fitting, quick_look, batch_fitting
+from scripts.lorentzian_fitting import (batch_step_1_fit, batch_step_1_jac,
+                                        default_config, default_contrasts, two_step, two_step_batch,
+                                        failed_fit, seed_from_fit, stack_seeds, fit_pixel_sequence,
+                                        compact_fits, concat_compact, failed_compact, merge_compact, fit_b0_shift)
+# Fitting parameters and models that used to live here, re-exported for existing callers
+from scripts.lorentzian_fitting import (lorentzian, step_1_fit, water_fit_correction, step_2_fit,
+                                        contrast_bounds, fit_regions, package_fit, cutoffs, options, contrast_params,
+                                        p0_corr, lb_corr, ub_corr, p0_corr_ph, lb_corr_ph, ub_corr_ph,
+                                        p0_water, p0_mt, p0_noe, p0_noe_neg_1_6, p0_creatine, p0_amide, p0_amine, p0_hydroxyl, p0_salicylic,
+                                        lb_water, lb_mt, lb_noe, lb_noe_neg_1_6, lb_creatine, lb_amide, lb_amine, lb_hydroxyl, lb_salicylic,
+                                        ub_water, ub_mt, ub_noe, ub_noe_neg_1_6, ub_creatine, ub_amide, ub_amine, ub_hydroxyl, ub_salicylic,
+                                        p0_1, lb_1, ub_1, p0_2, lb_2, ub_2, p0_ph, lb_ph, ub_ph)
+from scripts.pixel_results import PixelFitResult
+from scripts.fit_cache import cache_key
 
-# --- Curve fitting parameters. Feel free to modify, results not guaranteed. --- #
-###Pre-correction###
-##Starting points for curve fitting: amplitude, FWHM, peak center##
-p0_water = [0.8, 1.8, 0]
-p0_mt = [0.15, 40, -1]
-##Lower bounds for curve fitting##
-lb_water = [0.02, 0.3, -10]
-lb_mt = [0.0, 30, -2.5]
-##Upper bounds for curve fitting##
-ub_water = [1, 10, 10]
-ub_mt = [0.5, 60, 0]
-
-##Combine for curve fitting##
-#B0 correction (tissue)
-p0_corr = p0_water + p0_mt
-lb_corr = lb_water + lb_mt
-ub_corr = ub_water + ub_mt 
-#B0 correction (phantom)
-p0_corr_ph = p0_water
-lb_corr_ph = lb_water
-ub_corr_ph = ub_water
-
-###Post-correction###
-##Starting points for curve fitting: amplitude, FWHM, peak center##
-p0_water = [0.8, 0.2, 0]
-p0_mt = [0.15, 40, -1]
-p0_noe = [0.05, 1, -3.50]
-p0_noe_neg_1_6 = [0.05, 1, -1.6]
-p0_creatine = [0.05, 0.5, 2.0]
-p0_amide = [0.05, 1.5, 3.5]
-p0_amine = [0.05, 1.5, 2.5]
-p0_hydroxyl = [0.05, 1.5, 0.6]
-p0_salicylic = [0.05, 1.5, 9.3]
-##Lower bounds for curve fitting##
-lb_water = [0.02, 0.01, -1e-6]
-lb_mt = [0.0, 30, -2.5]
-lb_noe = [0.0, 0.5, -4.0]
-lb_noe_neg_1_6 = [0.0, 0.5, -1.8]
-lb_creatine = [0.0, 0.5, 1.6]
-lb_amide = [0.0, 0.5, 3.2]
-lb_amine = [0.0, 0.1, 2.2]
-lb_hydroxyl = [0.0, 0.1, 0.4]
-lb_salicylic = [0.0, 0.5, 8.0]
-##Upper bounds for curve fitting##
-ub_water = [1, 10, 1e-6]
-ub_mt = [0.5, 60, 0]
-ub_noe = [0.25, 5, -1.5]
-ub_noe_neg_1_6 = [.25, 5, -1.2]
-ub_creatine = [0.5, 5, 2.6]
-ub_amide = [0.3, 5, 4.0]
-ub_amine = [0.3, 5, 2.8]
-ub_hydroxyl = [0.3, 5, 1.2]
-ub_salicylic = [0.3, 5, 10.0]
-
-##Combine for curve fitting##
-#Step 1
-p0_1 = p0_water + p0_mt
-lb_1 = lb_water + lb_mt
-ub_1 = ub_water + ub_mt 
-#Step 2 (cardiac)
-p0_2 = p0_noe + p0_creatine + p0_amide
-lb_2 = lb_noe + lb_creatine + lb_amide
-ub_2 = ub_noe + ub_creatine + ub_amide
-#Single step (Cr phantom)
-p0_ph = p0_water + p0_creatine
-lb_ph = lb_water + lb_creatine
-ub_ph = ub_water + ub_creatine
-
-###Cutoffs and options for fitting###
-cutoffs = [-4, -1.4, 1.4, 4]
-options = {'xtol': 1e-10, 'ftol': 1e-4, 'maxfev': 50}
-
-
-# --- Model definitions --- #
-def lorentzian(x, amp, fwhm, offset):
-    num = amp * 0.25 * fwhm ** 2
-    den = 0.25 * fwhm ** 2 + (x - offset) ** 2
-    return num / den
-
-def step_1_fit(x, *fit_parameters):
-    water_fit = lorentzian(x, fit_parameters[0], fit_parameters[1], fit_parameters[2])
-    mt_fit = lorentzian(x, fit_parameters[3], fit_parameters[4], fit_parameters[5])
-    fit = 1 - water_fit - mt_fit
-    return fit
-
-def water_fit_correction(x, *fit_parameters):
-    water_fit = lorentzian(x, fit_parameters[0], fit_parameters[1], fit_parameters[2])
-    fit = 1 - water_fit
-    return fit
+# --- Pixelwise execution options --- #
+pixel_batch_size = 1024 # Spectra per block for the batched engine
+max_workers = None # Worker processes for the parallel engine, None uses all cores
+worker_start_method = 'spawn' # Fresh worker interpreters; forking the multithreaded Streamlit server can copy held locks
+chunks_per_worker = 4 # Smaller chunks balance load between workers
+warm_start_diagnostics = False # Refit a cold-started sample of each label to log the optimizer work saved by warm starts
+warm_start_sample = 20 # Pixels per label refit from cold starts for warm_start_diagnostics
+fov_tile_size = 64 # Tile edge (pixels) for full field-of-view fitting
+fov_intensity_threshold = 0.05 # Fraction of the 99th percentile M0 intensity
+fov_min_snr = 5 # Minimum M0 SNR for a pixel to be fit
+triage_min_snr = 10 # Pixels below this SNR are not fit
+triage_coarse_snr = 20 # Pixels below this SNR only get a coarse fit (when enabled)
+triage_coarse_maxfev = 15 # Optimizer evaluations per step for coarse fits
+triage_reference_ppm = 6 # Offsets at least this far from water are used for the Z-spectrum SNR
+
+# --- WASSR options --- #
+wassr_n_interp = 1000 # Spline samples across the offset range
+wassr_polish = True # Refine the spline minimum with a batched water + MT fit
+wassr_intensity_threshold = 0.05 # Fraction of the maximum image intensity for full B0 maps
+wassr_sample_stride = 4 # Sparse B0 maps fit every n-th foreground pixel along each image axis
+wassr_field_order = 3 # Total degree of the 2D polynomial B0 field model for sparse B0 maps
+wassr_outlier_mad = 5 # Samples further than this many median absolute deviations from the field are refit without
 
 # --- CEST fitting functions --- #
 def calc_spectra(imgs, user_geometry):
     """
     Calculates the mean spectrum for each ROI based on user defined geometry.
+    Means are accumulated in double precision, also for float32 image stacks.
     """
     spectra = {}
     if user_geometry['aha']:
@@ -116,18 +72,19 @@ def calc_spectra(imgs, user_geometry):
             for y, x in segment_coords:
                 segment_mask[y, x] = True
             pixels = imgs[segment_mask, :]
-            spectra[label] = np.mean(pixels, axis=0)
+            spectra[label] = np.mean(pixels, axis=0, dtype=np.float64)
     else:
         # Standard ROI logic
         masks = user_geometry['masks']
         for label, mask in masks.items():
             pixels = imgs[mask, :]
-            spectra[label] = np.mean(pixels, axis=0)
+            spectra[label] = np.mean(pixels, axis=0, dtype=np.float64)
     return spectra
 
 def calc_spectra_pixelwise(imgs, user_geometry):
     """
     Calculates the spectrum for each individual pixel within the given masks.
+    Spectra keep the image precision; the fits convert each block to double precision.
     """
     spectra_by_label = {}
     masks = user_geometry['masks']
@@ -144,129 +101,587 @@ def calc_spectra_pixelwise(imgs, user_geometry):
             spectra_by_label[label] = pixel_spectra
     return spectra_by_label
 
-def two_step(spectrum, offsets, custom_contrasts = None):
+def pixel_coords(user_geometry):
     """
-    Performs the two-step Lorentzian fitting on a single spectrum.
-    This is the core fitting logic.
+    Pixel coordinates for each label, in the same order as calc_spectra_pixelwise.
     """
-    n_interp = 4000
-    if custom_contrasts is None:
-        custom_contrasts = ['Amide', 'Creatine', 'NOE (-3.5 ppm)', 'NOE (-1.6 ppm)']
-    contrast_params = {
-        'NOE (-3.5 ppm)': (p0_noe, lb_noe, ub_noe),
-        'Creatine': (p0_creatine, lb_creatine, ub_creatine),
-        'Amide': (p0_amide, lb_amide, ub_amide),
-        'Amine': (p0_amine, lb_amine, ub_amine),
-        'Hydroxyl': (p0_hydroxyl, lb_hydroxyl, ub_hydroxyl),
-        'NOE (-1.6 ppm)': (p0_noe_neg_1_6, lb_noe_neg_1_6, ub_noe_neg_1_6),
-        'Salicylic acid': (p0_salicylic, lb_salicylic, ub_salicylic)
-    }
-    p0_2, lb_2, ub_2 = [], [], []
-    for contrast in custom_contrasts:
-        p0_2 += contrast_params[contrast][0]
-        lb_2 += contrast_params[contrast][1]
-        ub_2 += contrast_params[contrast][2]
-    def step_2_fit(x, *params):
-        fit_sum = np.zeros_like(x)
-        index = 0
-        for contrast in custom_contrasts:
-            fit_sum += lorentzian(x, params[index], params[index + 1], params[index + 2])
-            index += 3
-        return fit_sum
-    try:
-        if offsets[0] > 0:
-            offsets = np.flip(offsets)
-            spectrum = np.flip(spectrum)
-        fit_1, _ = curve_fit(step_1_fit, offsets, spectrum, p0=p0_corr, bounds=(lb_corr, ub_corr), **options)
-        correction = fit_1[2]
-        offsets_corrected = offsets - correction
-        if 'Hydroxyl' in custom_contrasts:
-            cutoffs[2] = 0.4
-        else:
-            cutoffs[2] = 1.4
-        condition = (offsets_corrected <= cutoffs[0]) | (offsets_corrected >= cutoffs[3]) | \
-                    ((offsets_corrected >= cutoffs[1]) & (offsets_corrected <= cutoffs[2]))
-        condition_rmse = ((offsets_corrected <= -1.4) & (offsets_corrected >= -4)) | \
-                         ((offsets_corrected >= 1.4) & (offsets_corrected <= 4))
-        offsets_cropped = offsets_corrected[condition]
-        spectrum_cropped = spectrum[condition]
-        if len(offsets_cropped) == 0:  # Handle empty offsets case
-            raise RuntimeError("No valid offsets found after cropping")
-        offsets_interp = np.linspace(offsets_corrected[0], offsets_corrected[-1], n_interp)
-        fit_1, _ = curve_fit(step_1_fit, offsets_cropped, spectrum_cropped, p0=p0_1, bounds=(lb_1, ub_1), **options)
-        water_fit = lorentzian(offsets_interp, fit_1[0], fit_1[1], fit_1[2])
-        mt_fit = lorentzian(offsets_interp, fit_1[3], fit_1[4], fit_1[5])
-        background = lorentzian(offsets_corrected, fit_1[0], fit_1[1], fit_1[2]) + \
-                     lorentzian(offsets_corrected, fit_1[3], fit_1[4], fit_1[5])
-        lorentzian_difference = 1 - (spectrum + background)
-        step_1_fit_values = step_1_fit(offsets_corrected, *fit_1)
-        step_1_rmse = np.sqrt(mean_squared_error(spectrum, step_1_fit_values))
-        fit_2, _ = curve_fit(step_2_fit, offsets_corrected, lorentzian_difference, p0=p0_2, bounds=(lb_2, ub_2), **options)
-        fit_curves = {}
-        index = 0
-        for contrast in custom_contrasts:
-            fit_curves[contrast] = lorentzian(offsets_interp, fit_2[index], fit_2[index + 1], fit_2[index + 2])
-            index += 3
-        step_2_fit_values = step_2_fit(offsets_corrected, *fit_2)
-        step_2_rmse = np.sqrt(mean_squared_error(lorentzian_difference, step_2_fit_values))
-        total_fit = step_1_fit_values - step_2_fit_values
-        spectrum_region = spectrum[condition_rmse]
-        total_fit_region = total_fit[condition_rmse]
-        rmse = np.sqrt(mean_squared_error(spectrum_region, total_fit_region))
-        offsets_interp = np.flip(offsets_interp)
-        water_fit = np.flip(water_fit)
-        mt_fit = np.flip(mt_fit)
-        fit_curves_named = {f"{contrast}_Fit": np.flip(fit_curves[contrast]) for contrast in fit_curves}
-        contrasts = {'Water': 100 * fit_1[0], 'MT': 100 * fit_1[3]}
-        for i, contrast in enumerate(custom_contrasts):
-            contrasts[contrast] = 100 * fit_2[i * 3]
-        data_dict = {'Zspec': spectrum, 'Offsets': offsets, 'Offsets_Corrected': offsets_corrected,
-                     'Offsets_Interp': offsets_interp, 'Water_Fit': water_fit, 'MT_Fit': mt_fit,
-                     **fit_curves_named, 'Lorentzian_Difference': lorentzian_difference}
-        fit_parameters = [fit_1, fit_2]
-    except RuntimeError:
-        # Assign zeros instead of crashing
-        fit_parameters = [np.zeros(len(p0_1)), np.zeros(len(p0_2))]
-        contrasts = {key: 0 for key in ['Water', 'MT'] + custom_contrasts}
-        data_dict = {'Zspec': spectrum, 'Offsets': offsets, 'Offsets_Corrected': np.zeros_like(offsets),
-                     'Offsets_Interp': np.zeros(n_interp), 'Water_Fit': np.zeros(n_interp), 'MT_Fit': np.zeros(n_interp),
-                     'Lorentzian_Difference': np.zeros(n_interp), **{f"{contrast}_Fit": np.zeros(n_interp) for contrast in custom_contrasts}}
-        spectrum_region = np.array([])
-        total_fit_region = np.array([])
-        rmse = np.inf
-    return {'Fit_Params': fit_parameters, 'Data_Dict': data_dict,
-            'Contrasts': contrasts, 'Residuals': spectrum_region - total_fit_region, 'RMSE': rmse}
+    masks = user_geometry['masks']
+    if user_geometry['aha']:
+        return {'lv': np.argwhere(masks['lv'])}
+    return {label: np.argwhere(mask) for label, mask in masks.items()}
+
+def collect_pixel_fits(pixel_fits, user_geometry):
+    """
+    Gathers compact fit_all_pixels output into a single PixelFitResult.
+    """
+    coords = pixel_coords(user_geometry)
+    shape = next(iter(user_geometry['masks'].values())).shape
+    return PixelFitResult.from_compact(pixel_fits, coords, shape)
+
+def cached_two_step(spectrum, offsets, custom_contrasts, b0_shift=None, config=default_config, cache=None):
+    """
+    two_step, reusing a previous result for identical inputs when a FitCache is given.
+    """
+    if cache is None:
+        return two_step(spectrum, offsets, custom_contrasts, b0_shift=b0_shift, config=config)
+    key = cache_key('two_step', spectrum, offsets, custom_contrasts, b0_shift, config)
+    return cache.get_or_compute(key, lambda: two_step(spectrum, offsets, custom_contrasts, b0_shift=b0_shift, config=config))
 
 @time_it
-def fit_all_rois(spectra_by_roi, offsets, custom_contrasts):
+def fit_all_rois(spectra_by_roi, offsets, custom_contrasts, b0_shifts=None, config=default_config, cache=None):
     """
     Iterates through all ROIs and applies the two-step fit.
+    b0_shifts (from roi_b0_shifts) replaces the B0 pre-fit per ROI.
+    config is the lorentzian_fitting.FitConfig used for every fit.
+    cache is an optional fit_cache.FitCache consulted before fitting.
     """
     fits = {}
     for roi, spectrum in spectra_by_roi.items():
-        fits[roi] = two_step(spectrum, offsets, custom_contrasts)
+        b0_shift = b0_shifts.get(roi) if b0_shifts else None
+        fits[roi] = cached_two_step(spectrum, offsets, custom_contrasts, b0_shift, config, cache)
     return fits
 
 @time_it
-def fit_all_pixels(spectra_by_pixel, offsets, custom_contrasts):
+def refit_all_contrasts(roi_fits, pixel_fits, custom_contrasts, config=default_config):
+    """
+    Refits ROI fits and (optionally) a PixelFitResult for a new contrast selection.
+    Only step 2 is rerun unless the Hydroxyl cutoff changes. Pixels excluded by SNR triage stay excluded.
+    """
+    roi_fits = {roi: lorentzian_fitting.refit_contrasts(fit, custom_contrasts, config) for roi, fit in roi_fits.items()}
+    if pixel_fits is not None:
+        excluded = triage_classes(pixel_fits.snr) == 0 if pixel_fits.snr is not None else None
+        pixel_fits = pixel_fits.refit_contrasts(custom_contrasts, config, excluded)
+    return roi_fits, pixel_fits
+
+# --- Saturation power series (multi-B1) --- #
+@time_it
+def fit_all_powers(spectra_by_power, offsets, reference_fits, custom_contrasts, config=default_config, cache=None):
+    """
+    Fits the ROI spectra of additional saturation powers in one batched solve.
+    spectra_by_power is a list of calc_spectra outputs acquired on the same offsets and ROIs as reference_fits
+    (the fit_all_rois output of the main CEST scan). Every power reuses the reference B0 correction of its ROI;
+    water, MT and the contrasts are fit per power since their widths and amplitudes change with B1.
+    Returns a list of {roi: fit} dictionaries in the order of spectra_by_power.
+    """
+    rois = list(reference_fits)
+    spectra = np.array([spectra_by_roi[roi] for spectra_by_roi in spectra_by_power for roi in rois], dtype=np.float64)
+    b0_shifts = np.tile([fit_b0_shift(reference_fits[roi]) for roi in rois], len(spectra_by_power))
+    def run():
+        return two_step_batch(spectra, offsets, custom_contrasts, b0_shifts=b0_shifts, config=config)
+    fits = run() if cache is None else cache.get_or_compute(cache_key('powers', spectra, offsets, custom_contrasts, b0_shifts, config), run)
+    n_rois = len(rois)
+    return [dict(zip(rois, fits[i * n_rois:(i + 1) * n_rois])) for i in range(len(spectra_by_power))]
+
+@time_it
+def fit_power_pixels(pixel_fits, power_imgs, offsets, custom_contrasts, config=default_config, cache=None):
+    """
+    Pixelwise fits of additional saturation powers on the pixels of pixel_fits (PixelFitResult of the main scan).
+    Every pixel reuses the B0 correction of its main scan fit; pixels whose main fit failed get their own B0 pre-fit.
+    power_imgs is a list of (rows, cols, offsets) stacks. Returns a matching list of PixelFitResults.
+    """
+    b0_shifts = np.where(pixel_fits.converged, pixel_fits.correction, np.nan)
+    results = []
+    for imgs in power_imgs:
+        spectra = imgs[pixel_fits.coords[:, 0], pixel_fits.coords[:, 1], :]
+        args = (spectra, offsets, custom_contrasts, 'batched', None, None, b0_shifts, config, pixel_batch_size)
+        def run():
+            return lorentzian_fitting.fit_slice(*args)
+        compact = run() if cache is None else cache.get_or_compute(cache_key('slice', *args), run)
+        results.append(pixel_fits.with_fits(compact))
+    return results
+
+@time_it
+def refit_all_powers(power_fits, custom_contrasts, config=default_config):
+    """
+    Refits every saturation power of a fit_all_powers result ({label: {roi: fit}}) for a new contrast selection.
+    """
+    return {label: {roi: lorentzian_fitting.refit_contrasts(fit, custom_contrasts, config) for roi, fit in roi_fits.items()}
+            for label, roi_fits in power_fits.items()}
+
+# --- External B0 (WASSR) maps --- #
+def wassr_b0_map(wassr_fits, user_geometry, shape, wassr_full_map=None):
+    """
+    Assembles a 2D B0 map (ppm, NaN where unknown) from fit_wassr_full or fit_wassr_masked output.
+    """
+    if wassr_full_map is not None:
+        return np.asarray(wassr_full_map, dtype=float)
+    b0_map = np.full(shape, np.nan)
+    if user_geometry['aha']:
+        coords_by_label = {label: np.asarray(coords).reshape(-1, 2) for label, coords in user_geometry['aha'].items()}
+    else:
+        coords_by_label = {label: np.argwhere(mask) for label, mask in user_geometry['masks'].items()}
+    for label, coords in coords_by_label.items():
+        values = np.asarray(wassr_fits.get(label, []), dtype=float)
+        if len(values) == len(coords):
+            b0_map[coords[:, 0], coords[:, 1]] = values
+    return b0_map
+
+def roi_b0_shifts(b0_map, user_geometry):
+    """
+    Median B0 shift per ROI (or AHA segment), matching the regions of calc_spectra.
+    """
+    if user_geometry['aha']:
+        regions = {label: tuple(np.asarray(coords).reshape(-1, 2).T) for label, coords in user_geometry['aha'].items()}
+    else:
+        regions = user_geometry['masks']
+    shifts = {}
+    for label, region in regions.items():
+        values = b0_map[region]
+        values = values[np.isfinite(values)]
+        shifts[label] = float(np.median(values)) if values.size else None
+    return shifts
+
+def pixel_values(value_map, user_geometry):
+    """
+    Values of a 2D map for each label's pixels, in the same order as calc_spectra_pixelwise.
+    """
+    return {label: value_map[coords[:, 0], coords[:, 1]] for label, coords in pixel_coords(user_geometry).items()}
+
+def pixel_b0_shifts(b0_map, user_geometry):
+    """
+    Per-pixel B0 shifts for each label, in the same order as calc_spectra_pixelwise.
+    """
+    return pixel_values(b0_map, user_geometry)
+
+def pixel_warm_starts(user_geometry, roi_fits, config=default_config):
+    """
+    Pairs every pixel from calc_spectra_pixelwise with its coordinates and the seed
+    from the fit_all_rois result of its ROI (or AHA segment for cardiac data).
+    """
+    warm_starts = {}
+    coords_by_label = pixel_coords(user_geometry)
+    if user_geometry['aha']:
+        segment_of = {tuple(coord): segment for segment, coords in user_geometry['aha'].items() for coord in coords}
+        segment_seeds = {segment: seed_from_fit(fit, config) for segment, fit in roi_fits.items()}
+        coords = coords_by_label['lv']
+        seeds = [segment_seeds.get(segment_of.get(tuple(coord))) for coord in coords]
+        warm_starts['lv'] = {'coords': coords, 'seeds': seeds}
+    else:
+        for label, coords in coords_by_label.items():
+            seed = seed_from_fit(roi_fits[label], config) if label in roi_fits else None
+            warm_starts[label] = {'coords': coords, 'seeds': [seed] * len(coords)}
+    return warm_starts
+
+def report_warm_start(label, fits, pixel_spectra, offsets, custom_contrasts, engine, b0_shifts=None, config=default_config):
+    """
+    Logs optimizer work per pixel for warm-started fits against a cold-started sample (warm_start_diagnostics).
+    'Iterations' counts Levenberg-Marquardt iterations for the batched engine and curve_fit
+    function evaluations for the serial and parallel engines.
+    """
+    summary = fits if isinstance(fits, dict) else compact_fits(fits)
+    n_pixels = len(summary['RMSE'])
+    n_sample = min(warm_start_sample, n_pixels)
+    sample = np.linspace(0, n_pixels - 1, n_sample).astype(int)
+    sample_shifts = b0_shifts[sample] if b0_shifts is not None else [None] * n_sample
+    if engine == 'batched':
+        cold = two_step_batch(pixel_spectra[sample], offsets, custom_contrasts, compact=True,
+                              b0_shifts=b0_shifts[sample] if b0_shifts is not None else None, config=config)
+    else:
+        cold = compact_fits([two_step(pixel_spectra[i], offsets, custom_contrasts, b0_shift=b0_shift, config=config)
+                             for i, b0_shift in zip(sample, sample_shifts)])
+    unit = "LM iterations" if engine == 'batched' else "curve_fit evaluations"
+    warm_iterations = np.nanmean(summary['Iterations'][sample])
+    cold_iterations = np.nanmean(cold['Iterations'])
+    n_failed = np.sum(np.isinf(summary['RMSE']))
+    n_failed_cold = np.sum(np.isinf(cold['RMSE']))
+    st_functions.message_logging(
+        f"Warm start in {label}: {warm_iterations:.1f} {unit} per pixel vs. {cold_iterations:.1f} cold "
+        f"({cold_iterations - warm_iterations:.1f} saved, sampled on {n_sample} pixels). "
+        f"Failed fits: {n_failed}/{n_pixels} warm, {n_failed_cold}/{n_sample} in the cold sample.",
+        msg_type='info')
+
+class WorkerPool:
+    """
+    Process pool and progress queue for the parallel engine, shared by every fit of one analysis run.
+    Workers and the queue are only started on first use and are shut down when the with block exits.
+    """
+    def __init__(self, n_workers=None):
+        self.n_workers = n_workers or max_workers or os.cpu_count() or 1
+        self.mp_context = multiprocessing.get_context(worker_start_method)
+        self._executor = None
+        self._manager = None
+        self._queue = None
+
+    def executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.n_workers, mp_context=self.mp_context)
+        return self._executor
+
+    def progress_queue(self):
+        if self._queue is None:
+            self._manager = self.mp_context.Manager()
+            self._queue = self._manager.Queue()
+        return self._queue
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        if self._manager is not None:
+            self._manager.shutdown()
+        self._executor = self._manager = self._queue = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def fit_pixels_parallel(pixel_spectra, offsets, custom_contrasts, progress, warm_start=None, compact=False, b0_shifts=None, config=default_config, pool=None):
+    """
+    Splits pixel spectra into chunks and runs two_step on them in a process pool.
+    Workers are started with worker_start_method, so they only import scripts.lorentzian_fitting,
+    and report progress through a queue. pool is a WorkerPool to reuse; without one a pool is
+    started and shut down for this call.
+    """
+    total_pixels = len(pixel_spectra)
+    with WorkerPool() if pool is None else nullcontext(pool) as pool:
+        executor = pool.executor()
+        progress_queue = pool.progress_queue()
+        n_chunks = max(1, min(total_pixels, pool.n_workers * chunks_per_worker))
+        bounds = np.array_split(np.arange(total_pixels), n_chunks)
+        futures = []
+        for chunk in bounds:
+            coords = warm_start['coords'][chunk] if warm_start else None
+            seeds = [warm_start['seeds'][i] for i in chunk] if warm_start else None
+            shifts = b0_shifts[chunk] if b0_shifts is not None else None
+            futures.append(executor.submit(lorentzian_fitting.fit_pixel_chunk, pixel_spectra[chunk], offsets,
+                                           custom_contrasts, progress_queue, coords, seeds, compact, shifts, config))
+        completed = 0
+        while completed < total_pixels:
+            try:
+                completed += progress_queue.get(timeout=0.5)
+            except queue.Empty:
+                # Stop polling if a worker died without reporting
+                if all(future.done() for future in futures):
+                    break
+            progress(min(completed / total_pixels, 1.0))
+        chunk_fits = [future.result() for future in futures]
+        # Drop reports left after polling stopped so the next call on this pool starts from zero
+        while not progress_queue.empty():
+            progress_queue.get_nowait()
+    if compact:
+        return concat_compact(chunk_fits)
+    return list(itertools.chain.from_iterable(chunk_fits))
+
+def fit_pixel_block(pixel_spectra, offsets, custom_contrasts, engine, warm_start, progress, compact=False, b0_shifts=None, config=default_config, cache=None, pool=None):
+    """
+    Fits one set of pixel spectra with the chosen engine.
+    progress is called with the fraction of the block that is done.
+    b0_shifts optionally gives each pixel's B0 shift (ppm) so the B0 pre-fit is skipped.
+    With a FitCache, the whole block is reused when the spectra and all fit settings are unchanged.
+    pool is an optional WorkerPool for the parallel engine.
+    """
+    if b0_shifts is not None:
+        b0_shifts = np.asarray(b0_shifts, dtype=float)
+    if cache is not None:
+        key = cache_key('pixels', pixel_spectra, offsets, custom_contrasts, engine, warm_start, compact, b0_shifts, config)
+        fits = cache.get(key)
+        if fits is None:
+            fits = fit_pixel_block(pixel_spectra, offsets, custom_contrasts, engine, warm_start, progress, compact, b0_shifts, config, pool=pool)
+            cache.put(key, fits)
+        progress(1.0)
+        return fits
+    total_pixels = len(pixel_spectra)
+    if engine == 'batched':
+        blocks = []
+        for start in range(0, total_pixels, pixel_batch_size):
+            block = pixel_spectra[start:start + pixel_batch_size]
+            block_start = None
+            if warm_start:
+                block_start = stack_seeds(warm_start['seeds'][start:start + pixel_batch_size], custom_contrasts, config)
+            block_shifts = b0_shifts[start:start + pixel_batch_size] if b0_shifts is not None else None
+            blocks.append(two_step_batch(block, offsets, custom_contrasts, block_start, compact, block_shifts, config))
+            progress(min(start + pixel_batch_size, total_pixels) / total_pixels)
+        return concat_compact(blocks) if compact else list(itertools.chain.from_iterable(blocks))
+    if engine == 'parallel':
+        return fit_pixels_parallel(pixel_spectra, offsets, custom_contrasts, progress, warm_start, compact, b0_shifts, config, pool=pool)
+    return fit_pixel_sequence(
+        pixel_spectra, offsets, custom_contrasts,
+        warm_start['coords'] if warm_start else None, warm_start['seeds'] if warm_start else None,
+        lambda n_done: progress(n_done / total_pixels), compact, b0_shifts, config)
+
+# --- SNR triage --- #
+def m0_noise(m0, intensity_threshold=None):
+    """
+    Robust noise level of the M0 image from its background (intensity-rejected) pixels, or None if unknown.
+    """
+    intensity_threshold = fov_intensity_threshold if intensity_threshold is None else intensity_threshold
+    m0 = np.abs(np.nan_to_num(np.asarray(m0, dtype=float)))
+    background = m0[m0 <= intensity_threshold * np.percentile(m0, 99)]
+    if background.size < 100:
+        return None
+    noise = 1.4826 * np.median(np.abs(background - np.median(background)))
+    return noise if noise > 0 else None
+
+def pixel_snr(imgs, m0, offsets):
+    """
+    Per-pixel SNR map used for triage: the lower of the M0 SNR (noise from m0_noise) and the
+    Z-spectrum SNR at the reference offsets, where the noise comes from second differences
+    of the smooth far off-resonance baseline on each side of water.
+    """
+    offsets = np.asarray(offsets, dtype=float)
+    snr = np.full(imgs.shape[:2], np.inf)
+    noise = m0_noise(m0)
+    if noise is not None:
+        snr = np.minimum(snr, np.abs(np.nan_to_num(np.asarray(m0, dtype=float))) / noise)
+    differences, reference = [], []
+    for side in (offsets <= -triage_reference_ppm, offsets >= triage_reference_ppm):
+        side_index = np.flatnonzero(side)[np.argsort(offsets[side])]
+        reference.append(imgs[:, :, side_index])
+        if side_index.size >= 3:
+            differences.append(np.diff(imgs[:, :, side_index], n=2, axis=2))
+    if differences:
+        # Second differences of white noise have variance 6 * sigma ** 2
+        z_noise = np.sqrt(np.mean(np.concatenate(differences, axis=2) ** 2, axis=2) / 6)
+        z_signal = np.mean(np.concatenate(reference, axis=2), axis=2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            snr = np.minimum(snr, np.where(z_noise > 0, z_signal / z_noise, np.inf))
+    return snr
+
+def triage_classes(snr, coarse=True):
+    """
+    Triage class per pixel: 0 = excluded (not fit), 1 = coarse fit only, 2 = full fit.
+    """
+    snr = np.nan_to_num(np.asarray(snr, dtype=float), nan=-np.inf)
+    classes = np.where(snr >= triage_min_snr, 2, 0)
+    if coarse:
+        classes[(snr >= triage_min_snr) & (snr < triage_coarse_snr)] = 1
+    return classes
+
+def subset_warm_start(warm_start, index):
+    """
+    The pixel_warm_starts entry restricted to the pixels in index.
+    """
+    if not warm_start:
+        return warm_start
+    return {'coords': np.asarray(warm_start['coords'])[index], 'seeds': [warm_start['seeds'][i] for i in index]}
+
+def fit_triaged_block(pixel_spectra, snr, offsets, custom_contrasts, engine, warm_start, progress, compact=False, b0_shifts=None, config=default_config, cache=None, coarse=True, pool=None):
+    """
+    fit_pixel_block with SNR triage (see triage_classes). Excluded pixels are not fit and come back
+    zero-filled with RMSE = inf; borderline pixels are fit with triage_coarse_maxfev evaluations.
+    Results keep the input pixel order, and compact results carry the per-pixel 'SNR'.
+    """
+    if custom_contrasts is None:
+        custom_contrasts = default_contrasts
+    classes = triage_classes(snr, coarse)
+    total_pixels = len(pixel_spectra)
+    coarse_config = replace(config, maxfev=triage_coarse_maxfev)
+    parts, order = [], []
+    n_done = 0
+    for triage_class, group_config in ((2, config), (1, coarse_config)):
+        index = np.flatnonzero(classes == triage_class)
+        if index.size == 0:
+            continue
+        def group_progress(fraction, n_done=n_done, n_group=index.size):
+            progress(min((n_done + fraction * n_group) / total_pixels, 1.0))
+        parts.append(fit_pixel_block(pixel_spectra[index], offsets, custom_contrasts, engine, subset_warm_start(warm_start, index),
+                                     group_progress, compact, b0_shifts[index] if b0_shifts is not None else None, group_config, cache, pool=pool))
+        order.append(index)
+        n_done += index.size
+    index = np.flatnonzero(classes == 0)
+    if index.size:
+        # Same ascending offset order as the fitted pixels
+        flip = offsets[0] > 0
+        excluded_offsets = np.flip(offsets) if flip else offsets
+        excluded_spectra = np.flip(pixel_spectra[index], axis=1) if flip else pixel_spectra[index]
+        if compact:
+            parts.append(failed_compact(excluded_spectra, excluded_offsets, custom_contrasts, config))
+        else:
+            parts.append([failed_fit(spectrum, excluded_offsets, custom_contrasts, config=config) for spectrum in excluded_spectra])
+        order.append(index)
+    progress(1.0)
+    if not compact:
+        fits = list(itertools.chain.from_iterable(parts))
+        return [fits[i] for i in np.argsort(np.concatenate(order))]
+    merged = merge_compact(parts, order)
+    merged['SNR'] = np.asarray(snr, dtype=float)
+    return merged
+
+def report_triage(label, snr, coarse=True):
+    """
+    Logs how many pixels were fully fit, coarse fit and excluded by SNR triage.
+    """
+    counts = np.bincount(triage_classes(snr, coarse), minlength=3)
+    st_functions.message_logging(
+        f"SNR triage in {label}: {counts[2]} pixels fit, {counts[1]} coarse fit (SNR < {triage_coarse_snr}), "
+        f"{counts[0]} excluded (SNR < {triage_min_snr}).", msg_type='info')
+
+@time_it
+def fit_all_pixels(spectra_by_pixel, offsets, custom_contrasts, engine='serial', warm_starts=None, compact=False, b0_shifts=None, config=default_config, cache=None, snr=None, coarse=True, pool=None):
     """
     Iterates through all pixels in a mask and applies the two-step fit.
+    engine='batched' fits blocks of pixels at once with two_step_batch.
+    engine='parallel' spreads two_step over a process pool, reusing the WorkerPool pool when given.
+    warm_starts (from pixel_warm_starts) seeds pixels from ROI fits and converged neighbours.
+    The batched engine only uses the ROI seeds, since neighbours in a block are fit together.
+    With compact=True each label holds parameter-only arrays instead of a list of two_step dicts;
+    use lorentzian_fitting.expand_pixel_fit to regenerate curves for a pixel.
+    b0_shifts (from pixel_b0_shifts) replaces the per-pixel B0 pre-fit with an external B0 map.
+    cache is an optional fit_cache.FitCache; unchanged labels are loaded instead of refit.
+    snr (from pixel_values of a pixel_snr map) enables SNR triage, see fit_triaged_block.
     """
     pixel_fits = {}
     for label, pixel_spectra in spectra_by_pixel.items():
         fits_for_label = []
+        warm_start = warm_starts.get(label) if warm_starts else None
+        label_shifts = b0_shifts.get(label) if b0_shifts else None
+        label_snr = snr.get(label) if snr else None
         
         total_pixels = len(pixel_spectra)
         progress_bar = st.progress(0, text=f"Fitting pixels in {label}...")
 
-        for i, spectrum in enumerate(pixel_spectra):
-            fits_for_label.append(two_step(spectrum, offsets, custom_contrasts))
-            progress_bar.progress((i + 1) / total_pixels)
+        hits = cache.hits if cache is not None else 0
+        if total_pixels and label_snr is not None:
+            report_triage(label, label_snr, coarse)
+            fits_for_label = fit_triaged_block(pixel_spectra, label_snr, offsets, custom_contrasts, engine, warm_start,
+                                               progress_bar.progress, compact, label_shifts, config, cache, coarse, pool=pool)
+        elif total_pixels:
+            fits_for_label = fit_pixel_block(pixel_spectra, offsets, custom_contrasts, engine, warm_start,
+                                             progress_bar.progress, compact, label_shifts, config, cache, pool=pool)
+        reused = cache is not None and cache.hits > hits
         
+        if warm_start_diagnostics and warm_start and total_pixels and not reused:
+            report_warm_start(label, fits_for_label, pixel_spectra, offsets, custom_contrasts, engine, label_shifts, config)
         pixel_fits[label] = fits_for_label
         progress_bar.empty()
     return pixel_fits
 
+# --- Full field-of-view fitting --- #
+def foreground_mask(m0, intensity_threshold=None, min_snr=None):
+    """
+    Separates object from background in the unsaturated (M0) image.
+    Pixels must exceed a fraction of the robust maximum intensity and a minimum SNR, with the
+    noise level estimated from the background (intensity-rejected) pixels.
+    """
+    intensity_threshold = fov_intensity_threshold if intensity_threshold is None else intensity_threshold
+    min_snr = fov_min_snr if min_snr is None else min_snr
+    m0 = np.abs(np.nan_to_num(np.asarray(m0, dtype=float)))
+    mask = m0 > intensity_threshold * np.percentile(m0, 99)
+    noise = m0_noise(m0, intensity_threshold) if min_snr else None
+    if noise is not None:
+        mask &= m0 / noise > min_snr
+    return mask
+
+@time_it
+def fit_full_fov(imgs, m0, offsets, custom_contrasts, engine='serial', warm_start=True, b0_map=None, config=default_config, cache=None, triage=False, coarse=True, pool=None):
+    """
+    Fits every foreground pixel of the image stack and returns a PixelFitResult with a single 'Full FOV' label.
+    Background pixels (foreground_mask) are never fit. Pixels are processed in square tiles so only
+    one tile of spectra and intermediate arrays is held at a time.
+    b0_map (ppm, e.g. from wassr_b0_map) replaces the B0 pre-fit wherever it is finite.
+    With a FitCache, tiles whose spectra and settings are unchanged are loaded instead of refit.
+    With triage, low-SNR foreground pixels are excluded or coarse fit (see fit_triaged_block).
+    pool is an optional WorkerPool shared by all tiles. Returns None when there is no foreground.
+    """
+    label = 'Full FOV'
+    mask = foreground_mask(m0)
+    snr_map = pixel_snr(imgs, m0, offsets) if triage else None
+    n_foreground = int(np.sum(mask))
+    st_functions.message_logging(
+        f"Full FOV mapping: fitting {n_foreground} of {mask.size} pixels ({mask.size - n_foreground} background pixels skipped).",
+        msg_type='info')
+    if n_foreground == 0:
+        st_functions.message_logging("No foreground pixels found in the M0 image, the full FOV map was skipped.", msg_type='warning')
+        return None
+    seed = None
+    if warm_start:
+        seed = seed_from_fit(cached_two_step(np.mean(imgs[mask], axis=0), offsets, custom_contrasts, config=config, cache=cache), config)
+    if triage:
+        report_triage(label, snr_map[mask], coarse)
+    progress_bar = st.progress(0, text="Fitting full FOV...")
+    tiles, coords = [], []
+    n_done = 0
+    rows, cols = mask.shape
+    for y0 in range(0, rows, fov_tile_size):
+        for x0 in range(0, cols, fov_tile_size):
+            tile_mask = mask[y0:y0 + fov_tile_size, x0:x0 + fov_tile_size]
+            tile_coords = np.argwhere(tile_mask) + [y0, x0]
+            if len(tile_coords) == 0:
+                continue
+            tile_spectra = imgs[tile_coords[:, 0], tile_coords[:, 1], :]
+            tile_start = {'coords': tile_coords, 'seeds': [seed] * len(tile_coords)} if warm_start else None
+            def progress(fraction, n_done=n_done, n_tile=len(tile_coords)):
+                progress_bar.progress(min((n_done + fraction * n_tile) / n_foreground, 1.0), text="Fitting full FOV...")
+            tile_shifts = b0_map[tile_coords[:, 0], tile_coords[:, 1]] if b0_map is not None else None
+            if triage:
+                tile_snr = snr_map[tile_coords[:, 0], tile_coords[:, 1]]
+                tiles.append(fit_triaged_block(tile_spectra, tile_snr, offsets, custom_contrasts, engine, tile_start, progress, True, tile_shifts, config, cache, coarse, pool=pool))
+            else:
+                tiles.append(fit_pixel_block(tile_spectra, offsets, custom_contrasts, engine, tile_start, progress, True, tile_shifts, config, cache, pool=pool))
+            coords.append(tile_coords)
+            n_done += len(tile_coords)
+    progress_bar.empty()
+    return PixelFitResult.from_compact({label: concat_compact(tiles)}, {label: np.concatenate(coords)}, mask.shape)
+
+# --- Multi-slice (volume) fitting --- #
+@time_it
+def fit_volume(imgs, m0, offsets, custom_contrasts, engine='batched', warm_start=True, b0_map=None, config=default_config, cache=None, pool=None):
+    """
+    Full field-of-view fits for every slice of a (rows, cols, slices, offsets) volume.
+    Each slice is one process pool job (largest first), so whole-organ coverage scales with the number of cores.
+    The foreground mask comes from the whole M0 volume. Within a slice engine='batched' uses two_step_batch;
+    the other engines run two_step pixel by pixel with neighbour warm starts.
+    b0_map is an optional (rows, cols, slices) B0 map in ppm. With a FitCache, unchanged slices are not refit.
+    pool is an optional WorkerPool to run the slices in.
+    Returns one PixelFitResult ('Full FOV' label) per slice, None for slices without foreground,
+    or None when the whole volume has no foreground.
+    """
+    mask = foreground_mask(m0)
+    n_slices = mask.shape[2]
+    n_foreground = int(np.sum(mask))
+    if n_foreground == 0:
+        st_functions.message_logging("No foreground pixels found in the M0 volume, volume mapping was skipped.", msg_type='warning')
+        return None
+    st_functions.message_logging(
+        f"Volume mapping: fitting {n_foreground} foreground pixels in {n_slices} slices ({mask.size - n_foreground} background pixels skipped).",
+        msg_type='info')
+    seed = None
+    if warm_start:
+        seed = seed_from_fit(cached_two_step(np.mean(imgs[mask], axis=0, dtype=np.float64), offsets, custom_contrasts, config=config, cache=cache), config)
+    slice_engine = 'batched' if engine == 'batched' else 'serial'
+    coords, fits, jobs = {}, {}, {}
+    for index in range(n_slices):
+        slice_coords = np.argwhere(mask[:, :, index])
+        if len(slice_coords) == 0:
+            continue
+        coords[index] = slice_coords
+        spectra = imgs[slice_coords[:, 0], slice_coords[:, 1], index, :]
+        shifts = b0_map[slice_coords[:, 0], slice_coords[:, 1], index] if b0_map is not None else None
+        args = (spectra, offsets, custom_contrasts, slice_engine, seed, slice_coords, shifts, config, pixel_batch_size)
+        key = cache_key('slice', *args) if cache is not None else None
+        cached = cache.get(key) if cache is not None else None
+        if cached is not None:
+            fits[index] = cached
+        else:
+            jobs[index] = (key, args)
+    progress_bar = st.progress(len(fits) / len(coords), text="Fitting slices...")
+    if jobs:
+        with WorkerPool(min(max_workers or os.cpu_count() or 1, len(jobs))) if pool is None else nullcontext(pool) as pool:
+            futures = {pool.executor().submit(lorentzian_fitting.fit_slice, *args): index
+                       for index, (_, args) in sorted(jobs.items(), key=lambda job: -len(coords[job[0]]))}
+            for future in as_completed(futures):
+                index = futures[future]
+                fits[index] = future.result()
+                if cache is not None:
+                    cache.put(jobs[index][0], fits[index])
+                progress_bar.progress(len(fits) / len(coords), text=f"Fitted {len(fits)}/{len(coords)} slices...")
+    progress_bar.empty()
+    label = 'Full FOV'
+    return [PixelFitResult.from_compact({label: fits[index]}, {label: coords[index]}, mask.shape[:2]) if index in fits else None
+            for index in range(n_slices)]
+
+# --- Quick-look maps --- #
+@time_it
+def quick_look_maps(imgs, m0, offsets, custom_contrasts, b0_map=None, config=default_config):
+    """
+    MTRasym and Lorentzian difference maps for the whole image in a single vectorized pass (see scripts.quick_look).
+    Background pixels (foreground_mask) are set to NaN.
+    """
+    maps = quick_look.quick_look_maps(imgs, offsets, custom_contrasts, b0_map, config)
+    mask = foreground_mask(m0)
+    return {title: np.where(mask, values, np.nan) for title, values in maps.items()}
+
 # --- B1 fitting functions --- #
 @time_it
 def fit_b1(imgs, nominal_flip):
@@ -284,43 +699,218 @@ def fit_b1(imgs, nominal_flip):
     
     return np.nan_to_num(np.squeeze(flip_error))
     
+# --- B1 correction --- #
+def resample_b1(b1_map, shape):
+    """
+    Relative B1 map linearly resampled to a (rows, cols) image grid.
+    """
+    b1_map = np.asarray(b1_map, dtype=float)
+    if b1_map.shape == tuple(shape):
+        return b1_map
+    return ndimage.zoom(b1_map, (shape[0] / b1_map.shape[0], shape[1] / b1_map.shape[1]), order=1)
+
+def b1_lookup(maps_by_power, nominal_b1):
+    """
+    Stacks {contrast: map} dictionaries acquired at nominal_b1 (uT) into lookup tables along a B1 axis.
+    Returns (nominal B1 in ascending order, {contrast: (rows, cols, n_powers) table}).
+    """
+    order = np.argsort(nominal_b1)
+    b1_axis = np.asarray(nominal_b1, dtype=float)[order]
+    table = {name: np.stack([maps_by_power[k][name] for k in order], axis=-1) for name in maps_by_power[0]}
+    return b1_axis, table
+
+def b1_correct(b1_axis, table, rel_b1, target_b1):
+    """
+    Contrast maps at the actual saturation B1 target_b1, interpolated pixelwise along the B1 axis of a b1_lookup table.
+    A pixel with relative B1 rel_b1 saw rel_b1 * nominal, so target_b1 is reached at a nominal B1 of target_b1 / rel_b1.
+    Pixels that would need a nominal B1 outside the acquired powers are NaN.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        query = target_b1 / np.asarray(rel_b1, dtype=float)
+    inside = (query >= b1_axis[0]) & (query <= b1_axis[-1])
+    query = np.where(inside, query, b1_axis[0])[..., np.newaxis]
+    return {name: np.where(inside, quick_look.interp_offsets(values, b1_axis, query)[..., 0], np.nan)
+            for name, values in table.items()}
+
+@time_it
+def correct_b1(pixel_fits_by_power, nominal_b1, b1_map, target_b1):
+    """
+    B1-corrected MT and contrast maps from pixelwise fits at several saturation powers and a relative B1 (DAMB1) map.
+    The B1 map is resampled to the CEST grid once; the correction itself is array interpolation, with no refits.
+    """
+    names = pixel_fits_by_power[0].contrast_names[1:]
+    # Failed and triaged pixels carry zeroed parameters, so they are blanked before they enter the lookup table
+    maps_by_power = [{name: np.where(fits.to_map(fits.converged, False), values, np.nan) for name, values in fits.contrast_maps(names).items()}
+                     for fits in pixel_fits_by_power]
+    b1_axis, table = b1_lookup(maps_by_power, nominal_b1)
+    rel_b1 = resample_b1(b1_map, pixel_fits_by_power[0].shape)
+    corrected = b1_correct(b1_axis, table, rel_b1, target_b1)
+    fitted = np.all(np.isfinite(next(iter(table.values()))), axis=-1)
+    n_outside = int(np.sum(fitted & ~np.isfinite(next(iter(corrected.values())))))
+    if n_outside:
+        st_functions.message_logging(f"B₁ correction: {n_outside} pixels need a saturation power outside the acquired range and are left out.", msg_type='warning')
+    return corrected
+
 # --- WASSR fitting functions --- #
+def wassr_splines(spectra, offsets):
+    """
+    Sorts a (n_pixels, n_offsets) stack of WASSR spectra by offset and samples one cubic spline through all
+    finite spectra on wassr_n_interp points. Returns (offsets, spectra, finite, offsets_interp, spectra_interp).
+    """
+    order = np.argsort(offsets)
+    offsets = np.asarray(offsets, dtype=float)[order]
+    spectra = np.asarray(spectra, dtype=np.float64)[:, order]
+    finite = np.all(np.isfinite(spectra), axis=1)
+    offsets_interp = np.linspace(offsets[0], offsets[-1], wassr_n_interp)
+    spectra_interp = CubicSpline(offsets, spectra[finite], axis=1)(offsets_interp) if np.any(finite) else np.empty((0, wassr_n_interp))
+    return offsets, spectra, finite, offsets_interp, spectra_interp
+
+def parabola_vertex(values, index):
+    """
+    Sub-sample position (index + fraction) of the extremum of each row of values near index,
+    from the parabola through three evenly spaced samples.
+    """
+    index = np.clip(index, 1, values.shape[1] - 2)
+    rows = np.arange(len(index))
+    ym, y0, yp = (values[rows, index + k] for k in (-1, 0, 1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vertex = 0.5 * (ym - yp) / (ym - 2 * y0 + yp)
+    return index + np.where(np.isfinite(vertex), np.clip(vertex, -1, 1), 0)
+
+def wassr_b0_batch(spectra, offsets, polish=None, config=default_config):
+    """
+    B0 shifts (ppm) for a (n_pixels, n_offsets) stack of WASSR spectra at once.
+    One cubic spline through all spectra is sampled on wassr_n_interp points and its minimum is refined
+    with a parabola through the neighbouring samples. With polish (default wassr_polish), water + MT are
+    then fit to the acquired points with the batched solver, starting from the spline minimum, depth and
+    half-depth width; pixels that do not converge keep the spline estimate. Spectra with non-finite values give NaN.
+    """
+    polish = wassr_polish if polish is None else polish
+    offsets, spectra, finite, offsets_interp, spectra_interp = wassr_splines(spectra, offsets)
+    b0 = np.full(spectra.shape[0], np.nan)
+    if not np.any(finite):
+        return b0
+    step = offsets_interp[1] - offsets_interp[0]
+    estimate = offsets_interp[0] + parabola_vertex(spectra_interp, np.argmin(spectra_interp, axis=1)) * step
+    if polish:
+        # Data-driven water start; the generic p0_corr lets the solver trade the water pool for MT
+        depth = 1 - np.min(spectra_interp, axis=1)
+        width = np.sum(spectra_interp < 1 - 0.5 * depth[:, np.newaxis], axis=1) * step
+        p0 = np.tile(np.asarray(config.p0_corr, dtype=float), (len(estimate), 1))
+        p0[:, 0] = np.clip(depth, config.lb_corr[0], config.ub_corr[0])
+        p0[:, 1] = np.clip(width, config.lb_corr[1], config.ub_corr[1])
+        p0[:, 2] = estimate
+        y = spectra[finite]
+        fit, _, ok, _ = batch_fitting.levenberg_marquardt(batch_step_1_fit, batch_step_1_jac, np.broadcast_to(offsets, y.shape), y, p0,
+                                                          config.lb_corr, config.ub_corr, max_iter=config.maxfev, ftol=config.ftol, xtol=config.xtol)
+        estimate = np.where(ok, fit[:, 2], estimate)
+    b0[finite] = np.clip(estimate, offsets[0], offsets[-1])
+    return b0
+
+def wassr_b0_mscf(spectra, offsets):
+    """
+    B0 shifts (ppm) with the maximum-symmetry centre frequency (MSCF) method for a (n_pixels, n_offsets) stack.
+    Each spline-sampled saturation profile is cross-correlated with its mirror image, which is its
+    convolution with itself, through one FFT over all pixels. The lag of maximum correlation (refined with
+    a parabola) is twice the centre of symmetry. No lineshape is fit, so asymmetric lines and MT do not
+    pull the estimate the way they pull a Lorentzian fit. Spectra with non-finite values give NaN.
+    """
+    offsets, spectra, finite, offsets_interp, spectra_interp = wassr_splines(spectra, offsets)
+    b0 = np.full(spectra.shape[0], np.nan)
+    if not np.any(finite):
+        return b0
+    # Saturation profile with its plateau removed, so the overlap at each lag is dominated by the water line
+    profile = np.max(spectra_interp, axis=1, keepdims=True) - spectra_interp
+    n_fft = 2 * wassr_n_interp
+    spectrum_fft = np.fft.rfft(profile, n=n_fft, axis=1)
+    correlation = np.fft.irfft(spectrum_fft * spectrum_fft, n=n_fft, axis=1)[:, :n_fft - 1]
+    # Lag k of the self-convolution corresponds to a centre of symmetry at offsets_interp[0] + k * step / 2
+    lag = parabola_vertex(correlation, np.argmax(correlation, axis=1))
+    b0[finite] = offsets_interp[0] + 0.5 * lag * (offsets_interp[1] - offsets_interp[0])
+    return b0
+
+def wassr_b0_blocks(spectra, offsets, text, algorithm='lorentzian', config=default_config):
+    """
+    wassr_b0_batch ('lorentzian') or wassr_b0_mscf ('mscf') in blocks of pixel_batch_size spectra with a progress bar.
+    """
+    b0 = np.full(len(spectra), np.nan)
+    progress_bar = st.progress(0, text=text)
+    for start in range(0, len(spectra), pixel_batch_size):
+        stop = min(start + pixel_batch_size, len(spectra))
+        if algorithm == 'mscf':
+            b0[start:stop] = wassr_b0_mscf(spectra[start:stop], offsets)
+        else:
+            b0[start:stop] = wassr_b0_batch(spectra[start:stop], offsets, config=config)
+        progress_bar.progress(stop / len(spectra), text=text)
+    progress_bar.progress(1.0, text="WASSR B₀ fitting complete.")
+    progress_bar.empty()
+    return b0
+
+def smooth_b0_field(b0_samples, coords, mask, order=None):
+    """
+    Fits a 2D polynomial of total degree order (default wassr_field_order) to B0 samples at coords (n, 2)
+    and evaluates it on mask. Samples further than wassr_outlier_mad median absolute deviations from the
+    first fit are dropped and the field is refit once.
+    Returns the field map and the residual map (sample - field at the samples), both NaN elsewhere.
+    Both maps are all NaN when fewer finite samples than polynomial terms are left, before or after the outlier rejection.
+    """
+    order = wassr_field_order if order is None else order
+    shape = mask.shape
+    n_terms = (order + 1) * (order + 2) // 2
+    field = np.full(shape, np.nan)
+    residual_map = np.full(shape, np.nan)
+    def design(points):
+        # Coordinates scaled to [-1, 1] keep the powers well conditioned
+        y = 2 * points[:, 0] / max(shape[0] - 1, 1) - 1
+        x = 2 * points[:, 1] / max(shape[1] - 1, 1) - 1
+        return np.stack([y ** i * x ** j for i in range(order + 1) for j in range(order + 1 - i)], axis=1)
+    valid = np.isfinite(b0_samples)
+    coords, b0_samples = coords[valid], b0_samples[valid]
+    samples_design = design(coords)
+    keep = np.ones(len(b0_samples), dtype=bool)
+    for _ in range(2):
+        if np.count_nonzero(keep) < n_terms:
+            return field, residual_map
+        coefficients = np.linalg.lstsq(samples_design[keep], b0_samples[keep], rcond=None)[0]
+        residuals = b0_samples - samples_design @ coefficients
+        mad = np.median(np.abs(residuals - np.median(residuals)))
+        keep = np.abs(residuals) <= wassr_outlier_mad * 1.4826 * mad if mad > 0 else keep
+    field[mask] = design(np.argwhere(mask)) @ coefficients
+    residual_map[coords[:, 0], coords[:, 1]] = residuals
+    return field, residual_map
+
 @time_it
-def fit_wassr_full(imgs, offsets, user_geometry):
+def fit_wassr_full(imgs, offsets, user_geometry, algorithm='lorentzian', sparse=False, config=default_config):
     """
     Performs full (unmasked) WASSR fitting and returns the full B0 map as well as maskes results.
+    All foreground pixels are processed together with the 'lorentzian' (wassr_b0_batch) or 'mscf' (wassr_b0_mscf) algorithm.
+    With sparse, only every wassr_sample_stride-th foreground pixel along each axis is fit and the map is the
+    smooth_b0_field model over the foreground; too few foreground pixels or successful sample fits fall back
+    to dense fitting. The third output is the sample residual map (None for dense maps).
     """
-    n_interp = 1000
     b0_full_map = np.full((imgs.shape[0], imgs.shape[1]), np.nan, dtype=float)
-    total_pixels = imgs.shape[0] * imgs.shape[1]
-    progress_bar = st.progress(0, text="Fitting full WASSR B₀ map...")
-    progress_counter = 0
-    for i in range(imgs.shape[0]):
-        for j in range(imgs.shape[1]):
-            progress_counter += 1
-            if progress_counter % 100 == 0:
-                 progress_bar.progress(progress_counter / total_pixels, text="Fitting full WASSR B₀ map...")
-            if np.mean(imgs[i, j, :]) < 0.05 * np.max(imgs):
-                continue
-            spectrum = imgs[i, j, :]
-            pixel_offsets = offsets.copy()
-            if pixel_offsets[0] > pixel_offsets[-1]:
-                pixel_offsets = np.flip(pixel_offsets)
-                spectrum = np.flip(spectrum)
-            try:
-                cubic_spline = CubicSpline(pixel_offsets, spectrum)
-                offsets_interp = np.linspace(pixel_offsets[0], pixel_offsets[-1], n_interp)
-                spectrum_interp = cubic_spline(offsets_interp)
-                min_idx = np.argmin(spectrum_interp)
-                p0_corr[2] = offsets_interp[min_idx]
-                fit_1, _ = curve_fit(step_1_fit, offsets_interp, spectrum_interp, p0=p0_corr, bounds=(lb_corr, ub_corr))
-                water_fit = lorentzian(offsets_interp, fit_1[0], fit_1[1], fit_1[2])
-                b0_shift = offsets_interp[np.argmax(water_fit)]
-                b0_full_map[i, j] = b0_shift
-            except (RuntimeError, ValueError):
-                b0_full_map[i, j] = np.nan
-    progress_bar.progress(1.0, text="WASSR B₀ fitting complete.")
-    progress_bar.empty()
+    foreground = np.mean(imgs, axis=2) >= wassr_intensity_threshold * np.max(imgs)
+    residual_map = None
+    if sparse:
+        grid = np.zeros_like(foreground)
+        grid[::wassr_sample_stride, ::wassr_sample_stride] = True
+        coords = np.argwhere(foreground & grid)
+        n_terms = (wassr_field_order + 1) * (wassr_field_order + 2) // 2
+        if len(coords) < 3 * n_terms:
+            st_functions.message_logging("Too few foreground pixels for a sparse B₀ map, fitting every pixel instead.", msg_type='warning')
+            sparse = False
+    if sparse:
+        b0_samples = wassr_b0_blocks(imgs[coords[:, 0], coords[:, 1], :], offsets, "Fitting sparse WASSR B₀ samples...", algorithm, config)
+        b0_full_map, residual_map = smooth_b0_field(b0_samples, coords, foreground)
+        if np.all(np.isnan(b0_full_map)):
+            st_functions.message_logging(f"Only {np.count_nonzero(np.isfinite(b0_samples))} of {len(coords)} sparse B₀ samples could be fit, "
+                                         "too few for the field model. Fitting every pixel instead.", msg_type='warning')
+            sparse, residual_map = False, None
+        else:
+            st_functions.message_logging(f"Sparse B₀ map: fit {len(coords)} of {np.count_nonzero(foreground)} foreground pixels, "
+                                         f"RMS field residual {np.sqrt(np.nanmean(residual_map ** 2)):.4f} ppm.", msg_type='info')
+    if not sparse:
+        b0_full_map[foreground] = wassr_b0_blocks(imgs[foreground], offsets, "Fitting full WASSR B₀ map...", algorithm, config)
     pixelwise = {}
     if user_geometry['aha']:
         masks_dict = user_geometry.get('aha', {})
@@ -333,51 +923,27 @@ def fit_wassr_full(imgs, offsets, user_geometry):
             coords = np.argwhere(mask)
             valid_coords = [c for c in coords if not np.isnan(b0_full_map[c[0], c[1]])]
             pixelwise[label] = [b0_full_map[r, c] for r, c in valid_coords]
-    return pixelwise, b0_full_map
+    return pixelwise, b0_full_map, residual_map
 
 @time_it
-def fit_wassr_masked(imgs, offsets, user_geometry):
+def fit_wassr_masked(imgs, offsets, user_geometry, algorithm='lorentzian', config=default_config):
     """
     Performs masked WASSR fitting for B0 shifts.
+    The pixels of all masks are processed together with the 'lorentzian' or 'mscf' algorithm (see fit_wassr_full).
     """
-    n_interp = 1000
-    pixelwise = {}
     if user_geometry['aha']:
         masks_dict = user_geometry.get('aha', {})
-        all_coords = [(label, coord) for label, coords_list in masks_dict.items() for coord in coords_list]
+        coords_by_label = {label: np.array(coords_list, dtype=int).reshape(-1, 2) for label, coords_list in masks_dict.items()}
     else:
         masks_dict = user_geometry.get('masks', {})
-        all_coords = []
-        for label, mask in masks_dict.items():
-            coords = np.argwhere(mask)
-            all_coords.extend([(label, tuple(coord)) for coord in coords])
-    if not all_coords:
+        coords_by_label = {label: np.argwhere(mask) for label, mask in masks_dict.items()}
+    all_coords = np.concatenate(list(coords_by_label.values())) if coords_by_label else np.empty((0, 2), dtype=int)
+    if len(all_coords) == 0:
         return {}
-    progress_bar = st.progress(0, text="Fitting WASSR B₀ shifts for masked region...")
-    total = len(all_coords)
-    progress_counter = 0
-    for label in masks_dict:
-        pixelwise[label] = []
-    for i, (label, (y, x)) in enumerate(all_coords):
-        spectrum = imgs[y, x, :]
-        pixel_offsets = offsets.copy()
-        if pixel_offsets[0] > pixel_offsets[-1]:
-            pixel_offsets = np.flip(pixel_offsets)
-            spectrum = np.flip(spectrum)
-        try:
-            cubic_spline = CubicSpline(pixel_offsets, spectrum)
-            offsets_interp = np.linspace(pixel_offsets[0], pixel_offsets[-1], n_interp)
-            spectrum_interp = cubic_spline(offsets_interp)
-            min_idx = np.argmin(spectrum_interp)
-            p0_corr[2] = offsets_interp[min_idx]
-            fit_1, _ = curve_fit(step_1_fit, offsets_interp, spectrum_interp, p0=p0_corr, bounds=(lb_corr, ub_corr))
-            water_fit = lorentzian(offsets_interp, fit_1[0], fit_1[1], fit_1[2])
-            b0_shift = offsets_interp[np.argmax(water_fit)]
-        except Exception:
-            b0_shift = np.nan
-        pixelwise[label].append(b0_shift)
-        progress_counter += 1
-        progress_bar.progress(progress_counter / total, text="Fitting WASSR B₀ shifts for masked region...")
-    progress_bar.progress(1.0, text="WASSR B₀ fitting complete.")
-    progress_bar.empty()
-    return pixelwise
\ No newline at end of file
+    b0 = wassr_b0_blocks(imgs[all_coords[:, 0], all_coords[:, 1], :], offsets, "Fitting WASSR B₀ shifts for masked region...", algorithm, config)
+    pixelwise = {}
+    start = 0
+    for label, coords in coords_by_label.items():
+        pixelwise[label] = list(b0[start:start + len(coords)])
+        start += len(coords)
+    return pixelwise
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 16 19:41:08 2026
+
+@author: jonah
+
+Content-addressed on-disk cache for fit results.
+"""
+import os
+import pickle
+import hashlib
+import dataclasses
+from pathlib import Path
+import numpy as np
+
+# --- Cache options --- #
+cache_max_bytes = 2 * 1024 ** 3 # Least recently used entries are evicted above this size
+cache_version = 1 # Bump when fit outputs change so stale entries are never returned
+
+def _update(digest, value):
+    """
+    Feeds a (possibly nested) value into a hashlib digest in a type-tagged, order-preserving way.
+    """
+    if value is None:
+        digest.update(b'N')
+    elif isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        digest.update(b'A' + value.dtype.str.encode() + repr(value.shape).encode())
+        digest.update(value.tobytes())
+    elif isinstance(value, (list, tuple)):
+        digest.update(b'L%d' % len(value))
+        for item in value:
+            _update(digest, item)
+    elif isinstance(value, dict):
+        digest.update(b'D%d' % len(value))
+        for key in sorted(value, key=repr):
+            _update(digest, key)
+            _update(digest, value[key])
+    elif dataclasses.is_dataclass(value):
+        digest.update(b'C' + type(value).__name__.encode())
+        _update(digest, dataclasses.astuple(value))
+    elif isinstance(value, (bool, int, float, str, np.generic)):
+        digest.update(b'S' + repr(value).encode())
+    else:
+        raise TypeError(f"Cannot hash {type(value).__name__} for the fit cache.")
+
+def cache_key(*parts):
+    """
+    SHA-256 key for the given inputs (arrays, configs, contrast lists, ...).
+    """
+    digest = hashlib.sha256(b'precat-fit-cache-%d' % cache_version)
+    _update(digest, parts)
+    return digest.hexdigest()
+
+def _check_owner(stat, path):
+    """
+    Raises PermissionError unless path belongs to the current user (POSIX only).
+    """
+    if hasattr(os, 'getuid') and stat.st_uid != os.getuid():
+        raise PermissionError(f"{path} is not owned by the current user.")
+
+class FitCache:
+    """
+    Stores pickled fit results under the hash of their inputs.
+    Reads refresh an entry's modification time, so eviction removes the least recently used entries first.
+    Entries are unpickled, so the directory must be private: it is created with mode 0o700 and refused
+    when another user owns it or can write to it.
+    """
+    def __init__(self, directory, max_bytes=None):
+        self.directory = Path(directory)
+        self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        stat = self.directory.lstat()
+        if self.directory.is_symlink():
+            raise PermissionError(f"{self.directory} is a symbolic link.")
+        _check_owner(stat, self.directory)
+        if hasattr(os, 'getuid') and stat.st_mode & 0o077:
+            os.chmod(self.directory, 0o700)
+        self.max_bytes = cache_max_bytes if max_bytes is None else max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None # Running total of entry sizes, measured by the first evict scan
+
+    def _path(self, key):
+        return self.directory / f"{key}.pkl"
+
+    def get(self, key):
+        """
+        Returns the cached value for key, or None.
+        Entries that cannot be loaded (e.g. pickled by an older version of the code) are removed.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                _check_owner(os.fstat(f.fileno()), path)
+                value = pickle.load(f)
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception:
+            self.misses += 1
+            path.unlink(missing_ok=True)
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Stores value under key, then evicts old entries if the cache may be over its size cap.
+        """
+        path = self._path(key)
+        temp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(temp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        added = temp_path.stat().st_size
+        try:
+            added -= path.stat().st_size
+        except OSError:
+            pass
+        os.replace(temp_path, path) # Atomic, so concurrent readers never see partial files
+        if self._size is not None:
+            self._size += added
+        if self._size is None or self._size > self.max_bytes:
+            self.evict()
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached value for key, computing and storing it on a miss.
+        """
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits in max_bytes and resets the running size.
+        """
+        entries = []
+        for path in self.directory.glob('*.pkl'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+                total -= size
+            except OSError:
+                pass
+        self._size = total
+
+    def clear(self):
+        for path in self.directory.glob('*.pkl'):
+            path.unlink(missing_ok=True)
+        self._size = 0
@@ -10,7 +10,6 @@ import sys
 import numpy as np
 import streamlit as st
 import matplotlib.pyplot as plt
-from scipy.interpolate import interpn
 from custom import st_functions
 from custom.st_functions import time_it
 
@@ -52,37 +51,59 @@ def find_cest_offsets(data):
         return best_val
     return None
 
+def find_sat_power(data):
+    """
+    Saturation B1 (uT) from the method file, or None if no known parameter is present.
+    """
+    known_candidates = [
+    "Cest_B1",
+    "SatPower",
+    "PVM_MagTransPower"
+    ]
+    for key in known_candidates:
+        if key in data.method:
+            return float(np.ravel(data.method[key])[0])
+    return None
+
+def power_label(sat_power, num):
+    """
+    Display label for a CEST scan in a saturation power series.
+    """
+    return f"Scan {num} ({sat_power:g} µT)" if sat_power is not None else f"Scan {num}"
 
 # --- Reconstruction and data loading functions --- #
-def load_bruker_img(num, directory):
+def load_bruker_img(num, directory, dtype=np.float64):
     """
     Loads a single Bruker image stack directly (processed image data).
     """
-    data = bruker.ReadExperiment(directory, num)
+    data = bruker.ReadExperiment(directory, num, dtype)
     imgs = data.proc_data
     imgs = np.rot90(imgs, k=2) # Rotates image, may not be necessary 
     return imgs
 
 @time_it    
-def recon_bruker(num, directory):
+def recon_bruker(num, directory, dtype=np.float64, split_slices=False):
     """
     Loads CEST data from Bruker processed image data.
+    dtype=np.float32 keeps the image stack in single precision.
+    With split_slices (CEST/WASSR), multi-slice and 3D studies give a (rows, cols, slices, offsets) stack.
     """
-    data = bruker.ReadExperiment(directory, num)
+    data = bruker.ReadExperiment(directory, num, dtype, split_slices)
     raw_offsets = find_cest_offsets(data)
     if raw_offsets is None:
         raise ValueError(f"Could not find CEST offsets/frequencies in parameters for Scan {num}.")
     offsets = np.round(raw_offsets / data.method["PVM_FrqWork"][0], 2)
     imgs = data.proc_data
-    study = {"imgs": imgs, "offsets": offsets}
+    study = {"imgs": imgs, "offsets": offsets, "sat_power": find_sat_power(data)}
     return study
 
 @time_it
-def recon_bart(num, directory):
+def recon_bart(num, directory, dtype=np.float64):
     """
     Reconstructs radial CEST data using BART.
+    dtype=np.float32 keeps k-space (complex64) and images in single precision.
     """
-    data = bruker.ReadExperiment(directory, num)
+    data = bruker.ReadExperiment(directory, num, dtype)
     imgs = []
     raw_offsets = find_cest_offsets(data)
     if raw_offsets is None:
@@ -96,13 +117,13 @@ def recon_bart(num, directory):
         offset_ksp = np.expand_dims(offset_ksp, axis=0)
         img = bart(1, 'nufft -i', traj, offset_ksp)
         img = bart(1, 'rss 8', img)
-        img = np.abs(img)
+        img = np.abs(img).astype(dtype, copy=False)
         imgs.append(img)
         loading_bar.progress((i + 1) / len(offsets), text="Reconstructing images...")
         if i+1 == len(offsets):
             loading_bar.progress((i + 1) / len(offsets), text="Reconstruction complete.")
     imgs = np.stack(imgs, axis=2)
-    study = {"imgs": imgs, "offsets": offsets}
+    study = {"imgs": imgs, "offsets": offsets, "sat_power": find_sat_power(data)}
     return study
 
 @time_it
@@ -213,65 +234,97 @@ def recon_damb1(directory, theta_path, two_theta_path):
 # --- Image processing functions --- #
 def rotate_image_stack(image_stack, k):
     """
-    Rotates a 3D image stack k * 90deg counterclockwise.
+    Rotates an image stack k * 90deg counterclockwise. Every slice of a volume gets the same rotation.
     """
     return np.rot90(image_stack, k=k, axes=(0, 1))
 
 def flip_image_stack_vertically(image_stack):
     """
-    Flips a 3D image stack horizontally.
+    Flips an image stack (or every slice of a volume) horizontally.
     """
     return np.flip(image_stack, axis=1)
 
+def interp_reference(m0, ref_index, query):
+    """
+    Linearly interpolates the M0 frames (last axis, acquired at frame indices ref_index) at the frame indices query.
+    Raises ValueError for frames outside the reference scans, which cannot be interpolated.
+    """
+    if np.any(query < ref_index[0]) or np.any(query > ref_index[-1]):
+        raise ValueError("Frames outside the range of the reference scans.")
+    upper = np.clip(np.searchsorted(ref_index, query), 1, len(ref_index) - 1)
+    weight = (query - ref_index[upper - 1]) / (ref_index[upper] - ref_index[upper - 1])
+    return m0[..., upper - 1] * (1 - weight) + m0[..., upper] * weight
+
 @time_it
 def thermal_drift(recon_data):
     """
     Performs thermal drift correction on an image stack.
     Accepts a dictionary with 'imgs' and 'offsets' and returns an updated one.
+    The offsets are the last axis, so (rows, cols, slices, offsets) volumes are corrected slice by slice.
+    The image stack keeps its precision (float32 or float64).
     """
     THRESHOLD_PPM = 15
     images = recon_data['imgs']
+    dtype = images.dtype if images.dtype == np.float32 else np.float64
     offsets = recon_data['offsets']
     ref_index = np.where(offsets > THRESHOLD_PPM)[0]
-    m0 = images[:, :, ref_index]
+    m0 = images[..., ref_index]
     corrected_offsets = np.delete(offsets, ref_index)
-    corrected_images = np.delete(images, ref_index, axis=2)
+    corrected_images = np.delete(images, ref_index, axis=-1)
     if np.size(ref_index) > 1:
-        # Interpolation logic
-        m0_indices = ref_index
-        points = (np.arange(images.shape[0]), np.arange(images.shape[1]), m0_indices)
-        # 2. The query points are the indices of the 'corrected' images
-        all_indices = np.arange(len(offsets))
-        corrected_indices = np.delete(all_indices, ref_index)
-        # 3. Create the meshgrid of query points
-        xi, yi, fi = np.meshgrid(np.arange(images.shape[0]), np.arange(images.shape[1]), corrected_indices, indexing='ij')
-        query_points = np.stack((xi, yi, fi), axis=-1)
-        # 4. Interpolate m0 data at the query points
+        # Interpolate the M0 drift between reference scans at the frame index of every saturated image
+        corrected_indices = np.delete(np.arange(len(offsets)), ref_index)
         try:
-            m0_interp = interpn(points, m0, query_points)
+            m0_interp = interp_reference(m0, ref_index, corrected_indices).astype(dtype, copy=False)
         except ValueError:
             st_functions.message_logging(
                         f"Interpolation failed. Falling back to normalization by single $S_0$ image.",
                         msg_type='warning'
                     )
-            corrected_images = np.nan_to_num(corrected_images / m0[:, :, 0][..., np.newaxis])
+            corrected_images = np.nan_to_num(corrected_images / m0[..., 0][..., np.newaxis]).astype(dtype, copy=False)
             return {
                 "imgs": corrected_images, "offsets": corrected_offsets,
-                "m0": np.squeeze(m0[:, :, 0])
+                "m0": m0[..., 0]
             }
-        corrected_images = np.nan_to_num(corrected_images / m0_interp)
+        corrected_images = np.nan_to_num(corrected_images / m0_interp).astype(dtype, copy=False)
         return {
             "imgs": corrected_images, "offsets": corrected_offsets,
-            "m0": m0[:, :, 0], "m0_final": m0[:, :, -1], "m0_interp": m0_interp
+            "m0": m0[..., 0], "m0_final": m0[..., -1], "m0_interp": m0_interp
         }
     else:
         # Simple normalization
-        corrected_images = np.nan_to_num(corrected_images / m0)
+        corrected_images = np.nan_to_num(corrected_images / m0).astype(dtype, copy=False)
         return {
             "imgs": corrected_images, "offsets": corrected_offsets,
-            "m0": np.squeeze(m0[:, :, 0])
+            "m0": m0[..., 0]
         }
 
+# --- Multi-slice helpers --- #
+def slice_count(imgs):
+    """
+    Number of slices in a (rows, cols, offsets) or (rows, cols, slices, offsets) stack.
+    """
+    return imgs.shape[2] if imgs.ndim == 4 else 1
+
+def select_slice(study, index, n_slices=None):
+    """
+    Single-slice copy of a dictionary of multi-slice arrays (e.g. thermal_drift output or quick-look maps).
+    Arrays with a slice axis (axis 2) are indexed; offsets and other entries are shared.
+    n_slices defaults to the slice count of study['imgs'].
+    """
+    n_slices = slice_count(study['imgs']) if n_slices is None else n_slices
+    if n_slices == 1:
+        return study
+    return {key: value[:, :, index] if isinstance(value, np.ndarray) and value.ndim >= 3 and value.shape[2] == n_slices else value
+            for key, value in study.items()}
+
+def preview_image(image_stack):
+    """
+    First frame of an image stack, taken from the center slice for volumes.
+    """
+    image = image_stack[..., 0]
+    return image[:, :, image.shape[2] // 2] if image.ndim == 3 else image
+
 # --- Interactive UI functions --- #
 def show_rotation_ui(image_stack, exp_type):
     """
@@ -293,7 +346,7 @@ def show_rotation_ui(image_stack, exp_type):
     # 1. Select rotation and flip
     if st.session_state[rot_stage_key] == 'select_transform':
         fig, ax = plt.subplots()
-        ax.imshow(image_stack[:, :, 0], cmap='gray')
+        ax.imshow(preview_image(image_stack), cmap='gray')
         ax.axis('off')
         st.pyplot(fig, use_container_width=False)
         selected_k = st.selectbox(
@@ -322,7 +375,7 @@ def show_rotation_ui(image_stack, exp_type):
             transformed_img = flip_image_stack_vertically(transformed_img)
         st.write("Is this orientation correct?")
         fig, ax = plt.subplots()
-        ax.imshow(transformed_img[:, :, 0], cmap='gray')
+        ax.imshow(preview_image(transformed_img), cmap='gray')
         ax.axis('off')
         st.pyplot(fig)
         col1, col2 = st.columns(2)
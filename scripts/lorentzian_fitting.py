@@ -0,0 +1,714 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 16 11:02:17 2026
+
+@author: jonah
+
+Lorentzian models and the two-step fit. This module must not import Streamlit,
+so that process pool workers can load it on their own.
+"""
+from functools import lru_cache
+from dataclasses import dataclass
+import numpy as np
+from sklearn.metrics import mean_squared_error
+from scipy.optimize import curve_fit, nnls
+from scripts import batch_fitting, lorentzian_kernels
+
+# --- Curve fitting parameters. Feel free to modify, results not guaranteed. --- #
+###Pre-correction###
+##Starting points for curve fitting: amplitude, FWHM, peak center##
+p0_water = [0.8, 1.8, 0]
+p0_mt = [0.15, 40, -1]
+##Lower bounds for curve fitting##
+lb_water = [0.02, 0.3, -10]
+lb_mt = [0.0, 30, -2.5]
+##Upper bounds for curve fitting##
+ub_water = [1, 10, 10]
+ub_mt = [0.5, 60, 0]
+
+##Combine for curve fitting##
+#B0 correction (tissue)
+p0_corr = p0_water + p0_mt
+lb_corr = lb_water + lb_mt
+ub_corr = ub_water + ub_mt 
+#B0 correction (phantom)
+p0_corr_ph = p0_water
+lb_corr_ph = lb_water
+ub_corr_ph = ub_water
+
+###Post-correction###
+##Starting points for curve fitting: amplitude, FWHM, peak center##
+p0_water = [0.8, 0.2, 0]
+p0_mt = [0.15, 40, -1]
+p0_noe = [0.05, 1, -3.50]
+p0_noe_neg_1_6 = [0.05, 1, -1.6]
+p0_creatine = [0.05, 0.5, 2.0]
+p0_amide = [0.05, 1.5, 3.5]
+p0_amine = [0.05, 1.5, 2.5]
+p0_hydroxyl = [0.05, 1.5, 0.6]
+p0_salicylic = [0.05, 1.5, 9.3]
+##Lower bounds for curve fitting##
+lb_water = [0.02, 0.01, -1e-6]
+lb_mt = [0.0, 30, -2.5]
+lb_noe = [0.0, 0.5, -4.0]
+lb_noe_neg_1_6 = [0.0, 0.5, -1.8]
+lb_creatine = [0.0, 0.5, 1.6]
+lb_amide = [0.0, 0.5, 3.2]
+lb_amine = [0.0, 0.1, 2.2]
+lb_hydroxyl = [0.0, 0.1, 0.4]
+lb_salicylic = [0.0, 0.5, 8.0]
+##Upper bounds for curve fitting##
+ub_water = [1, 10, 1e-6]
+ub_mt = [0.5, 60, 0]
+ub_noe = [0.25, 5, -1.5]
+ub_noe_neg_1_6 = [.25, 5, -1.2]
+ub_creatine = [0.5, 5, 2.6]
+ub_amide = [0.3, 5, 4.0]
+ub_amine = [0.3, 5, 2.8]
+ub_hydroxyl = [0.3, 5, 1.2]
+ub_salicylic = [0.3, 5, 10.0]
+
+##Combine for curve fitting##
+#Step 1
+p0_1 = p0_water + p0_mt
+lb_1 = lb_water + lb_mt
+ub_1 = ub_water + ub_mt 
+#Step 2 (cardiac)
+p0_2 = p0_noe + p0_creatine + p0_amide
+lb_2 = lb_noe + lb_creatine + lb_amide
+ub_2 = ub_noe + ub_creatine + ub_amide
+#Single step (Cr phantom)
+p0_ph = p0_water + p0_creatine
+lb_ph = lb_water + lb_creatine
+ub_ph = ub_water + ub_creatine
+
+###Cutoffs and options for fitting###
+cutoffs = [-4, -1.4, 1.4, 4]
+options = {'xtol': 1e-10, 'ftol': 1e-4, 'maxfev': 50}
+use_analytic_jac = True # Closed-form Jacobians instead of finite differences
+use_nnls_init = True # Seed cold step 2 fits from a non-negative least-squares fit over a Lorentzian basis
+nnls_widths = [0.5, 1, 2, 4] # Candidate FWHMs (ppm) for the basis, clipped to each pool's bounds
+
+###Contrast lookup for step 2###
+default_contrasts = ['Amide', 'Creatine', 'NOE (-3.5 ppm)', 'NOE (-1.6 ppm)']
+contrast_params = {
+    'NOE (-3.5 ppm)': (p0_noe, lb_noe, ub_noe),
+    'Creatine': (p0_creatine, lb_creatine, ub_creatine),
+    'Amide': (p0_amide, lb_amide, ub_amide),
+    'Amine': (p0_amine, lb_amine, ub_amine),
+    'Hydroxyl': (p0_hydroxyl, lb_hydroxyl, ub_hydroxyl),
+    'NOE (-1.6 ppm)': (p0_noe_neg_1_6, lb_noe_neg_1_6, ub_noe_neg_1_6),
+    'Salicylic acid': (p0_salicylic, lb_salicylic, ub_salicylic)
+}
+
+# --- Fit configuration --- #
+@dataclass(frozen=True)
+class FitConfig:
+    """
+    Immutable starting points, bounds, cutoffs and optimizer options for the two-step and WASSR fits.
+    Defaults come from the module-level parameters above. Use dataclasses.replace for variants
+    instead of editing module globals, so concurrent fits never see each other's settings.
+    """
+    p0_corr: tuple = tuple(p0_corr)
+    lb_corr: tuple = tuple(lb_corr)
+    ub_corr: tuple = tuple(ub_corr)
+    p0_1: tuple = tuple(p0_1)
+    lb_1: tuple = tuple(lb_1)
+    ub_1: tuple = tuple(ub_1)
+    contrast_params: tuple = tuple((name, tuple(tuple(values) for values in params)) for name, params in contrast_params.items())
+    cutoffs: tuple = tuple(cutoffs)
+    hydroxyl_cutoff: float = 0.4 # Replaces cutoffs[2] when Hydroxyl is fit
+    rmse_cutoffs: tuple = (-4, -1.4, 1.4, 4)
+    xtol: float = options['xtol']
+    ftol: float = options['ftol']
+    maxfev: int = options['maxfev']
+    use_analytic_jac: bool = use_analytic_jac
+    use_nnls_init: bool = use_nnls_init
+    nnls_widths: tuple = tuple(nnls_widths)
+
+    @property
+    def options(self):
+        return {'xtol': self.xtol, 'ftol': self.ftol, 'maxfev': self.maxfev}
+
+    def step_1_cutoffs(self, custom_contrasts):
+        """
+        Step 1 cutoffs for a contrast selection. Hydroxyl sits close to water, so its inner cutoff is lower.
+        """
+        if 'Hydroxyl' in custom_contrasts:
+            return self.cutoffs[:2] + (self.hydroxyl_cutoff,) + self.cutoffs[3:]
+        return self.cutoffs
+
+default_config = FitConfig()
+
+# --- Model definitions --- #
+def lorentzian(x, amp, fwhm, offset):
+    # fwhm * fwhm rather than fwhm ** 2: Python's scalar pow is not always correctly rounded
+    num = amp * 0.25 * (fwhm * fwhm)
+    den = 0.25 * (fwhm * fwhm) + (x - offset) ** 2
+    return num / den
+
+def step_1_fit(x, *fit_parameters):
+    if lorentzian_kernels.enabled():
+        return lorentzian_kernels.lorentzian_sum(x, fit_parameters[0:6], 1.0, -1.0)
+    water_fit = lorentzian(x, fit_parameters[0], fit_parameters[1], fit_parameters[2])
+    mt_fit = lorentzian(x, fit_parameters[3], fit_parameters[4], fit_parameters[5])
+    fit = 1 - water_fit - mt_fit
+    return fit
+
+def water_fit_correction(x, *fit_parameters):
+    if lorentzian_kernels.enabled():
+        return lorentzian_kernels.lorentzian_sum(x, fit_parameters[0:3], 1.0, -1.0)
+    water_fit = lorentzian(x, fit_parameters[0], fit_parameters[1], fit_parameters[2])
+    fit = 1 - water_fit
+    return fit
+
+def step_2_fit(x, *fit_parameters):
+    if lorentzian_kernels.enabled():
+        return lorentzian_kernels.lorentzian_sum(x, fit_parameters)
+    fit_sum = np.zeros_like(x, dtype=float)
+    for index in range(0, len(fit_parameters), 3):
+        fit_sum += lorentzian(x, fit_parameters[index], fit_parameters[index + 1], fit_parameters[index + 2])
+    return fit_sum
+
+# --- Analytic Jacobians (columns follow the parameter order) --- #
+def lorentzian_jac(x, amp, fwhm, offset):
+    q = 0.25 * (fwhm * fwhm)
+    d = x - offset
+    den = q + d ** 2
+    return np.stack([q / den, amp * 0.5 * fwhm * d ** 2 / den ** 2, amp * 2 * q * d / den ** 2], axis=-1)
+
+def step_1_jac(x, *fit_parameters):
+    if lorentzian_kernels.enabled():
+        return lorentzian_kernels.lorentzian_jac(x, fit_parameters[0:6], -1.0)
+    return -np.hstack([lorentzian_jac(x, *fit_parameters[0:3]), lorentzian_jac(x, *fit_parameters[3:6])])
+
+def water_fit_correction_jac(x, *fit_parameters):
+    if lorentzian_kernels.enabled():
+        return lorentzian_kernels.lorentzian_jac(x, fit_parameters[0:3], -1.0)
+    return -lorentzian_jac(x, *fit_parameters[0:3])
+
+def step_2_jac(x, *fit_parameters):
+    if lorentzian_kernels.enabled():
+        return lorentzian_kernels.lorentzian_jac(x, fit_parameters)
+    return np.hstack([lorentzian_jac(x, *fit_parameters[index:index + 3]) for index in range(0, len(fit_parameters), 3)])
+
+def jacobian_for(model_jac, config=default_config):
+    """
+    Returns the analytic Jacobian for curve_fit, or None to fall back to finite differences.
+    """
+    return model_jac if config.use_analytic_jac else None
+
+# --- Batched model definitions (params are (n_spectra, n_params)) --- #
+def batch_step_1_fit(x, params):
+    return 1 - batch_fitting.multi_lorentzian(x, params)
+
+def batch_step_1_jac(x, params):
+    return -batch_fitting.multi_lorentzian_jac(x, params)
+
+# --- Two-step fitting --- #
+def contrast_bounds(custom_contrasts, config=default_config):
+    """
+    Combines starting points and bounds for the selected step 2 contrasts.
+    """
+    params = dict(config.contrast_params)
+    p0_2, lb_2, ub_2 = [], [], []
+    for contrast in custom_contrasts:
+        p0_2 += params[contrast][0]
+        lb_2 += params[contrast][1]
+        ub_2 += params[contrast][2]
+    return p0_2, lb_2, ub_2
+
+# --- Linear (NNLS) step 2 initializer --- #
+@lru_cache(maxsize=64)
+def _nnls_columns(custom_contrasts, config):
+    p0_2, lb_2, ub_2 = contrast_bounds(custom_contrasts, config)
+    pools, widths, centers = [], [], []
+    for pool in range(len(custom_contrasts)):
+        candidates = np.unique(np.clip(config.nnls_widths + (p0_2[3 * pool + 1],), lb_2[3 * pool + 1], ub_2[3 * pool + 1]))
+        pools += [pool] * len(candidates)
+        widths += list(candidates)
+        centers += [p0_2[3 * pool + 2]] * len(candidates)
+    return np.array(pools), np.array(widths), np.array(centers)
+
+def nnls_basis(offsets_corrected, custom_contrasts, config=default_config):
+    """
+    Unit-amplitude Lorentzians at each contrast's starting center, one column per candidate width.
+    Returns the (n_offsets, n_columns) basis with the pool index and FWHM of every column.
+    The columns (pool, width, center) only depend on the contrasts and are built once; evaluating them on
+    a pixel's corrected offsets is the same as shifting the centers by its B0 correction.
+    """
+    pools, widths, centers = _nnls_columns(tuple(custom_contrasts), config)
+    basis = lorentzian(np.asarray(offsets_corrected, dtype=float)[:, np.newaxis], 1.0, widths, centers)
+    return basis, pools, widths
+
+def nnls_start(offsets_corrected, lorentzian_difference, custom_contrasts, config=default_config):
+    """
+    Step 2 starting point from a non-negative least-squares fit of the Lorentzian difference on nnls_basis.
+    Each pool's amplitude is the summed weight of its columns and its FWHM the weighted mean width.
+    Pools without weight keep their default starting point.
+    """
+    p0_2, lb_2, ub_2 = contrast_bounds(custom_contrasts, config)
+    basis, pools, widths = nnls_basis(offsets_corrected, custom_contrasts, config)
+    weights, _ = nnls(basis, np.nan_to_num(lorentzian_difference))
+    start = np.array(p0_2, dtype=float)
+    amps = np.bincount(pools, weights, minlength=len(custom_contrasts))
+    fwhms = np.bincount(pools, weights * widths, minlength=len(custom_contrasts))
+    found = amps > 0
+    start[0::3][found] = amps[found]
+    start[1::3][found] = fwhms[found] / amps[found]
+    return np.clip(start, lb_2, ub_2)
+
+def fit_regions(offsets_corrected, custom_contrasts, config=default_config):
+    """
+    Returns the step 1 fitting region and the RMSE region for B0 corrected offsets.
+    Works elementwise, so a (n_pixels, n_offsets) array of offsets is also accepted.
+    """
+    cutoffs = config.step_1_cutoffs(custom_contrasts)
+    rmse_cutoffs = config.rmse_cutoffs
+    condition = (offsets_corrected <= cutoffs[0]) | (offsets_corrected >= cutoffs[3]) | \
+                ((offsets_corrected >= cutoffs[1]) & (offsets_corrected <= cutoffs[2]))
+    condition_rmse = ((offsets_corrected <= rmse_cutoffs[1]) & (offsets_corrected >= rmse_cutoffs[0])) | \
+                     ((offsets_corrected >= rmse_cutoffs[2]) & (offsets_corrected <= rmse_cutoffs[3]))
+    return condition, condition_rmse
+
+def package_fit(spectrum, offsets, offsets_corrected, fit_1, fit_2, custom_contrasts, iterations=np.nan, n_interp=4000, config=default_config):
+    """
+    Builds the two_step output dictionary from converged step 1 and step 2 parameters.
+    Iterations is the total number of optimizer evaluations used for the spectrum.
+    """
+    _, condition_rmse = fit_regions(offsets_corrected, custom_contrasts, config)
+    offsets_interp = np.linspace(offsets_corrected[0], offsets_corrected[-1], n_interp)
+    water_fit = lorentzian(offsets_interp, fit_1[0], fit_1[1], fit_1[2])
+    mt_fit = lorentzian(offsets_interp, fit_1[3], fit_1[4], fit_1[5])
+    background = lorentzian(offsets_corrected, fit_1[0], fit_1[1], fit_1[2]) + \
+                 lorentzian(offsets_corrected, fit_1[3], fit_1[4], fit_1[5])
+    lorentzian_difference = 1 - (spectrum + background)
+    step_1_fit_values = step_1_fit(offsets_corrected, *fit_1)
+    fit_curves = {}
+    step_2_fit_values = np.zeros_like(offsets_corrected)
+    index = 0
+    for contrast in custom_contrasts:
+        fit_curves[contrast] = lorentzian(offsets_interp, fit_2[index], fit_2[index + 1], fit_2[index + 2])
+        step_2_fit_values += lorentzian(offsets_corrected, fit_2[index], fit_2[index + 1], fit_2[index + 2])
+        index += 3
+    total_fit = step_1_fit_values - step_2_fit_values
+    spectrum_region = spectrum[condition_rmse]
+    total_fit_region = total_fit[condition_rmse]
+    if lorentzian_kernels.enabled():
+        n_points, _, total_sq = lorentzian_kernels.residual_sums(spectrum, total_fit, condition_rmse)
+        rmse = np.sqrt(total_sq / n_points)
+    else:
+        rmse = np.sqrt(mean_squared_error(spectrum_region, total_fit_region))
+    offsets_interp = np.flip(offsets_interp)
+    water_fit = np.flip(water_fit)
+    mt_fit = np.flip(mt_fit)
+    fit_curves_named = {f"{contrast}_Fit": np.flip(fit_curves[contrast]) for contrast in fit_curves}
+    contrasts = {'Water': 100 * fit_1[0], 'MT': 100 * fit_1[3]}
+    for i, contrast in enumerate(custom_contrasts):
+        contrasts[contrast] = 100 * fit_2[i * 3]
+    data_dict = {'Zspec': spectrum, 'Offsets': offsets, 'Offsets_Corrected': offsets_corrected,
+                 'Offsets_Interp': offsets_interp, 'Water_Fit': water_fit, 'MT_Fit': mt_fit,
+                 **fit_curves_named, 'Lorentzian_Difference': lorentzian_difference}
+    return {'Fit_Params': [fit_1, fit_2], 'Data_Dict': data_dict,
+            'Contrasts': contrasts, 'Residuals': spectrum_region - total_fit_region, 'RMSE': rmse,
+            'Iterations': iterations}
+
+def failed_fit(spectrum, offsets, custom_contrasts, n_interp=4000, config=default_config):
+    """
+    Zero-filled two_step output for spectra that could not be fit.
+    """
+    p0_2, _, _ = contrast_bounds(custom_contrasts, config)
+    fit_parameters = [np.zeros(len(config.p0_1)), np.zeros(len(p0_2))]
+    contrasts = {key: 0 for key in ['Water', 'MT'] + custom_contrasts}
+    data_dict = {'Zspec': spectrum, 'Offsets': offsets, 'Offsets_Corrected': np.zeros_like(offsets),
+                 'Offsets_Interp': np.zeros(n_interp), 'Water_Fit': np.zeros(n_interp), 'MT_Fit': np.zeros(n_interp),
+                 'Lorentzian_Difference': np.zeros(n_interp), **{f"{contrast}_Fit": np.zeros(n_interp) for contrast in custom_contrasts}}
+    return {'Fit_Params': fit_parameters, 'Data_Dict': data_dict,
+            'Contrasts': contrasts, 'Residuals': np.array([]), 'RMSE': np.inf,
+            'Iterations': np.nan}
+
+def fit_b0_shift(fit):
+    """
+    B0 correction (ppm) used by a two_step fit, NaN for failed fits.
+    """
+    if not np.isfinite(fit['RMSE']):
+        return np.nan
+    data_dict = fit['Data_Dict']
+    return data_dict['Offsets'][0] - data_dict['Offsets_Corrected'][0]
+
+# --- Compact (parameter-only) pixel results --- #
+def compact_batch(spectra, offsets, offsets_corrected, fit_1, fit_2, ok, iterations, custom_contrasts, config=default_config):
+    """
+    Parameter-only results for a stack of spectra: fit parameters, B0 correction, RMSE and residual statistics.
+    Interpolated curves are not stored; expand_pixel_fit regenerates them for a single pixel.
+    """
+    _, condition_rmse = fit_regions(offsets_corrected, custom_contrasts, config)
+    total_fit = 1 - batch_fitting.multi_lorentzian(offsets_corrected, fit_1) - batch_fitting.multi_lorentzian(offsets_corrected, fit_2)
+    if lorentzian_kernels.enabled():
+        n_points, total, total_sq = lorentzian_kernels.residual_sums(spectra, total_fit, condition_rmse)
+    else:
+        residuals = np.where(condition_rmse, spectra - total_fit, 0.0)
+        n_points, total, total_sq = np.sum(condition_rmse, axis=1), np.sum(residuals, axis=1), np.sum(residuals ** 2, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        residual_mean = total / n_points
+        rmse = np.sqrt(total_sq / n_points)
+        residual_std = np.sqrt(np.maximum(rmse ** 2 - residual_mean ** 2, 0))
+    ok = ok & (n_points > 0)
+    return {
+        'Offsets': offsets, 'Contrast_Names': list(custom_contrasts), 'Zspec': spectra,
+        'Fit_Params_1': np.where(ok[:, np.newaxis], fit_1, 0.0), 'Fit_Params_2': np.where(ok[:, np.newaxis], fit_2, 0.0),
+        'Correction': np.where(ok, offsets[0] - offsets_corrected[:, 0], np.nan),
+        'RMSE': np.where(ok, rmse, np.inf), 'Residual_Mean': np.where(ok, residual_mean, np.nan),
+        'Residual_Std': np.where(ok, residual_std, np.nan), 'Iterations': np.where(ok, iterations, np.nan),
+    }
+
+def slim_fit(fit):
+    """
+    Drops the interpolated curves from a two_step result, keeping what compact_fits needs.
+    """
+    data_dict = fit['Data_Dict']
+    return {**fit, 'Data_Dict': {key: data_dict[key] for key in ('Zspec', 'Offsets', 'Offsets_Corrected')}}
+
+def compact_fits(fits):
+    """
+    Collapses a list of two_step (or slim_fit) results into the compact_batch layout.
+    """
+    contrast_names = [name for name in fits[0]['Contrasts'] if name not in ('Water', 'MT')]
+    offsets = next((fit['Data_Dict']['Offsets'] for fit in fits if np.isfinite(fit['RMSE'])), fits[0]['Data_Dict']['Offsets'])
+    correction, residual_mean, residual_std = [], [], []
+    for fit in fits:
+        data_dict = fit['Data_Dict']
+        failed = not np.isfinite(fit['RMSE'])
+        correction.append(np.nan if failed else data_dict['Offsets'][0] - data_dict['Offsets_Corrected'][0])
+        residual_mean.append(np.nan if failed else np.mean(fit['Residuals']))
+        residual_std.append(np.nan if failed else np.std(fit['Residuals']))
+    return {
+        'Offsets': offsets, 'Contrast_Names': contrast_names,
+        'Zspec': np.array([fit['Data_Dict']['Zspec'] for fit in fits]),
+        'Fit_Params_1': np.array([fit['Fit_Params'][0] for fit in fits], dtype=float),
+        'Fit_Params_2': np.array([fit['Fit_Params'][1] for fit in fits], dtype=float),
+        'Correction': np.array(correction), 'RMSE': np.array([fit['RMSE'] for fit in fits], dtype=float),
+        'Residual_Mean': np.array(residual_mean), 'Residual_Std': np.array(residual_std),
+        'Iterations': np.array([fit['Iterations'] for fit in fits], dtype=float),
+    }
+
+def concat_compact(parts):
+    """
+    Joins compact results from several blocks or chunks of the same label.
+    """
+    merged = {'Offsets': parts[0]['Offsets'], 'Contrast_Names': parts[0]['Contrast_Names']}
+    for key in parts[0]:
+        if key not in merged:
+            merged[key] = np.concatenate([part[key] for part in parts])
+    return merged
+
+def failed_compact(spectra, offsets, custom_contrasts, config=default_config):
+    """
+    Zero-filled compact result for spectra that are not fit. offsets and spectra must already be in ascending order.
+    """
+    return compact_fits([failed_fit(spectrum, offsets, custom_contrasts, config=config) for spectrum in spectra])
+
+def merge_compact(parts, order):
+    """
+    Joins compact results for disjoint subsets of pixels back into the original pixel order.
+    order holds the original indices of each part's pixels.
+    """
+    merged = concat_compact(parts)
+    position = np.argsort(np.concatenate(order))
+    for key in merged:
+        if key not in ('Offsets', 'Contrast_Names'):
+            merged[key] = merged[key][position]
+    return merged
+
+def compact_contrasts(compact):
+    """
+    Contrast values (%) for every pixel of a compact result, keyed like two_step 'Contrasts'.
+    """
+    contrasts = {'Water': 100 * compact['Fit_Params_1'][:, 0], 'MT': 100 * compact['Fit_Params_1'][:, 3]}
+    for i, contrast in enumerate(compact['Contrast_Names']):
+        contrasts[contrast] = 100 * compact['Fit_Params_2'][:, i * 3]
+    return contrasts
+
+def expand_pixel_fit(compact, index, config=default_config):
+    """
+    Regenerates the full two_step output (including interpolated curves) for one pixel of a compact result.
+    """
+    spectrum = compact['Zspec'][index]
+    offsets = compact['Offsets']
+    if not np.isfinite(compact['RMSE'][index]):
+        return failed_fit(spectrum, offsets, compact['Contrast_Names'], config=config)
+    offsets_corrected = offsets - compact['Correction'][index]
+    return package_fit(spectrum, offsets, offsets_corrected, compact['Fit_Params_1'][index],
+                       compact['Fit_Params_2'][index], compact['Contrast_Names'], compact['Iterations'][index], config=config)
+
+# --- Warm starts --- #
+def seed_from_fit(fit, config=default_config):
+    """
+    Converts a converged two_step result into (p0_corr, p0_1, p0_2) starting points.
+    Returns None for failed fits.
+    """
+    if not np.isfinite(fit['RMSE']):
+        return None
+    fit_1, fit_2 = fit['Fit_Params']
+    data_dict = fit['Data_Dict']
+    correction = data_dict['Offsets'][0] - data_dict['Offsets_Corrected'][0]
+    seed_corr = [fit_1[0], fit_1[1], correction, fit_1[3], fit_1[4], fit_1[5] + correction]
+    return (np.clip(seed_corr, config.lb_corr, config.ub_corr), np.clip(fit_1, config.lb_1, config.ub_1),
+            np.asarray(fit_2, dtype=float))
+
+def stack_seeds(seeds, custom_contrasts, config=default_config):
+    """
+    Stacks per-pixel seeds into (n_pixels, n_params) starting points for two_step_batch.
+    Pixels without a seed start from the global defaults.
+    """
+    if custom_contrasts is None:
+        custom_contrasts = default_contrasts
+    p0_2, _, _ = contrast_bounds(custom_contrasts, config)
+    defaults = (config.p0_corr, config.p0_1, p0_2)
+    return tuple(np.array([seed[k] if seed is not None else defaults[k] for seed in seeds], dtype=float)
+                 for k in range(3))
+
+def two_step(spectrum, offsets, custom_contrasts = None, warm_start = None, b0_shift = None, config = default_config):
+    """
+    Performs the two-step Lorentzian fitting on a single spectrum.
+    This is the core fitting logic.
+    warm_start is an optional (p0_corr, p0_1, p0_2) tuple from seed_from_fit.
+    Cold starts seed step 2 from nnls_start unless config.use_nnls_init is off.
+    b0_shift (ppm, e.g. from WASSR) replaces the B0 pre-fit when it is finite.
+    config is the FitConfig with starting points, bounds, cutoffs and optimizer options.
+    """
+    if custom_contrasts is None:
+        custom_contrasts = default_contrasts
+    p0_2, lb_2, ub_2 = contrast_bounds(custom_contrasts, config)
+    start_corr, start_1, start_2 = warm_start if warm_start is not None else (config.p0_corr, config.p0_1, p0_2)
+    options = config.options
+    try:
+        if offsets[0] > 0:
+            offsets = np.flip(offsets)
+            spectrum = np.flip(spectrum)
+        if b0_shift is not None and np.isfinite(b0_shift):
+            correction, nfev_corr = b0_shift, 0
+        else:
+            fit_corr, _, info_corr, _, _ = curve_fit(step_1_fit, offsets, spectrum, p0=start_corr, bounds=(config.lb_corr, config.ub_corr),
+                                                     jac=jacobian_for(step_1_jac, config), full_output=True, **options)
+            correction, nfev_corr = fit_corr[2], info_corr['nfev']
+        offsets_corrected = offsets - correction
+        condition, _ = fit_regions(offsets_corrected, custom_contrasts, config)
+        offsets_cropped = offsets_corrected[condition]
+        spectrum_cropped = spectrum[condition]
+        if len(offsets_cropped) == 0:  # Handle empty offsets case
+            raise RuntimeError("No valid offsets found after cropping")
+        fit_1, _, info_1, _, _ = curve_fit(step_1_fit, offsets_cropped, spectrum_cropped, p0=start_1, bounds=(config.lb_1, config.ub_1),
+                                           jac=jacobian_for(step_1_jac, config), full_output=True, **options)
+        background = lorentzian(offsets_corrected, fit_1[0], fit_1[1], fit_1[2]) + \
+                     lorentzian(offsets_corrected, fit_1[3], fit_1[4], fit_1[5])
+        lorentzian_difference = 1 - (spectrum + background)
+        if warm_start is None and config.use_nnls_init:
+            start_2 = nnls_start(offsets_corrected, lorentzian_difference, custom_contrasts, config)
+        fit_2, _, info_2, _, _ = curve_fit(step_2_fit, offsets_corrected, lorentzian_difference, p0=start_2, bounds=(lb_2, ub_2),
+                                           jac=jacobian_for(step_2_jac, config), full_output=True, **options)
+        iterations = nfev_corr + info_1['nfev'] + info_2['nfev']
+        return package_fit(spectrum, offsets, offsets_corrected, fit_1, fit_2, custom_contrasts, iterations, config=config)
+    except RuntimeError:
+        # Assign zeros instead of crashing
+        return failed_fit(spectrum, offsets, custom_contrasts, config=config)
+
+def two_step_batch(spectra, offsets, custom_contrasts = None, warm_start = None, compact = False, b0_shifts = None, config = default_config):
+    """
+    Performs the two-step Lorentzian fitting on a (n_pixels, n_offsets) stack of spectra at once.
+    Uses the batched Levenberg-Marquardt solver and returns the same output as two_step for each spectrum.
+    warm_start is an optional tuple of per-pixel starting points from stack_seeds; cold starts use the default p0.
+    The NNLS step 2 initializer is not used here: it runs per pixel and does not save batched evaluations.
+    With compact=True a single parameter-only result (see compact_batch) is returned instead.
+    b0_shifts (ppm per pixel) skips the B0 pre-fit for every pixel with a finite shift.
+    """
+    if custom_contrasts is None:
+        custom_contrasts = default_contrasts
+    p0_2, lb_2, ub_2 = contrast_bounds(custom_contrasts, config)
+    start_corr, start_1, start_2 = warm_start if warm_start is not None else (config.p0_corr, config.p0_1, p0_2)
+    spectra = np.asarray(spectra, dtype=float)
+    if offsets[0] > 0:
+        offsets = np.flip(offsets)
+        spectra = np.flip(spectra, axis=1)
+    n_pixels = spectra.shape[0]
+    lm_options = {'max_iter': config.maxfev, 'ftol': config.ftol, 'xtol': config.xtol}
+    # B0 pre-fit on the full spectrum, only where no external shift is given
+    correction = np.full(n_pixels, np.nan) if b0_shifts is None else np.array(b0_shifts, dtype=float)
+    ok = np.ones(n_pixels, dtype=bool)
+    iter_corr = np.zeros(n_pixels, dtype=int)
+    prefit = ~np.isfinite(correction)
+    if np.any(prefit):
+        x = np.broadcast_to(offsets, spectra[prefit].shape)
+        start = start_corr if np.ndim(start_corr) == 1 else np.asarray(start_corr)[prefit]
+        fit_corr, _, ok[prefit], iter_corr[prefit] = batch_fitting.levenberg_marquardt(
+            batch_step_1_fit, batch_step_1_jac, x, spectra[prefit], start, config.lb_corr, config.ub_corr, **lm_options)
+        correction[prefit] = fit_corr[:, 2]
+    offsets_corrected = offsets[np.newaxis, :] - correction[:, np.newaxis]
+    condition, _ = fit_regions(offsets_corrected, custom_contrasts, config)
+    ok &= np.any(condition, axis=1)
+    # Step 1: water + MT on the cropped region only
+    fit_1, _, ok_1, iter_1 = batch_fitting.levenberg_marquardt(
+        batch_step_1_fit, batch_step_1_jac, offsets_corrected, spectra, start_1, config.lb_1, config.ub_1,
+        weights=condition.astype(float), **lm_options)
+    ok &= ok_1
+    background = batch_fitting.multi_lorentzian(offsets_corrected, fit_1)
+    lorentzian_difference = 1 - (spectra + background)
+    # Step 2: selected contrasts on the Lorentzian difference
+    fit_2, _, ok_2, iter_2 = batch_fitting.levenberg_marquardt(
+        batch_fitting.multi_lorentzian, batch_fitting.multi_lorentzian_jac, offsets_corrected,
+        lorentzian_difference, start_2, lb_2, ub_2, **lm_options)
+    ok &= ok_2
+    iterations = iter_corr + iter_1 + iter_2
+    if compact:
+        return compact_batch(spectra, offsets, offsets_corrected, fit_1, fit_2, ok, iterations, custom_contrasts, config)
+    fits = []
+    for i in range(n_pixels):
+        if ok[i]:
+            fits.append(package_fit(spectra[i], offsets, offsets_corrected[i], fit_1[i], fit_2[i], custom_contrasts, iterations[i], config=config))
+        else:
+            fits.append(failed_fit(spectra[i], offsets, custom_contrasts, config=config))
+    return fits
+
+# --- Incremental contrast refits (step 2 only) --- #
+def needs_step_1(fitted_contrasts, custom_contrasts, config=default_config):
+    """
+    True when switching contrast sets changes the step 1 fitting region (Hydroxyl), so step 1 must be redone.
+    """
+    return config.step_1_cutoffs(fitted_contrasts) != config.step_1_cutoffs(custom_contrasts)
+
+def step_2_start(fit_2, fitted_contrasts, custom_contrasts, config=default_config):
+    """
+    Step 2 starting point for custom_contrasts. Pools that were already fit start from their converged values.
+    fit_2 may be a single parameter vector or a (n_pixels, n_params) stack.
+    """
+    p0_2, lb_2, ub_2 = contrast_bounds(custom_contrasts, config)
+    fit_2 = np.asarray(fit_2, dtype=float)
+    start = np.tile(np.asarray(p0_2, dtype=float), fit_2.shape[:-1] + (1,))
+    for i, contrast in enumerate(custom_contrasts):
+        if contrast in fitted_contrasts:
+            j = list(fitted_contrasts).index(contrast)
+            start[..., 3 * i:3 * i + 3] = fit_2[..., 3 * j:3 * j + 3]
+    return np.clip(start, lb_2, ub_2)
+
+def refit_contrasts(fit, custom_contrasts = None, config = default_config):
+    """
+    Refits only step 2 of a two_step result for a new contrast selection, reusing its B0 correction,
+    water/MT fit and Lorentzian difference. Failed fits and Hydroxyl changes fall back to a full two_step.
+    """
+    if custom_contrasts is None:
+        custom_contrasts = default_contrasts
+    fitted_contrasts = [name for name in fit['Contrasts'] if name not in ('Water', 'MT')]
+    data_dict = fit['Data_Dict']
+    if not np.isfinite(fit['RMSE']) or needs_step_1(fitted_contrasts, custom_contrasts, config):
+        b0_shift = data_dict['Offsets'][0] - data_dict['Offsets_Corrected'][0] if np.isfinite(fit['RMSE']) else None
+        return two_step(data_dict['Zspec'], data_dict['Offsets'], custom_contrasts, b0_shift=b0_shift, config=config)
+    fit_1, fit_2 = fit['Fit_Params']
+    _, lb_2, ub_2 = contrast_bounds(custom_contrasts, config)
+    start_2 = step_2_start(fit_2, fitted_contrasts, custom_contrasts, config)
+    try:
+        fit_2, _, info_2, _, _ = curve_fit(step_2_fit, data_dict['Offsets_Corrected'], data_dict['Lorentzian_Difference'], p0=start_2,
+                                           bounds=(lb_2, ub_2), jac=jacobian_for(step_2_jac, config), full_output=True, **config.options)
+    except RuntimeError:
+        return failed_fit(data_dict['Zspec'], data_dict['Offsets'], custom_contrasts, config=config)
+    return package_fit(data_dict['Zspec'], data_dict['Offsets'], data_dict['Offsets_Corrected'], fit_1, fit_2,
+                       custom_contrasts, info_2['nfev'], config=config)
+
+def refit_contrasts_batch(compact, custom_contrasts = None, config = default_config, exclude = None):
+    """
+    Step 2 only refit of a compact pixel result for a new contrast selection, using the batched solver.
+    Step 1 is redone (keeping the B0 correction) when the Hydroxyl cutoff changes; failed pixels get a full refit.
+    exclude marks pixels that stay zero-filled instead of being refit (e.g. excluded by SNR triage).
+    """
+    if custom_contrasts is None:
+        custom_contrasts = default_contrasts
+    fitted_contrasts = compact['Contrast_Names']
+    spectra, offsets = compact['Zspec'], compact['Offsets']
+    if exclude is not None and np.any(exclude):
+        skipped = np.flatnonzero(exclude)
+        kept = np.flatnonzero(~np.asarray(exclude))
+        parts, order = [failed_compact(spectra[skipped], offsets, custom_contrasts, config)], [skipped]
+        if kept.size:
+            subset = {key: value if key in ('Offsets', 'Contrast_Names') else value[kept] for key, value in compact.items()}
+            parts.insert(0, refit_contrasts_batch(subset, custom_contrasts, config))
+            order.insert(0, kept)
+        return merge_compact(parts, order)
+    if needs_step_1(fitted_contrasts, custom_contrasts, config):
+        return two_step_batch(spectra, offsets, custom_contrasts, compact=True, b0_shifts=compact['Correction'], config=config)
+    failed = ~np.isfinite(compact['RMSE'])
+    correction = np.where(failed, 0.0, compact['Correction'])
+    offsets_corrected = offsets[np.newaxis, :] - correction[:, np.newaxis]
+    fit_1 = compact['Fit_Params_1']
+    lorentzian_difference = 1 - (spectra + batch_fitting.multi_lorentzian(offsets_corrected, fit_1))
+    _, lb_2, ub_2 = contrast_bounds(custom_contrasts, config)
+    start_2 = step_2_start(compact['Fit_Params_2'], fitted_contrasts, custom_contrasts, config)
+    fit_2, _, ok, iterations = batch_fitting.levenberg_marquardt(
+        batch_fitting.multi_lorentzian, batch_fitting.multi_lorentzian_jac, offsets_corrected, lorentzian_difference,
+        start_2, lb_2, ub_2, max_iter=config.maxfev, ftol=config.ftol, xtol=config.xtol)
+    result = compact_batch(spectra, offsets, offsets_corrected, fit_1, fit_2, ok & ~failed, iterations, custom_contrasts, config)
+    if np.any(failed):
+        retry = two_step_batch(spectra[failed], offsets, custom_contrasts, compact=True, config=config)
+        for key, values in retry.items():
+            if key not in ('Offsets', 'Contrast_Names'):
+                result[key][failed] = values
+    return result
+
+# --- Pixel sequences and process pool workers --- #
+def fit_pixel_sequence(spectra, offsets, custom_contrasts, coords=None, seeds=None, callback=None, compact=False, b0_shifts=None, config=default_config):
+    """
+    Runs two_step over pixel spectra in scan-line order.
+    With coords, each pixel is seeded from an already converged left or upper neighbour,
+    otherwise from its entry in seeds (e.g. the ROI fit it belongs to).
+    callback is called with the number of pixels done after every fit.
+    With compact=True the parameter-only layout of compact_fits is returned.
+    b0_shifts optionally gives each pixel's B0 shift (ppm), see two_step.
+    """
+    fits = []
+    converged_seeds = {}
+    for i, spectrum in enumerate(spectra):
+        warm_start = None
+        if coords is not None:
+            y, x = coords[i]
+            warm_start = converged_seeds.get((y, x - 1)) or converged_seeds.get((y - 1, x))
+        if warm_start is None and seeds is not None:
+            warm_start = seeds[i]
+        fit = two_step(spectrum, offsets, custom_contrasts, warm_start, b0_shifts[i] if b0_shifts is not None else None, config)
+        if coords is not None:
+            seed = seed_from_fit(fit, config)
+            if seed is not None:
+                converged_seeds[(y, x)] = seed
+        fits.append(slim_fit(fit) if compact else fit)
+        if callback is not None:
+            callback(i + 1)
+    return compact_fits(fits) if compact else fits
+
+def fit_pixel_chunk(spectra, offsets, custom_contrasts, progress_queue=None, coords=None, seeds=None, compact=False, b0_shifts=None, config=default_config, report_every=10):
+    """
+    Runs fit_pixel_sequence on a chunk of pixel spectra inside a worker process.
+    Progress is sent back as pixel counts through progress_queue.
+    With compact=True only parameter arrays are sent back to the main process.
+    """
+    def report(n_done):
+        if progress_queue is not None and n_done % report_every == 0:
+            progress_queue.put(report_every)
+    fits = fit_pixel_sequence(spectra, offsets, custom_contrasts, coords, seeds, report, compact, b0_shifts, config)
+    if progress_queue is not None and len(spectra) % report_every:
+        progress_queue.put(len(spectra) % report_every)
+    return fits
+
+def fit_slice(spectra, offsets, custom_contrasts, engine='batched', seed=None, coords=None, b0_shifts=None, config=default_config, batch_size=1024):
+    """
+    Compact fits for all pixel spectra of one slice, run as a process pool job by cest_fitting.fit_volume.
+    engine='batched' fits blocks of batch_size spectra with two_step_batch; otherwise two_step runs
+    pixel by pixel, warm started from converged neighbours in coords. seed (from seed_from_fit) starts every pixel.
+    """
+    if engine == 'batched':
+        blocks = []
+        for start in range(0, len(spectra), batch_size):
+            block = spectra[start:start + batch_size]
+            block_start = stack_seeds([seed] * len(block), custom_contrasts, config) if seed is not None else None
+            block_shifts = b0_shifts[start:start + batch_size] if b0_shifts is not None else None
+            blocks.append(two_step_batch(block, offsets, custom_contrasts, block_start, True, block_shifts, config))
+        return concat_compact(blocks)
+    seeds = [seed] * len(spectra) if seed is not None else None
+    return fit_pixel_sequence(spectra, offsets, custom_contrasts, coords, seeds, compact=True, b0_shifts=b0_shifts, config=config)
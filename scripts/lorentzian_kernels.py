@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 09:41:18 2026
+
+@author: jonah
+
+Numba-compiled kernels for the multi-Lorentzian model, its Jacobian and the RMSE statistics.
+Numba is optional: lorentzian_fitting and batch_fitting use these kernels only when enabled() is True
+and otherwise keep their NumPy implementations. The arithmetic follows the NumPy code operation by
+operation, so model and Jacobian values are bit-identical; residual sums differ only in summation order.
+"""
+import numpy as np
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# --- Kernel options --- #
+use_numba = True # Use the compiled kernels when Numba is installed
+
+def enabled():
+    """
+    True when the compiled kernels are used.
+    """
+    return use_numba and numba is not None
+
+def jit(func):
+    """
+    numba.njit with on-disk caching, or the plain Python function when Numba is missing.
+    """
+    if numba is None:
+        return func
+    return numba.njit(cache=True, nogil=True)(func)
+
+# --- Compiled kernels (x is (n_spectra, n_offsets), params is (n_spectra, 3 * n_pools)) --- #
+@jit
+def _lorentzian_sum(x, params, baseline, sign):
+    n_spectra, n_offsets = x.shape
+    out = np.empty((n_spectra, n_offsets))
+    for i in range(n_spectra):
+        for j in range(n_offsets):
+            total = baseline
+            for k in range(0, params.shape[1], 3):
+                q = 0.25 * params[i, k + 1] ** 2
+                d = x[i, j] - params[i, k + 2]
+                total += sign * (params[i, k] * q / (q + d ** 2))
+            out[i, j] = total
+    return out
+
+@jit
+def _lorentzian_jac(x, params, sign):
+    n_spectra, n_offsets = x.shape
+    out = np.empty((n_spectra, params.shape[1], n_offsets))
+    for i in range(n_spectra):
+        for k in range(0, params.shape[1], 3):
+            amp, fwhm = params[i, k], params[i, k + 1]
+            q = 0.25 * fwhm ** 2
+            for j in range(n_offsets):
+                d = x[i, j] - params[i, k + 2]
+                den = q + d ** 2
+                out[i, k, j] = sign * (q / den)
+                out[i, k + 1, j] = sign * (amp * 0.5 * fwhm * d ** 2 / den ** 2)
+                out[i, k + 2, j] = sign * (amp * 2 * q * d / den ** 2)
+    return out
+
+@jit
+def _residual_sums(y, fit, mask):
+    n_spectra, n_offsets = y.shape
+    n_points = np.zeros(n_spectra)
+    total = np.zeros(n_spectra)
+    total_sq = np.zeros(n_spectra)
+    for i in range(n_spectra):
+        for j in range(n_offsets):
+            if mask[i, j]:
+                r = y[i, j] - fit[i, j]
+                n_points[i] += 1
+                total[i] += r
+                total_sq[i] += r * r
+    return n_points, total, total_sq
+
+# --- Wrappers (a single spectrum may be passed as 1D x and params) --- #
+def lorentzian_sum(x, params, baseline=0.0, sign=1.0):
+    """
+    baseline + sign * (sum of Lorentzian pools) for one spectrum or a batch of spectra.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    params = np.asarray(params, dtype=np.float64)
+    if x.ndim == 1:
+        return _lorentzian_sum(x[np.newaxis], params[np.newaxis], baseline, sign)[0]
+    return _lorentzian_sum(x, params, baseline, sign)
+
+def lorentzian_jac(x, params, sign=1.0):
+    """
+    Jacobian of sign * lorentzian_sum; (n_offsets, n_params) for one spectrum, (n_spectra, n_offsets, n_params) for a batch.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    params = np.asarray(params, dtype=np.float64)
+    # Parameters-by-offsets storage, transposed on return: the same memory layout as the NumPy
+    # Jacobians, so downstream einsum and least-squares solves also sum in the same order
+    if x.ndim == 1:
+        return np.ascontiguousarray(_lorentzian_jac(x[np.newaxis], params[np.newaxis], sign)[0].T)
+    return _lorentzian_jac(x, params, sign).transpose(0, 2, 1)
+
+def residual_sums(y, fit, mask):
+    """
+    Number of points, sum and sum of squares of y - fit inside mask, per spectrum.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    fit = np.asarray(fit, dtype=np.float64)
+    mask = np.asarray(mask, dtype=np.bool_)
+    if y.ndim == 1:
+        return tuple(values[0] for values in _residual_sums(y[np.newaxis], fit[np.newaxis], mask[np.newaxis]))
+    return _residual_sums(y, fit, mask)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 16 17:05:19 2026
+
+@author: jonah
+
+Struct-of-arrays container for pixelwise CEST fits.
+"""
+from dataclasses import dataclass
+import numpy as np
+from scripts.lorentzian_fitting import (compact_contrasts, concat_compact, package_fit, failed_fit,
+                                        refit_contrasts_batch, default_config)
+
+@dataclass
+class PixelFitResult:
+    """
+    Pixelwise two-step fits for every label, stored as contiguous per-pixel arrays.
+    Pixels of one label are stored next to each other, in np.argwhere(mask) order.
+    """
+    shape: tuple # (rows, cols) of the image the pixels come from
+    labels: list
+    label_index: np.ndarray # (n_pixels,) index into labels
+    coords: np.ndarray # (n_pixels, 2) row/col of each pixel
+    offsets: np.ndarray
+    contrast_names: list # Contrast columns, 'Water' and 'MT' first
+    zspec: np.ndarray # (n_pixels, n_offsets)
+    fit_params_1: np.ndarray # (n_pixels, 6) water + MT
+    fit_params_2: np.ndarray # (n_pixels, 3 * n_pools) step 2 pools
+    contrasts: np.ndarray # (n_pixels, n_contrasts) in %
+    correction: np.ndarray
+    rmse: np.ndarray
+    residual_mean: np.ndarray
+    residual_std: np.ndarray
+    iterations: np.ndarray
+    snr: np.ndarray = None # (n_pixels,) triage SNR, None when SNR triage was off
+
+    # --- Construction --- #
+    @classmethod
+    def from_compact(cls, compact_by_label, coords_by_label, shape):
+        """
+        Builds a result from fit_all_pixels(..., compact=True) output and the pixel coordinates of each label.
+        """
+        labels = [label for label in compact_by_label if len(compact_by_label[label]['RMSE'])]
+        if not labels:
+            raise ValueError("No pixelwise fits to collect.")
+        merged = concat_compact([compact_by_label[label] for label in labels])
+        counts = [len(compact_by_label[label]['RMSE']) for label in labels]
+        return cls._from_merged(merged, shape, labels, np.repeat(np.arange(len(labels)), counts),
+                                np.concatenate([np.asarray(coords_by_label[label]).reshape(-1, 2) for label in labels]))
+
+    @classmethod
+    def _from_merged(cls, merged, shape, labels, label_index, coords, snr=None):
+        contrasts = compact_contrasts(merged)
+        return cls(
+            shape=tuple(shape), labels=labels, label_index=label_index, coords=coords,
+            offsets=merged['Offsets'], contrast_names=list(contrasts),
+            zspec=merged['Zspec'], fit_params_1=merged['Fit_Params_1'], fit_params_2=merged['Fit_Params_2'],
+            contrasts=np.column_stack(list(contrasts.values())),
+            correction=merged['Correction'], rmse=merged['RMSE'], residual_mean=merged['Residual_Mean'],
+            residual_std=merged['Residual_Std'], iterations=merged['Iterations'], snr=merged.get('SNR', snr))
+
+    def with_fits(self, compact):
+        """
+        Result for the same pixels and labels with other compact fits (e.g. another saturation power).
+        """
+        return self._from_merged(compact, self.shape, self.labels, self.label_index, self.coords)
+
+    def to_compact(self):
+        """
+        All pixels in the lorentzian_fitting.compact_batch layout.
+        """
+        return {
+            'Offsets': self.offsets, 'Contrast_Names': self.contrast_names[2:], 'Zspec': self.zspec,
+            'Fit_Params_1': self.fit_params_1, 'Fit_Params_2': self.fit_params_2, 'Correction': self.correction,
+            'RMSE': self.rmse, 'Residual_Mean': self.residual_mean, 'Residual_Std': self.residual_std,
+            'Iterations': self.iterations,
+        }
+
+    def refit_contrasts(self, custom_contrasts, config=default_config, exclude=None):
+        """
+        New result for a different contrast selection, refitting only step 2 where possible.
+        Pixels marked in exclude are left zero-filled.
+        """
+        merged = refit_contrasts_batch(self.to_compact(), custom_contrasts, config, exclude)
+        return self._from_merged(merged, self.shape, self.labels, self.label_index, self.coords, self.snr)
+
+    # --- Access --- #
+    @property
+    def n_pixels(self):
+        return len(self.rmse)
+
+    @property
+    def converged(self):
+        return np.isfinite(self.rmse)
+
+    @property
+    def flat_index(self):
+        return np.ravel_multi_index((self.coords[:, 0], self.coords[:, 1]), self.shape)
+
+    def label_slice(self, label):
+        """
+        Slice selecting the pixels of one label; indexing with it returns views.
+        """
+        k = self.labels.index(label)
+        start = np.searchsorted(self.label_index, k, side='left')
+        stop = np.searchsorted(self.label_index, k, side='right')
+        return slice(int(start), int(stop))
+
+    def contrast(self, name):
+        """
+        Contrast values (%) for all pixels, as a view into the contrasts array.
+        """
+        return self.contrasts[:, self.contrast_names.index(name)]
+
+    def pixel_index(self, row, col):
+        """
+        Index of the pixel at (row, col), or None if it was not fit.
+        """
+        matches = np.flatnonzero((self.coords[:, 0] == row) & (self.coords[:, 1] == col))
+        return int(matches[0]) if matches.size else None
+
+    # --- Maps --- #
+    def to_map(self, values, fill=np.nan):
+        """
+        Places per-pixel values into a 2D image.
+        When the pixels cover the full image in raster order the map is a view of values.
+        """
+        values = np.asarray(values)
+        flat_index = self.flat_index
+        if values.size == np.prod(self.shape) and np.array_equal(flat_index, np.arange(values.size)):
+            return values.reshape(self.shape)
+        image = np.full(int(np.prod(self.shape)), fill, dtype=np.result_type(values, type(fill)))
+        image[flat_index] = values
+        return image.reshape(self.shape)
+
+    def contrast_maps(self, names=None):
+        """
+        2D maps (%) for the requested contrasts (all by default). Contrasts that were not fit stay NaN.
+        """
+        names = self.contrast_names if names is None else names
+        return {name: self.to_map(self.contrast(name)) if name in self.contrast_names
+                else np.full(self.shape, np.nan) for name in names}
+
+    # --- Single pixels --- #
+    def expand(self, index, config=default_config):
+        """
+        Regenerates the full two_step output (including interpolated curves) for one pixel.
+        """
+        pool_names = self.contrast_names[2:]
+        if not self.converged[index]:
+            return failed_fit(self.zspec[index], self.offsets, pool_names, config=config)
+        offsets_corrected = self.offsets - self.correction[index]
+        return package_fit(self.zspec[index], self.offsets, offsets_corrected, self.fit_params_1[index],
+                           self.fit_params_2[index], pool_names, self.iterations[index], config=config)
@@ -9,6 +9,7 @@ import os
 import itertools
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
 import streamlit as st
 from matplotlib.patches import Patch
 from scipy.signal import medfilt2d
@@ -25,22 +26,13 @@ def pixelwise_mapping(image, pixelwise_fits, user_geometry, custom_contrasts, sm
         x_min, x_max = max(np.min(x_indices) - 20, 0), min(np.max(x_indices) + 20, masks["lv"].shape[1])
         y_min, y_max = max(np.min(y_indices) - 20, 0), min(np.max(y_indices) + 20, masks["lv"].shape[0])
     else:
-        masks = user_geometry["masks"]
         x_min, x_max = 0, image.shape[1] 
         y_min, y_max = 0, image.shape[0]
     image_path = os.path.join(save_path, 'Images')
     os.makedirs(image_path, exist_ok=True)
     contrasts_to_plot = custom_contrasts if custom_contrasts is not None else ['Amide', 'Creatine', 'NOE (-3.5 ppm)', 'NOE (-1.6 ppm)']
     contrasts_to_plot = ['MT'] + contrasts_to_plot
-    contrast_images = {contrast: np.full_like(image, np.nan, dtype=float) for contrast in contrasts_to_plot}
-    for label, mask in masks.items():
-        data = pixelwise_fits.get(label, [])
-        for contrast in contrasts_to_plot:
-            contrast_list = [datum["Contrasts"].get(contrast, np.nan) for datum in data]
-            mask_indices = np.argwhere(mask)
-            for idx, (i, j) in enumerate(mask_indices):
-                if idx < len(contrast_list):
-                    contrast_images[contrast][i, j] = contrast_list[idx]
+    contrast_images = pixelwise_fits.contrast_maps(contrasts_to_plot)
     if smoothing_filter:
         for contrast in contrast_images:
             contrast_images[contrast] = medfilt2d(contrast_images[contrast], kernel_size=3)
@@ -74,6 +66,105 @@ def pixelwise_mapping(image, pixelwise_fits, user_geometry, custom_contrasts, sm
                     st.pyplot(fig)
     return contrast_images
 
+def plot_volume_maps(m0, volume_fits, custom_contrasts, save_path, n_cols=4):
+    """
+    Displays pixelwise CEST contrast maps for every slice of a volume (fit_volume output) as one montage per contrast.
+    All slices of a contrast share one color scale.
+    """
+    image_path = os.path.join(save_path, 'Images')
+    os.makedirs(image_path, exist_ok=True)
+    contrasts_to_plot = ['MT'] + (custom_contrasts if custom_contrasts is not None else ['Amide', 'Creatine', 'NOE (-3.5 ppm)', 'NOE (-1.6 ppm)'])
+    n_slices = m0.shape[2]
+    empty = np.full(m0.shape[:2], np.nan)
+    volume_maps = {}
+    for contrast in contrasts_to_plot:
+        volume_maps[contrast] = np.stack([fits.contrast_maps([contrast])[contrast] if fits is not None else empty
+                                          for fits in volume_fits], axis=-1)
+    n_rows = int(np.ceil(n_slices / n_cols))
+    for contrast, values in volume_maps.items():
+        vmax = np.nanmax(values) if np.any(np.isfinite(values)) else 1
+        fig, axes = plt.subplots(n_rows, n_cols, figsize=(3 * n_cols, 3 * n_rows), squeeze=False)
+        for index, ax in enumerate(axes.flat):
+            ax.axis("off")
+            if index >= n_slices:
+                continue
+            ax.imshow(m0[:, :, index], cmap="gray")
+            im = ax.imshow(values[:, :, index], cmap="viridis", alpha=0.9, norm=Normalize(vmin=0, vmax=vmax))
+            ax.set_title(f"Slice {index + 1}", fontsize=12)
+        fig.suptitle(contrast, fontsize=20, weight='bold')
+        cbar = fig.colorbar(im, ax=axes, shrink=0.8)
+        cbar.set_label("CEST Contrast (%)", fontsize=14)
+        st.pyplot(fig)
+        fig.savefig(os.path.join(image_path, f"{contrast}_Volume_Map.png"), dpi=150, bbox_inches="tight")
+        plt.close(fig)
+    return volume_maps
+
+def plot_quick_look(image, quick_look_maps, save_path):
+    """
+    Displays quick-look MTRasym and Lorentzian difference maps (no fitting) over the reference image.
+    """
+    image_path = os.path.join(save_path, 'Images')
+    os.makedirs(image_path, exist_ok=True)
+    maps = {title: values for title, values in quick_look_maps.items() if title != 'B0'}
+    titles = list(maps)
+    for i in range(0, len(titles), 2):
+        cols = st.columns(2)
+        for col, title in zip(cols, titles[i:i + 2]):
+            values = maps[title]
+            limit = np.nanpercentile(np.abs(values), 99) if np.any(np.isfinite(values)) else 1
+            fig, ax = plt.subplots(figsize=(6, 6))
+            ax.imshow(image, cmap="gray")
+            im = ax.imshow(values, cmap="RdBu_r", alpha=0.9, norm=Normalize(vmin=-limit, vmax=limit))
+            ax.set_title(title, fontsize=20, weight='bold')
+            ax.axis("off")
+            cbar = fig.colorbar(im, ax=ax, shrink=0.8)
+            cbar.set_label("Contrast (%)", fontsize=16)
+            cbar.ax.tick_params(labelsize=14)
+            with col:
+                st.pyplot(fig)
+            fig.savefig(os.path.join(image_path, f"Quick_Look_{title}.png"), dpi=150, bbox_inches="tight")
+            plt.close(fig)
+
+def plot_b1_corrected(image, corrected_maps, save_path):
+    """
+    Displays B1-corrected contrast maps (cest_fitting.correct_b1 output) over the reference image.
+    """
+    image_path = os.path.join(save_path, 'Images')
+    os.makedirs(image_path, exist_ok=True)
+    titles = list(corrected_maps)
+    for i in range(0, len(titles), 2):
+        cols = st.columns(2)
+        for col, title in zip(cols, titles[i:i + 2]):
+            values = corrected_maps[title]
+            vmax = np.nanmax(values) if np.any(np.isfinite(values)) else 1
+            fig, ax = plt.subplots(figsize=(6, 6))
+            ax.imshow(image, cmap="gray")
+            im = ax.imshow(values, cmap="viridis", alpha=0.9, norm=Normalize(vmin=0, vmax=vmax))
+            ax.set_title(title, fontsize=28, weight='bold', fontname='Arial')
+            ax.axis("off")
+            cbar = fig.colorbar(im, ax=ax, shrink=0.8)
+            cbar.set_label("B$_1$-corrected contrast (%)", fontsize=16)
+            cbar.ax.tick_params(labelsize=14)
+            with col:
+                st.pyplot(fig)
+            fig.savefig(os.path.join(image_path, f"{title}_B1_Corrected_Map.png"), dpi=300, bbox_inches="tight")
+            plt.close(fig)
+    return corrected_maps
+
+def plot_pixel_zspec(pixelwise_fits, save_path):
+    """
+    Regenerates and plots the Z-spectrum fit for a single user-selected pixel.
+    """
+    label = st.selectbox("ROI", pixelwise_fits.labels, key="pixel_zspec_label")
+    pixels = pixelwise_fits.label_slice(label)
+    n_pixels = pixels.stop - pixels.start
+    index = pixels.start
+    if n_pixels > 1:
+        index += st.slider("Pixel index (scan-line order)", 0, n_pixels - 1, 0, key="pixel_zspec_index")
+    y, x = pixelwise_fits.coords[index]
+    fit = pixelwise_fits.expand(index)
+    plot_zspec({f"{label} pixel ({y}, {x})": fit}, save_path)
+
 def show_segmentation(image, mask, labeled_segments, save_path):
     """
     Displays the AHA segmentation on a reference image.
@@ -237,4 +328,40 @@ def plot_zspec(fits, save_path):
                 fig.suptitle(roi, fontsize=28, weight='bold', fontname='Arial')
                 plt.grid(False)
                 st.pyplot(fig)
-                plt.savefig(plot_path + '/' + roi + '_Lorentzian_Dif.png', dpi=300, bbox_inches="tight")
\ No newline at end of file
+                plt.savefig(plot_path + '/' + roi + '_Lorentzian_Dif.png', dpi=300, bbox_inches="tight")
+
+def plot_power_series(fits_by_power, save_path):
+    """
+    Overlays the Z-spectra of every saturation power per ROI and tabulates the fitted contrasts.
+    fits_by_power is {power label: {roi: fit}}, starting with the main CEST scan. Returns the contrast table.
+    """
+    plot_path = os.path.join(save_path, 'Plots')
+    os.makedirs(plot_path, exist_ok=True)
+    rows = []
+    for power, roi_fits in fits_by_power.items():
+        for roi, fit in roi_fits.items():
+            rows.append({'ROI': roi, 'Saturation power': power, **fit['Contrasts'], 'RMSE (%)': 100 * fit['RMSE']})
+    rois = list(next(iter(fits_by_power.values())))
+    colors = plt.get_cmap('viridis')(np.linspace(0, 0.9, len(fits_by_power)))
+    n_cols = 3
+    for row in range(-(-len(rois) // n_cols)):
+        cols = st.columns(min(n_cols, len(rois) - row * n_cols))
+        for col, roi in zip(cols, rois[row * n_cols:(row + 1) * n_cols]):
+            fig, ax = plt.subplots(figsize=(12, 10))
+            for color, (power, roi_fits) in zip(colors, fits_by_power.items()):
+                data_dict = roi_fits[roi]['Data_Dict']
+                total_fit = sum(value for key, value in data_dict.items() if key.endswith('_Fit'))
+                ax.plot(data_dict['Offsets_Corrected'], data_dict['Zspec'], '.', markersize=12, fillstyle='none', color=color)
+                ax.plot(data_dict['Offsets_Interp'], 1 - total_fit, linewidth=3, color=color, label=power)
+            ax.legend(fontsize=16)
+            ax.invert_xaxis()
+            ax.tick_params(axis='both', which='major', labelsize=16)
+            ax.set_ylim([0, 1])
+            ax.set_xlabel("Offset frequency (ppm)", fontsize=18, fontname='Arial')
+            ax.set_ylabel("$S/S_0$", fontsize=18, fontname='Arial')
+            fig.suptitle(roi, fontsize=28, weight='bold', fontname='Arial')
+            with col:
+                st.pyplot(fig)
+            fig.savefig(os.path.join(plot_path, f"{roi}_Zspec_Powers.png"), dpi=300, bbox_inches="tight")
+            plt.close(fig)
+    return pd.DataFrame(rows)
@@ -61,6 +61,28 @@ def plot_t1_map(t1_fits, reference_image, masks, save_path):
     plt.savefig(os.path.join(image_path, 'T1_Maps.png'), dpi=300, bbox_inches="tight")
     return t1_map_masked
 
+def plot_t1_full_map(t1_full_map, save_path):
+    """
+    Plots the T1 map fitted over the full field of view.
+    """
+    image_path = os.path.join(save_path, 'Images')
+    os.makedirs(image_path, exist_ok=True)
+    valid_t1_values = t1_full_map[np.isfinite(t1_full_map)]
+    vmin, vmax = np.percentile(valid_t1_values, [5, 95]) if valid_t1_values.size else (0, 1000)
+    fig, ax = plt.subplots(figsize=(8, 8))
+    overlay = ax.imshow(np.ma.masked_invalid(t1_full_map), cmap='plasma', vmin=vmin, vmax=vmax)
+    divider = make_axes_locatable(ax)
+    cax = divider.append_axes("right", size="5%", pad=0.05)
+    cbar = fig.colorbar(overlay, cax=cax)
+    cbar.set_label('T₁ (ms)', fontsize=24, fontweight='bold')
+    cbar.ax.tick_params(labelsize=18)
+    ax.axis('off')
+    ax.set_title('Full-FOV T₁ Map', fontsize=28, fontweight='bold')
+    fig.tight_layout()
+    fig.savefig(os.path.join(image_path, 'T1_Full_Map.png'), dpi=300, bbox_inches="tight")
+    st.pyplot(fig)
+    plt.close(fig)
+
 def plot_quesp_maps(quesp_fits, masks, reference_image, save_path, plotmin, plotmax):
     """
     Reconstructs and plots fb, kb, and R² maps for each fitted pool,
@@ -42,6 +42,26 @@ def plot_wassr_aha(wassr_aha_fits, save_path):
     fig.savefig(plot_file, dpi=300)
     st.pyplot(fig) 
 
+def plot_wassr_residuals(residual_map, save_path):
+    """
+    Shows the sparse B0 samples' residuals from the smooth field model.
+    """
+    image_path = os.path.join(save_path, 'Images')
+    os.makedirs(image_path, exist_ok=True)
+    v_abs_max = np.nanmax(np.abs(residual_map)) if np.any(np.isfinite(residual_map)) else 1
+    fig, ax = plt.subplots(figsize=(6, 6))
+    im = ax.imshow(np.ma.masked_invalid(residual_map), cmap='BrBG', vmin=-v_abs_max, vmax=v_abs_max, interpolation='nearest')
+    ax.set_title('B$_0$ Field Residuals', fontsize=20, fontname='Arial', weight='bold')
+    ax.axis('off')
+    divider = make_axes_locatable(ax)
+    cax = divider.append_axes("right", size="5%", pad=0.05)
+    cbar = fig.colorbar(im, cax=cax)
+    cbar.ax.tick_params(labelsize=14)
+    cbar.set_label('Sample - field (ppm)', fontname='Arial', fontsize=16)
+    fig.savefig(os.path.join(image_path, 'WASSR_Field_Residuals.png'), dpi=300, bbox_inches="tight")
+    st.pyplot(fig)
+    plt.close(fig)
+
 def plot_wassr(image, user_geometry, wassr_masked_fits, save_path, wassr_full_map = None):
     """
     Visualizes WASSR B0 map. Handles both full map and masked-only data.
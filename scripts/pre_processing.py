@@ -107,10 +107,14 @@ def motion_correction(ksp, traj, method, experiment_type, offsets_ppm):
 @time_it
 def denoise_data(image_stack):
     """
-    Denoises a stack of images using Global PCA.
+    Denoises a stack of images (offsets last, one or more slices) using Global PCA.
+    float32 stacks are decomposed in single precision, which is faster and halves memory.
     """
-    height, width, n_offsets_s = image_stack.shape
-    data_matrix = image_stack.reshape((height * width, n_offsets_s))
+    n_offsets_s = image_stack.shape[-1]
+    data_matrix = image_stack.reshape((-1, n_offsets_s))
+    # Center with a double precision mean first; float32 covariances of uncentered Z-spectra lose the small components
+    mean_spectrum = np.mean(data_matrix, axis=0, dtype=np.float64).astype(data_matrix.dtype)
+    data_matrix = data_matrix - mean_spectrum
     pca = PCA()
     pca.fit(data_matrix)
     eigenvalues = pca.explained_variance_
@@ -125,17 +129,18 @@ def denoise_data(image_stack):
     st_functions.message_logging(f"Denoised with {n_components_to_keep} components.", msg_type='info')
     pca_denoising = PCA(n_components=n_components_to_keep)
     transformed_data = pca_denoising.fit_transform(data_matrix)
-    denoised_data_matrix = pca_denoising.inverse_transform(transformed_data)
-    return denoised_data_matrix.reshape((height, width, n_offsets_s))
+    denoised_data_matrix = pca_denoising.inverse_transform(transformed_data) + mean_spectrum
+    return denoised_data_matrix.reshape(image_stack.shape)
 
 # --- Main pre-processing function --- #
-def run_radial_preprocessing(directory, num_exp, use_pca, experiment_type = 'cest'):
+def run_radial_preprocessing(directory, num_exp, use_pca, experiment_type = 'cest', dtype = np.float64):
     """
     Main pipeline for radial pre-processing.
     Loads data, performs motion correction, and optionally denoises.
+    dtype=np.float32 runs the whole chain in single precision.
     """
     # 1. Load Data
-    exp = bruker.ReadExperiment(directory, num_exp)
+    exp = bruker.ReadExperiment(directory, num_exp, dtype)
     ksp = exp.GenerateKspace()
     traj = exp.traj
     method = exp.method
@@ -143,7 +148,7 @@ def run_radial_preprocessing(directory, num_exp, use_pca, experiment_type = 'ces
     offsets_ppm = np.round(offsets_hz / (method["PVM_FrqWork"][0]), 2)
     
     # 2. Motion Correction
-    motion_corrected_stack = motion_correction(ksp, traj, method, experiment_type, offsets_ppm)
+    motion_corrected_stack = motion_correction(ksp, traj, method, experiment_type, offsets_ppm).astype(dtype, copy=False)
     
     # 3. Optional Denoising
     final_stack = motion_corrected_stack
@@ -151,4 +156,4 @@ def run_radial_preprocessing(directory, num_exp, use_pca, experiment_type = 'ces
         st.info("Denoising data with PCA...")
         final_stack = denoise_data(motion_corrected_stack)
 
-    return {"imgs": final_stack, "offsets": offsets_ppm}
\ No newline at end of file
+    return {"imgs": final_stack, "offsets": offsets_ppm, "sat_power": load_study.find_sat_power(exp)}
\ No newline at end of file
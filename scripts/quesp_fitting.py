@@ -6,17 +6,28 @@ Created on Thu Jul 10 12:58:21 2025
 @author: jonah
 """
 import numpy as np
-from scipy.optimize import curve_fit
-from sklearn.metrics import r2_score
 import pandas as pd
 import streamlit as st
 from custom import st_functions
 from custom.st_functions import time_it
+from scripts import batch_fitting
 
 # --- Constants --- #
 # Proton gyromagnetic ratio (rad/T/s)
 GAMMA = 2.675221e8
 
+# --- Batched QUESP solver (tunable) --- #
+QUESP_MAX_ITER = 200 # Levenberg-Marquardt iterations per pixel
+QUESP_FTOL = 1e-8 # Relative cost reduction to stop at, as in curve_fit
+QUESP_XTOL = 1e-10
+
+# --- Variable-projection T1 fitting (tunable) --- #
+T1_GRID_MIN = 10 # Shortest T1 on the search grid (ms)
+T1_GRID_MAX = 10000 # Longest T1 on the search grid (ms)
+T1_GRID_SIZE = 400 # Log-spaced grid points
+T1_POLISH = True # Refine the grid T1 and M0 with a batched Levenberg-Marquardt fit
+T1_INTENSITY_THRESHOLD = 0.05 # Fraction of the maximum image intensity for full-FOV T1 maps
+
 # --- Dictionary to match CEST pool to frequency offset. Feel free to add to/update this! --- #
 pool_dict = {
     'Cr': 2.0,
@@ -27,32 +38,66 @@ pool_dict = {
 }
 
 # --- Model definitions --- #
-def standard_model(b1, r1, tsat, trecs, fb, kb):
+def t1_model_batch(x, params):
     """
-    MODIFIED: This model now handles a series of recovery times (trecs).
-    The initial magnetization (Zi) for the first scan is 1. For subsequent scans,
-    Zi is calculated based on the preceding trec.
+    Saturation-recovery T1 model m0 * (1 - exp(-tr / t1)) for every pixel (rows of x) at once,
+    with params holding (m0, t1) per pixel.
     """
-    omega = GAMMA * b1
+    return params[:, 0:1] * (1 - np.exp(-x / params[:, 1:2]))
 
-    # Calculate Zi for each scan based on the recovery from the *previous* scan
-    zi_values = np.ones_like(b1) # Initialize all Zi to 1
-    # For scans after the first, calculate Zi based on the preceding trec
-    if len(trecs) > 1:
-        zi_values[1:] = 1 - np.exp(-r1 * trecs[:-1])
-    alpha = omega**2 / (omega**2 + kb**2)
-    return (fb * kb * alpha) / (r1 + fb * kb * alpha) + (zi_values - 1) * np.exp(-r1 * tsat) - (zi_values - r1 / (r1 + fb * kb * alpha)) * np.exp(-(r1 + fb * kb * alpha) * tsat)
+def t1_model_batch_jac(x, params):
+    m0, t1 = params[:, 0:1], params[:, 1:2]
+    decay = np.exp(-x / t1)
+    return np.stack([1 - decay, -m0 * decay * x / t1**2], axis=2)
+
+# --- Batched model definitions --- #
+# x stacks (omega, r1, zi) along its last axis with one row per pixel; params holds (fb, kb) per pixel.
+def exchange_rate(omega, fb, kb):
+    """
+    Labeling-weighted exchange rate fb * kb * alpha and its derivatives with respect to fb and kb.
+    """
+    omega_sq = omega**2
+    alpha = omega_sq / (omega_sq + kb**2)
+    rate = fb * kb * alpha
+    return rate, kb * alpha, fb * alpha * (omega_sq - kb**2) / (omega_sq + kb**2)
 
-def inverse_model(b1, r1, fb, kb):
-    omega = GAMMA * b1
-    return 1 / r1 * fb * kb * omega**2 / (omega**2 + kb**2)
+def standard_model_batch(x, params, tsat):
+    """
+    Standard QUESP model (MTRasym) for every pixel at once. Returns the model and its Jacobian.
+    Handles a series of recovery times: the first scan starts from Zi = 1, later scans from the
+    recovery after the preceding trec (see fit_quesp_pixels).
+    """
+    omega, r1, zi = x[..., 0], x[..., 1], x[..., 2]
+    rate, d_fb, d_kb = exchange_rate(omega, params[:, 0:1], params[:, 1:2])
+    total = r1 + rate
+    decay = np.exp(-total * tsat)
+    value = rate / total + (zi - 1) * np.exp(-r1 * tsat) - (zi - r1 / total) * decay
+    d_rate = r1 / total**2 * (1 - decay) + (zi - r1 / total) * tsat * decay
+    return value, np.stack([d_rate * d_fb, d_rate * d_kb], axis=2)
+
+def inverse_model_batch(x, params, tsat):
+    """
+    Inverse QUESP model (MTRrex = fb * kb * alpha / r1) for every pixel at once. Returns the model and its Jacobian.
+    """
+    omega, r1 = x[..., 0], x[..., 1]
+    rate, d_fb, d_kb = exchange_rate(omega, params[:, 0:1], params[:, 1:2])
+    return rate / r1, np.stack([d_fb / r1, d_kb / r1], axis=2)
 
-def omega_plot(b1, r1, fb, kb):
-    omega = GAMMA * b1
-    return r1 / (fb * kb) + r1 * kb / (fb * omega**2)
+def omega_plot_batch(x, params, tsat):
+    """
+    Omega plot (1/MTRrex = r1 / (fb * kb) + r1 * kb / (fb * omega²)) for every pixel at once. Returns the model and its Jacobian.
+    """
+    omega, r1 = x[..., 0], x[..., 1]
+    fb, kb = params[:, 0:1], params[:, 1:2]
+    value = r1 / (fb * kb) + r1 * kb / (fb * omega**2)
+    d_kb = -r1 / (fb * kb**2) + r1 / (fb * omega**2)
+    return value, np.stack([-value / fb, d_kb], axis=2)
 
-def t1_model(tr, m0, t1):
-    return m0 * (1 - np.exp(-tr / t1))
+batch_models = {
+    'Standard (MTRasym)': standard_model_batch,
+    'Inverse (MTRrex)': inverse_model_batch,
+    'Omega Plot': omega_plot_batch,
+}
 
 # --- Misc. functions -- #
 def calc_proton_volume_fraction(conc, num_protons):
@@ -61,11 +106,134 @@ def calc_proton_volume_fraction(conc, num_protons):
     """
     return (num_protons * conc) / (111e3)
 
+def r2_rows(y, fitted):
+    """
+    Row-wise coefficient of determination, matching sklearn's r2_score for each pixel.
+    """
+    ss_res = np.sum((y - fitted)**2, axis=1)
+    ss_tot = np.sum((y - np.mean(y, axis=1, keepdims=True))**2, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r2 = 1 - ss_res / ss_tot
+    # Constant curves score 1 if reproduced exactly and 0 otherwise
+    return np.where(ss_tot > 0, r2, np.where(ss_res == 0, 1.0, 0.0))
+
+# --- Closed-form Omega plot --- #
+def omega_plot_regression(inv_mtr, omega, r1, weights=None):
+    """
+    Least-squares line through the Omega plot (1/MTRrex against 1/omega²) for every pixel (rows).
+    The intercept r1/(fb*kb) and slope r1*kb/fb give fb and kb; pixels without a positive intercept and slope are NaN.
+    weights apply to the squared residuals.
+    """
+    u = 1 / omega**2
+    w = np.ones_like(inv_mtr) if weights is None else weights
+    sw, su, suu = np.sum(w, axis=1), np.sum(w * u, axis=1), np.sum(w * u**2, axis=1)
+    sz, suz = np.sum(w * inv_mtr, axis=1), np.sum(w * u * inv_mtr, axis=1)
+    slope = (sw * suz - su * sz) / (sw * suu - su**2)
+    intercept = (sz - slope * su) / sw
+    positive = (intercept > 0) & (slope > 0)
+    kb = np.where(positive, np.sqrt(slope / intercept), np.nan)
+    fb = np.where(positive, r1[:, 0] / np.sqrt(intercept * slope), np.nan)
+    return np.stack([fb, kb], axis=1)
+
+def omega_plot_kb(inv_mtr, omega, r1, fixed_fb, kb_min, kb_max, weights=None):
+    """
+    Exact bounded least-squares kb of the Omega plot with fb fixed, for every pixel (rows).
+    Setting the derivative to zero gives a quartic in kb, solved through the eigenvalues of its companion matrices.
+    """
+    u = 1 / omega**2
+    w = np.ones_like(inv_mtr) if weights is None else weights
+    # With z = fb/r1 / MTRrex the model is z = 1/kb + kb*u, so the stationarity condition is
+    # sum(w*u²)*kb⁴ - sum(w*u*z)*kb³ + sum(w*z)*kb - sum(w) = 0
+    z = inv_mtr * fixed_fb / r1
+    coeffs = np.stack([-np.sum(w * u * z, axis=1), np.zeros(z.shape[0]), np.sum(w * z, axis=1), -np.sum(w, axis=1)], axis=1)
+    coeffs /= np.sum(w * u**2, axis=1)[:, np.newaxis]
+    companion = np.zeros((z.shape[0], 4, 4))
+    companion[:, 0, :] = -coeffs
+    companion[:, 1:, :3] = np.eye(3)
+    finite = np.all(np.isfinite(companion), axis=(1, 2))
+    roots = np.full((z.shape[0], 4), np.nan, dtype=complex)
+    roots[finite] = np.linalg.eigvals(companion[finite])
+    real_roots = np.where(np.abs(roots.imag) <= 1e-9 * np.abs(roots.real), roots.real, np.nan)
+    # The bounded minimum sits at an interior stationary point or on a bound
+    candidates = np.concatenate([real_roots, np.full((z.shape[0], 2), [kb_min, kb_max])], axis=1)
+    candidates[(candidates < kb_min) | (candidates > kb_max)] = np.nan
+    residuals = z[:, np.newaxis, :] - 1 / candidates[:, :, np.newaxis] - candidates[:, :, np.newaxis] * u
+    cost = np.sum(w[:, np.newaxis, :] * residuals**2, axis=2)
+    cost[~np.isfinite(cost)] = np.inf
+    kb = np.take_along_axis(candidates, np.argmin(cost, axis=1)[:, np.newaxis], axis=1)
+    kb[~finite | ~np.isfinite(np.min(cost, axis=1))] = np.nan
+    return kb
+
 # --- Fitting functions --- #
+def fit_quesp_pixels(curves, b1_values, r1, tsat, trecs, fit_type, fixed_fb=None):
+    """
+    Fits one QUESP model to all pixel curves (rows) at once, each pixel with its own r1.
+    Omega plot fits are solved in closed form and only refined with Levenberg-Marquardt when the
+    estimate falls outside the bounds; inverse fits start Levenberg-Marquardt from the weighted Omega plot.
+    Pixels without a valid T1, with non-finite data or with a non-finite fit cost are NaN.
+    """
+    n_pixels = curves.shape[0]
+    fb_values = np.full(n_pixels, np.nan)
+    kb_values = np.full(n_pixels, np.nan)
+    r2_values = np.full(n_pixels, np.nan)
+    valid = np.isfinite(r1) & np.all(np.isfinite(curves), axis=1)
+    if not np.any(valid):
+        return fb_values, kb_values, r2_values
+    y = curves[valid]
+    r1_valid = r1[valid, np.newaxis]
+    # Zi of each scan follows the recovery after the preceding one; the first scan starts from 1
+    zi = np.ones_like(y)
+    if len(trecs) > 1:
+        zi[:, 1:] = 1 - np.exp(-r1_valid * trecs[:-1])
+    x = np.stack(np.broadcast_arrays(GAMMA * b1_values, r1_valid, zi), axis=-1)
+    model = batch_models[fit_type]
+    if fixed_fb is not None:
+        def with_fb(params):
+            return np.concatenate([np.full((params.shape[0], 1), fixed_fb), params], axis=1)
+        fit_model = lambda x, params: model(x, with_fb(params), tsat)[0]
+        fit_jac = lambda x, params: model(x, with_fb(params), tsat)[1][:, :, 1:]
+        p0, lb, ub = [1000], [0.1], [5000]
+    else:
+        fit_model = lambda x, params: model(x, params, tsat)[0]
+        fit_jac = lambda x, params: model(x, params, tsat)[1]
+        p0, lb, ub = [0.01, 1000], [0, 0.1], [10, 5000]
+    params = np.tile(np.array(p0, dtype=float), (y.shape[0], 1))
+    solved = np.zeros(y.shape[0], dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        if fit_type in ['Omega Plot', 'Inverse (MTRrex)']:
+            # The Omega plot is a straight line; for MTRrex its regression weighted by MTRrex⁴ starts refinement next to the minimum
+            inv_mtr = y if fit_type == 'Omega Plot' else 1 / y
+            weights = None if fit_type == 'Omega Plot' else y**4
+            omega = GAMMA * b1_values
+            if fixed_fb is not None:
+                estimate = omega_plot_kb(inv_mtr, omega, r1_valid, fixed_fb, lb[0], ub[0], weights)
+            else:
+                estimate = omega_plot_regression(inv_mtr, omega, r1_valid, weights)
+            in_bounds = np.all(np.isfinite(estimate) & (estimate >= lb) & (estimate <= ub), axis=1)
+            params[in_bounds] = estimate[in_bounds]
+            # Unweighted Omega plot estimates inside the bounds are already the least-squares solution
+            if fit_type == 'Omega Plot':
+                solved = in_bounds
+        refine = np.flatnonzero(~solved)
+        if refine.size:
+            params[refine], _, _, _ = batch_fitting.levenberg_marquardt(fit_model, fit_jac, x[refine], y[refine], params[refine], lb, ub,
+                                                                        max_iter=QUESP_MAX_ITER, ftol=QUESP_FTOL, xtol=QUESP_XTOL)
+        fitted_curves = fit_model(x, params)
+        cost = np.sum((fitted_curves - y)**2, axis=1)
+        r2 = r2_rows(y, fitted_curves)
+    # Pixels still creeping along a flat valley at max_iter keep their estimate; only failed evaluations are dropped
+    fitted = np.isfinite(cost)
+    fb = np.full(params.shape[0], fixed_fb, dtype=float) if fixed_fb is not None else params[:, 0]
+    fb_values[valid] = np.where(fitted, fb, np.nan)
+    kb_values[valid] = np.where(fitted, params[:, -1], np.nan)
+    r2_values[valid] = np.where(fitted, r2, np.nan)
+    return fb_values, kb_values, r2_values
+
 @time_it
 def fit_quesp_map(quesp_data, t1_pixel_fits, masks, fit_type, fixed_fb=None):
     """
     Performs a pixel-wise QUESP fit for each ROI, with a single unified progress bar.
+    All pixels of an ROI are fit together for each pool.
     """
     if not quesp_data:
         st.error("QUESP data is empty. Cannot perform fit.")
@@ -146,108 +314,93 @@ def fit_quesp_map(quesp_data, t1_pixel_fits, masks, fit_type, fixed_fb=None):
                         msg_type='warning'
                     )
                 
-        # Iterate through each pixel in the current ROI
-        for i in range(len(y_coords)):
-            y, x = y_coords[i], x_coords[i]
-            t1_val_ms = t1_values_for_roi[i]
-            # Perform the fit for each chemical pool for the current pixel
-            for pool_name, data in pools_data.items():
-                fit_counter += 1
-                progress_bar.progress(fit_counter / total_fits, text=f"Fitting {pool_name} in {roi_label}...")
-
-                if np.isnan(t1_val_ms) or t1_val_ms == 0:
-                    results_by_roi[roi_label][pool_name]['fb_values'].append(np.nan)
-                    results_by_roi[roi_label][pool_name]['kb_values'].append(np.nan)
-                    results_by_roi[roi_label][pool_name]['r2_values'].append(np.nan)
-                    continue
-
-                r1_pixel = 1.0 / (t1_val_ms * 1e-3)
-                if fixed_fb is not None:
-                    if fit_type == 'Standard (MTRasym)':
-                        model_to_fit = lambda b1, kb: standard_model(b1, r1_pixel, data['tsat'], data['trecs'], fixed_fb, kb)
-                    elif fit_type == 'Inverse (MTRrex)':
-                        model_to_fit = lambda b1, kb: inverse_model(b1, r1_pixel, fixed_fb, kb)
-                    elif fit_type == 'Omega Plot':
-                        model_to_fit = lambda b1, kb: omega_plot(b1, r1_pixel, fixed_fb, kb)
-                    p0 = [1000]
-                    bounds = ([0.1], [5000])
-                else:
-                    if fit_type == 'Standard (MTRasym)':
-                        model_to_fit = lambda b1, fb, kb: standard_model(b1, r1_pixel, data['tsat'], data['trecs'], fb, kb)
-                    elif fit_type == 'Inverse (MTRrex)':
-                        model_to_fit = lambda b1, fb, kb: inverse_model(b1, r1_pixel, fb, kb)
-                    elif fit_type == 'Omega Plot':
-                        model_to_fit = lambda b1, fb, kb: omega_plot(b1, r1_pixel, fb, kb)
-                    p0=[0.01, 1000]
-                    bounds=([0, 0.1], [10, 5000])
-
-                if fit_type == 'Standard (MTRasym)':
-                    curve = data['mtr_asym_stack'][y, x, :]
-                elif fit_type == 'Inverse (MTRrex)':
-                    curve = data['mtr_rex_stack'][y, x, :]
-                elif fit_type == 'Omega Plot':
-                    curve = 1 / data['mtr_rex_stack'][y, x, :]
-
-                try:
-                    popt, _ = curve_fit(
-                        model_to_fit, data['b1_values'], curve,
-                        p0=p0, bounds=bounds
-                    )
-                    if fixed_fb is not None:
-                        fb = fixed_fb
-                        kb = popt[0]
-                    else:
-                        fb, kb = popt
-                    r2 = r2_score(curve, model_to_fit(data['b1_values'], *popt))
-                    results_by_roi[roi_label][pool_name]['fb_values'].append(fb)
-                    results_by_roi[roi_label][pool_name]['kb_values'].append(kb)
-                    results_by_roi[roi_label][pool_name]['r2_values'].append(r2)
-                except RuntimeError:
-                    results_by_roi[roi_label][pool_name]['fb_values'].append(np.nan)
-                    results_by_roi[roi_label][pool_name]['kb_values'].append(np.nan)
-                    results_by_roi[roi_label][pool_name]['r2_values'].append(np.nan)
+        # Fit every pixel of the ROI at once for each chemical pool
+        t1_values_ms = np.array(t1_values_for_roi, dtype=float)
+        with np.errstate(divide='ignore'):
+            r1_pixels = np.where(t1_values_ms == 0, np.nan, 1.0 / (t1_values_ms * 1e-3))
+        for pool_name, data in pools_data.items():
+            progress_bar.progress(fit_counter / total_fits, text=f"Fitting {pool_name} in {roi_label}...")
+            if fit_type == 'Standard (MTRasym)':
+                curves = data['mtr_asym_stack'][y_coords, x_coords, :]
+            elif fit_type == 'Inverse (MTRrex)':
+                curves = data['mtr_rex_stack'][y_coords, x_coords, :]
+            elif fit_type == 'Omega Plot':
+                with np.errstate(divide='ignore'):
+                    curves = 1 / data['mtr_rex_stack'][y_coords, x_coords, :]
+            fb_values, kb_values, r2_values = fit_quesp_pixels(
+                curves.astype(float), data['b1_values'], r1_pixels, data['tsat'], data['trecs'], fit_type, fixed_fb)
+            results_by_roi[roi_label][pool_name]['fb_values'].extend(fb_values.tolist())
+            results_by_roi[roi_label][pool_name]['kb_values'].extend(kb_values.tolist())
+            results_by_roi[roi_label][pool_name]['r2_values'].extend(r2_values.tolist())
+            fit_counter += len(y_coords)
 
     progress_bar.empty()
     st_functions.message_logging("QUESP fitting complete!")
     return results_by_roi
 
+def t1_varpro(signals, trs, polish=T1_POLISH):
+    """
+    Variable-projection T1 fit of every signal curve (rows) at once.
+    M0 enters linearly, so for each T1 on a log-spaced grid it is solved in closed form and the grid T1
+    with the smallest residual is kept; polish then refines M0 and T1 together. Returns M0 and T1 (ms).
+    """
+    signals = np.asarray(signals, dtype=float)
+    trs = np.asarray(trs, dtype=float)
+    t1_grid = np.geomspace(T1_GRID_MIN, T1_GRID_MAX, T1_GRID_SIZE)
+    basis = 1 - np.exp(-trs[np.newaxis, :] / t1_grid[:, np.newaxis])
+    m0 = np.full(signals.shape[0], np.nan)
+    t1 = np.full(signals.shape[0], np.nan)
+    valid = np.all(np.isfinite(signals), axis=1)
+    projections = signals[valid] @ basis.T
+    norms = np.sum(basis**2, axis=1)
+    # Residual = |y|² - projection²/norm for a positive M0; negative projections leave the full |y|²
+    explained = np.where(projections > 0, projections**2 / norms, 0)
+    best = np.argmax(explained, axis=1)
+    rows = np.arange(best.size)
+    m0[valid] = np.maximum(projections[rows, best] / norms[best], 0)
+    t1[valid] = t1_grid[best]
+    if polish and np.any(valid):
+        x = np.broadcast_to(trs, (np.count_nonzero(valid), trs.size))
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            params, _, _, _ = batch_fitting.levenberg_marquardt(t1_model_batch, t1_model_batch_jac, x, signals[valid],
+                                                                np.stack([m0[valid], t1[valid]], axis=1), [0, 1e-6], [np.inf, np.inf],
+                                                                max_iter=QUESP_MAX_ITER, ftol=QUESP_FTOL, xtol=QUESP_XTOL)
+        m0[valid], t1[valid] = params[:, 0], params[:, 1]
+    # A curve without any positive projection has no defined T1
+    t1[valid] = np.where(m0[valid] > 0, t1[valid], np.nan)
+    return m0, t1
+
 @time_it
 def fit_t1_map(t1_data, masks):
     """
-    Performs a pixel-wise T1 fit for each ROI, with a single unified progress bar.
+    Performs a pixel-wise T1 fit for each ROI. All ROI pixels are fit together with t1_varpro.
     """
     images = t1_data['imgs']
-    trs = t1_data['trs']
     pixelwise_fits = {}
-    all_coords = []
     for label, mask in masks.items():
-        coords = np.argwhere(mask)
-        all_coords.extend([(label, tuple(coord)) for coord in coords])
-        pixelwise_fits[label] = []
-
-    if not all_coords:
+        _, t1 = t1_varpro(images[mask], t1_data['trs'])
+        pixelwise_fits[label] = t1.tolist()
+    if not any(pixelwise_fits.values()):
         return {}
-    progress_bar = st.progress(0, text="Fitting T₁ map...")
-    total = len(all_coords)
-
-    for i, (label, (y, x)) in enumerate(all_coords):
-        signal_curve = images[y, x, :]
-        try:
-            popt, _ = curve_fit(
-                f=t1_model,
-                xdata=trs,
-                ydata=signal_curve,
-                p0=[np.max(signal_curve), 300.0],
-                bounds=([0, 0], [np.inf, np.inf])
-            )
-            pixelwise_fits[label].append(popt[1]) # Append T1 value
-        except RuntimeError:
-            pixelwise_fits[label].append(np.nan)
-        progress_bar.progress((i + 1) / total, text="Fitting T₁ map...")
-    progress_bar.progress(1.0, text="T₁ map fitting complete.")
-    progress_bar.empty()
     return pixelwise_fits
 
+@time_it
+def fit_t1_full(t1_data, masks):
+    """
+    Fits T1 over the full field of view and returns the ROI values (as fit_t1_map) and the full T1 map.
+    Pixels outside the ROIs and darker than T1_INTENSITY_THRESHOLD of the image maximum are left NaN.
+    """
+    images = t1_data['imgs']
+    t1_full_map = np.full(images.shape[:2], np.nan)
+    fit_pixels = np.max(images, axis=2) >= T1_INTENSITY_THRESHOLD * np.max(images)
+    for mask in masks.values():
+        fit_pixels |= mask # ROI pixels are always fit, so their values match fit_t1_map
+    _, t1_full_map[fit_pixels] = t1_varpro(images[fit_pixels], t1_data['trs'])
+    pixelwise_fits = {label: t1_full_map[mask].tolist() for label, mask in masks.items()}
+    if not any(pixelwise_fits.values()):
+        return {}, t1_full_map
+    return pixelwise_fits, t1_full_map
+
 def fixed_t1_map(fixed_t1, masks):
     pixelwise_fits = {}
     all_coords = []
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 16 21:14:06 2026
+
+@author: jonah
+
+Quick-look MTRasym and Lorentzian difference maps computed for the whole image stack at once.
+No fitting is done, so maps are available before the pixelwise Lorentzian fit runs.
+"""
+import numpy as np
+from scripts.lorentzian_fitting import lorentzian, default_config, default_contrasts, contrast_bounds
+
+# --- Quick-look options --- #
+b0_search = 1.5 # Range (ppm) around 0 searched for the water minimum
+water_widths = np.geomspace(0.2, 10, 24) # Candidate water FWHMs (ppm) for the background
+
+# --- Offset interpolation --- #
+def sort_offsets(imgs, offsets):
+    """
+    Returns the image stack and offsets with the offset axis (last) in ascending order.
+    """
+    order = np.argsort(offsets)
+    return imgs[..., order], np.asarray(offsets, dtype=float)[order]
+
+def interp_offsets(imgs, offsets, query):
+    """
+    Linearly interpolates every spectrum of a (..., n_offsets) stack at query offsets.
+    offsets must be ascending. query has shape (..., n_query) and may differ per pixel (e.g. B0 shifted).
+    Queries outside the acquired range take the nearest end value.
+    """
+    query = np.broadcast_to(query, imgs.shape[:-1] + np.shape(query)[-1:])
+    upper = np.clip(np.searchsorted(offsets, query), 1, len(offsets) - 1)
+    x0, x1 = offsets[upper - 1], offsets[upper]
+    weight = np.clip((query - x0) / (x1 - x0), 0, 1)
+    y0 = np.take_along_axis(imgs, upper - 1, axis=-1)
+    y1 = np.take_along_axis(imgs, upper, axis=-1)
+    return y0 + weight * (y1 - y0)
+
+def b0_from_minimum(imgs, offsets):
+    """
+    B0 shift (ppm) per pixel from the Z-spectrum minimum, refined with a parabola through its neighbours.
+    offsets must be ascending. Without any acquired offset within b0_search the global minimum is used.
+    """
+    search = np.abs(offsets) <= b0_search
+    if not np.any(search):
+        search = np.ones_like(search)
+    masked = np.where(search, imgs, np.inf)
+    index = np.clip(np.argmin(masked, axis=-1), 1, len(offsets) - 2)[..., np.newaxis]
+    xm, x0, xp = offsets[index - 1], offsets[index], offsets[index + 1]
+    ym, y0, yp = (np.take_along_axis(imgs, index + k, axis=-1) for k in (-1, 0, 1))
+    # Vertex of the parabola through three (unevenly spaced) points
+    num = (x0 - xm) ** 2 * (y0 - yp) - (x0 - xp) ** 2 * (y0 - ym)
+    den = (x0 - xm) * (y0 - yp) - (x0 - xp) * (y0 - ym)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vertex = x0 - 0.5 * num / den
+    vertex = np.where(np.isfinite(vertex) & (vertex >= xm) & (vertex <= xp), vertex, x0)
+    return vertex[..., 0]
+
+# --- Contrast maps --- #
+def mtr_asym(imgs, offsets, delta, b0=0):
+    """
+    MTRasym(delta) = Z(-delta) - Z(+delta) for every pixel, with offsets shifted by the B0 map b0.
+    """
+    z = interp_offsets(imgs, offsets, np.asarray(b0, dtype=float)[..., np.newaxis] + np.array([-delta, delta]))
+    return z[..., 0] - z[..., 1]
+
+def background_fit(imgs, offsets, b0, custom_contrasts, config=default_config):
+    """
+    Water + MT background fit over the step 1 region without iterations.
+    The MT pool keeps its default FWHM and center, and the water FWHM is searched on water_widths;
+    for each width both amplitudes follow from a 2x2 linear least-squares solve, all pixels at once.
+    Returns (water amplitude, water FWHM, MT amplitude) maps, NaN where no width gives a valid fit.
+    """
+    cutoffs = config.step_1_cutoffs(custom_contrasts)
+    x = offsets - np.asarray(b0, dtype=float)[..., np.newaxis]
+    region = ((x <= cutoffs[0]) | (x >= cutoffs[3]) | ((x >= cutoffs[1]) & (x <= cutoffs[2]))).astype(float)
+    saturation = 1 - imgs
+    mt = lorentzian(x, 1.0, config.p0_1[4], config.p0_1[5])
+    region_mt = region * mt
+    s_mm = np.einsum('...k,...k->...', region_mt, mt)
+    t_m = np.einsum('...k,...k->...', region_mt, saturation)
+    t_s = np.einsum('...k,...k->...', region * saturation, saturation)
+    best_cost = np.full(imgs.shape[:-1], np.inf)
+    amp_w, fwhm_w, amp_mt = (np.full(imgs.shape[:-1], np.nan) for _ in range(3))
+    for fwhm in water_widths:
+        region_water = region * lorentzian(x, 1.0, fwhm, 0)
+        s_ww = np.einsum('...k,...k->...', region_water, region_water)
+        s_wm = np.einsum('...k,...k->...', region_water, mt)
+        t_w = np.einsum('...k,...k->...', region_water, saturation)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            det = s_ww * s_mm - s_wm ** 2
+            a_w = (s_mm * t_w - s_wm * t_m) / det
+            a_m = (s_ww * t_m - s_wm * t_w) / det
+        # Residual sum of squares expanded in the accumulated sums
+        cost = t_s - 2 * (a_w * t_w + a_m * t_m) + a_w ** 2 * s_ww + 2 * a_w * a_m * s_wm + a_m ** 2 * s_mm
+        better = np.isfinite(cost) & (cost < best_cost) & (a_w > 0) & (a_m >= 0)
+        best_cost = np.where(better, cost, best_cost)
+        amp_w = np.where(better, a_w, amp_w)
+        fwhm_w = np.where(better, fwhm, fwhm_w)
+        amp_mt = np.where(better, a_m, amp_mt)
+    return amp_w, fwhm_w, amp_mt
+
+def lorentzian_difference_at(imgs, offsets, delta, b0, background, config=default_config):
+    """
+    Z_ref(delta) - Z(delta) for every pixel using the background from background_fit.
+    """
+    amp_w, fwhm_w, amp_mt = background
+    z = interp_offsets(imgs, offsets, (np.asarray(b0, dtype=float) + delta)[..., np.newaxis])[..., 0]
+    z_ref = 1 - lorentzian(delta, amp_w, fwhm_w, 0) - lorentzian(delta, amp_mt, config.p0_1[4], config.p0_1[5])
+    return z_ref - z
+
+def quick_look_maps(imgs, offsets, custom_contrasts=None, b0_map=None, config=default_config):
+    """
+    MTRasym and Lorentzian difference maps (%) for a thermal_drift corrected (rows, cols, n_offsets) stack.
+    Contrasts are evaluated at their default starting centers. b0_map (ppm) is estimated from the
+    Z-spectrum minimum when not given. Returns a dict of 2D maps keyed by title, plus the 'B0' map used.
+    """
+    if custom_contrasts is None:
+        custom_contrasts = default_contrasts
+    imgs, offsets = sort_offsets(np.asarray(imgs), offsets)
+    b0 = b0_from_minimum(imgs, offsets) if b0_map is None else np.nan_to_num(np.asarray(b0_map, dtype=float))
+    background = background_fit(imgs, offsets, b0, custom_contrasts, config)
+    p0_2, _, _ = contrast_bounds(custom_contrasts, config)
+    centers = dict(zip(custom_contrasts, p0_2[2::3]))
+    maps = {}
+    for delta in sorted({abs(center) for center in centers.values()}):
+        maps[f"MTRasym ({delta:g} ppm)"] = 100 * mtr_asym(imgs, offsets, delta, b0)
+    for contrast, center in centers.items():
+        maps[f"LD {contrast}"] = 100 * lorentzian_difference_at(imgs, offsets, center, b0, background, config)
+    maps['B0'] = b0
+    return maps